@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import directio
+from subprocess import check_output, call
+from optparse import OptionParser
+
+
+def percentile(latencies, percent):
+    # 'latencies' must already be sorted
+    if not latencies:
+        return 0.0
+    index = int(round((len(latencies) - 1) * percent / 100.0))
+    return latencies[index]
+
+
+def offsets(pattern, block_size, size, stride, seed):
+    # The offset of every block the run will touch
+    count = size / block_size
+    if pattern == 'sequential':
+        return [index * block_size for index in xrange(count)]
+    if pattern == 'random':
+        blocks = range(count)
+        random.Random(seed).shuffle(blocks)
+        return [index * block_size for index in blocks]
+    if pattern == 'strided':
+        # Every 'stride' blocks, like the metadata stores of a cow
+        # where one store is followed by the chunks it describes
+        return [index * block_size for index in xrange(1, count, stride)]
+    raise ValueError("unknown pattern '%s'" % pattern)
+
+
+def run_sync(fd, op, blocks, buf, block_size):
+    latencies = []
+    for offset in blocks:
+        start = time.time()
+        fd.seek(offset)
+        if op == 'read':
+            fd.read(block_size)
+        else:
+            fd.write(buf)
+        latencies.append(time.time() - start)
+    fd.flush()
+    return latencies
+
+
+def run_engine(engine, op, blocks, buf, block_size, depth):
+    latencies = []
+    op = directio.READ if op == 'read' else directio.WRITE
+    blocks = iter(blocks)
+    while True:
+        batch = [(op, offset, buf if op == directio.WRITE else block_size)
+                for offset, _ in zip(blocks, xrange(depth))]
+        if not batch:
+            break
+        engine.submit(batch)
+        for completion in engine.drain():
+            if completion.error:
+                raise completion.error
+            latencies.append(completion.latency)
+    return latencies
+
+
+def run(path, op, pattern, block_size, buffered, concurrency, options):
+    blocks = offsets(pattern, block_size, options.size, options.stride,
+            options.seed)
+    buf = directio.allocate(block_size)
+    buf.write('A' * block_size)
+
+    fd = directio.open(path, buffered=buffered)
+    engine = None
+    try:
+        if concurrency > 1:
+            if options.engine == 'threads':
+                engine = directio.ThreadedIO(fd, workers=concurrency)
+            else:
+                engine = directio.engine(fd, depth=concurrency)
+        start = time.time()
+        if engine:
+            latencies = run_engine(engine, op, blocks, buf, block_size,
+                    concurrency)
+        else:
+            latencies = run_sync(fd, op, blocks, buf, block_size)
+        elapsed = time.time() - start
+    finally:
+        if engine:
+            engine.close()
+        fd.close()
+
+    latencies.sort()
+    return {
+        'op': op, 'pattern': pattern, 'block_size': block_size,
+        'buffered': buffered, 'concurrency': concurrency,
+        'stride': options.stride if pattern == 'strided' else 1,
+        'engine': type(engine).__name__ if engine else 'sync',
+        'ios': len(latencies), 'bytes': len(latencies) * block_size,
+        'seconds': elapsed,
+        'mbps': (len(latencies) * block_size / 1048576.0) / elapsed,
+        'iops': len(latencies) / elapsed,
+        'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def key(result):
+    return (result['op'], result['pattern'], result['block_size'],
+            result['buffered'], result['concurrency'], result['stride'])
+
+
+def compare(results, baseline, tolerance):
+    # Return the results whose throughput fell more than 'tolerance'
+    # below the matching baseline result
+    baseline = dict((key(result), result) for result in baseline)
+    regressions = []
+    for result in results:
+        previous = baseline.get(key(result))
+        if not previous:
+            continue
+        result['baseline_mbps'] = previous['mbps']
+        if result['mbps'] < previous['mbps'] * (1 - tolerance):
+            regressions.append(result)
+    return regressions
+
+
+def select_ops(ops, target, write=False):
+    # The operations to run; write runs overwrite the target with 'A's,
+    # so a file or device the user gave is only read unless they ask
+    if ops is None:
+        ops = 'read' if target else 'read,write'
+    ops = ops.split(',')
+    for op in ops:
+        if op not in ('read', 'write'):
+            raise ValueError("unknown op '%s'" % op)
+    if target and 'write' in ops and not write:
+        raise ValueError("write runs overwrite '%s', pass --write to allow "
+                "it" % target)
+    return ops
+
+
+def create_target(options):
+    # A temp file filled with data, so reads don't hit sparse holes
+    fd, path = tempfile.mkstemp(dir=options.dir, prefix='bench-')
+    os.close(fd)
+    buf = directio.allocate(1048576)
+    buf.write('B' * 1048576)
+    with directio.open(path, buffered=0) as fd:
+        for index in xrange(options.size / 1048576):
+            fd.write(buf)
+    return path
+
+
+def sweep(path, options):
+    results = []
+    for op in options.ops:
+        for pattern in options.patterns.split(','):
+            for block_size in [int(size) for size
+                    in options.block_sizes.split(',')]:
+                for buffered in [int(size) for size
+                        in options.buffered.split(',')]:
+                    for concurrency in [int(depth) for depth
+                            in options.concurrency.split(',')]:
+                        # Only the raw handle can do positional I/O
+                        if concurrency > 1 and buffered:
+                            continue
+                        result = run(path, op, pattern, block_size,
+                                buffered, concurrency, options)
+                        print >> sys.stderr, "-- %(op)s %(pattern)s " \
+                                "bs=%(block_size)d buffered=%(buffered)d " \
+                                "depth=%(concurrency)d: %(mbps).1f MB/s " \
+                                "%(iops).0f IOPS p99 %(p99).6fs" % result
+                        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    description = "Benchmark directio read and write patterns"
+    parser = OptionParser(usage="Usage: %prog [<file or device>] [-h]",
+            description=description)
+    parser.add_option('--ops',
+            help="Operations to run, 'read', 'write' or both (default: "
+                "read,write on a temp file, read on a given target)")
+    parser.add_option('--write', const=True, action='store_const',
+            help="Allow write runs on a given file or device, destroying "
+                "its contents")
+    parser.add_option('--patterns', default='sequential,random,strided',
+            help="Access patterns to run (default: %default)")
+    parser.add_option('--block-sizes', default='4096,65536,1048576',
+            help="Block sizes to run (default: %default)")
+    parser.add_option('--buffered', default='0,32768',
+            help="directio.open() buffer sizes, 0 is unbuffered "
+                "(default: %default)")
+    parser.add_option('--concurrency', default='1,16',
+            help="Requests in flight (default: %default)")
+    parser.add_option('--engine', default='auto', choices=['auto', 'threads'],
+            help="Engine used when concurrency is more than 1, auto uses "
+                "native AIO where available (default: %default)")
+    parser.add_option('--stride', type='int', default=257,
+            help="Blocks between each access of the strided pattern, 257 "
+                "matches the metadata stores of a cow with 4k chunks "
+                "(default: %default)")
+    parser.add_option('--size', type='int', default=67108864,
+            help="Bytes of the target covered by each run "
+                "(default: %default)")
+    parser.add_option('--seed', type='int', default=0,
+            help="Seed for the random pattern (default: %default)")
+    parser.add_option('--dir', default=None,
+            help="Directory for the temp file when no target is given")
+    parser.add_option('--loop', const=True, action='store_const',
+            help="Attach the temp file to a loop device (requires root)")
+    parser.add_option('-o', '--output', metavar='FILE',
+            help="Write the results to FILE as JSON instead of stdout")
+    parser.add_option('-b', '--baseline', metavar='FILE',
+            help="Compare against the results in FILE and exit non-zero "
+                "on a regression")
+    parser.add_option('--tolerance', type='float', default=0.1,
+            help="Fraction of baseline throughput that may be lost "
+                "before a run counts as a regression (default: %default)")
+    options, args = parser.parse_args()
+
+    try:
+        options.ops = select_ops(options.ops, args[0] if args else None,
+                options.write)
+    except ValueError, e:
+        print >> sys.stderr, "-- %s" % e
+        sys.exit(1)
+
+    temp, device = (None, None)
+    if args:
+        path = args[0]
+    else:
+        path = temp = create_target(options)
+        if options.loop:
+            device = check_output("losetup --show -f %s" % temp,
+                    shell=True).strip()
+            path = device
+
+    try:
+        results = sweep(path, options)
+    finally:
+        if device:
+            call("losetup -d %s" % device, shell=True)
+        if temp:
+            os.unlink(temp)
+
+    regressions = []
+    if options.baseline:
+        with open(options.baseline) as file:
+            regressions = compare(results, json.load(file), options.tolerance)
+        for result in regressions:
+            print >> sys.stderr, "-- Regression %(op)s %(pattern)s " \
+                    "bs=%(block_size)d buffered=%(buffered)d " \
+                    "depth=%(concurrency)d: %(mbps).1f MB/s, baseline " \
+                    "%(baseline_mbps).1f MB/s" % result
+
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print json.dumps(results, indent=2)
+
+    sys.exit(1 if regressions else 0)
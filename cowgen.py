@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+
+import sys
+import random
+from array import array
+from struct import pack
+from optparse import OptionParser
+
+SECTOR_SHIFT = 9
+SNAPSHOT_DISK_MAGIC = 0x70416e53
+SNAPSHOT_DISK_VERSION = 1
+
+
+def image_size(exceptions, chunk_size):
+    # Header chunk, then every metadata store followed by its chunks,
+    # plus the store after the last full one which ends the cow
+    exceptions_per_chunk = chunk_size / 16
+    stores = (exceptions / exceptions_per_chunk) + 1
+    return chunk_size * (1 + (stores * (exceptions_per_chunk + 1)))
+
+
+def fill_buffer(fill, length, rand):
+    if fill == 'none':
+        return None
+    if fill == 'random':
+        return ('%0*x' % (length * 2, rand.getrandbits(length * 8))) \
+                .decode('hex')
+    return chr(int(fill) & 0xff) * length
+
+
+def generate(path, exceptions, chunk_sectors=8, fill='88', fragmentation=0.0,
+        origin_chunks=None, seed=0, size=None, valid=1):
+    # Write a version 1 dm-snapshot cow image to 'path' holding
+    # 'exceptions' exceptions. 'fragmentation' is the fraction of each
+    # store whose chunks are shuffled out of order and whose old chunks
+    # are picked at random from 'origin_chunks'; 'fill' is the byte value
+    # written to every exception chunk, 'random' for one chunk of random
+    # bytes written to each of them, or 'none' to leave the chunks as
+    # sparse holes
+    chunk_size = chunk_sectors << SECTOR_SHIFT
+    exceptions_per_chunk = chunk_size / 16
+    rand = random.Random(seed)
+    origin_chunks = origin_chunks or max(exceptions * 4, 1)
+    minimum = image_size(exceptions, chunk_size)
+    if size is not None and size < minimum:
+        raise ValueError("an image of %d exceptions needs at least %d bytes"
+                % (exceptions, minimum))
+
+    with open(path, 'wb') as file:
+        file.truncate(size or minimum)
+        file.write(pack('<IIII', SNAPSHOT_DISK_MAGIC, valid,
+            SNAPSHOT_DISK_VERSION, chunk_sectors))
+
+        # A single chunk is written over and over, a buffer for the whole
+        # store would be 16GiB at the largest chunk size
+        data = fill_buffer(fill, chunk_size, rand)
+        store, old_chunk = (0, 0)
+        while exceptions > 0:
+            count = min(exceptions, exceptions_per_chunk)
+            first = 1 + ((exceptions_per_chunk + 1) * store)
+            new_chunks = range(first + 1, first + 1 + count)
+            # Shuffle a fraction of the chunks out of order
+            moved = [index for index in xrange(count)
+                    if rand.random() < fragmentation]
+            targets = list(moved)
+            rand.shuffle(targets)
+            chunks = list(new_chunks)
+            for index, target in zip(moved, targets):
+                new_chunks[index] = chunks[target]
+
+            records = array('L')
+            for new_chunk in new_chunks:
+                if rand.random() < fragmentation:
+                    records.extend((rand.randrange(origin_chunks), new_chunk))
+                else:
+                    records.extend((old_chunk % origin_chunks, new_chunk))
+                old_chunk = old_chunk + 1
+            if sys.byteorder != 'little':
+                records.byteswap()
+            file.seek(first * chunk_size)
+            file.write(records.tostring())
+            if data:
+                file.seek((first + 1) * chunk_size)
+                for index in xrange(count):
+                    file.write(data)
+            exceptions = exceptions - count
+            store = store + 1
+    return chunk_size
+
+
+if __name__ == "__main__":
+    description = "Create a dm-snapshot cow image for testing the scrubber"
+    parser = OptionParser(usage="Usage: %prog <image> <exceptions> [-h]",
+            description=description)
+    parser.add_option('-c', '--chunk-sectors', type='int', default=8,
+            help="Chunk size in 512 byte sectors (default: %default)")
+    parser.add_option('-f', '--fill', default='88',
+            help="Byte value written to each exception chunk, 'random', or "
+                "'none' to leave them sparse (default: %default)")
+    parser.add_option('-F', '--fragmentation', type='float', default=0.0,
+            help="Fraction of the exceptions in each store written out of "
+                "order with random origin chunks (default: %default)")
+    parser.add_option('-o', '--origin-chunks', type='int',
+            help="Number of chunks in the origin (default: 4 times the "
+                "number of exceptions)")
+    parser.add_option('-s', '--size', type='int',
+            help="Size of the image in bytes (default: the smallest that "
+                "holds every exception)")
+    parser.add_option('--seed', type='int', default=0,
+            help="Random seed (default: %default)")
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        generate(args[0], int(args[1]), options.chunk_sectors, options.fill,
+                options.fragmentation, options.origin_chunks, options.seed,
+                options.size)
+    except ValueError, e:
+        print "-- %s" % e
+        sys.exit(1)
@@ -1,56 +1,483 @@
 #! /usr/bin/env python
 
-from ctypes import cdll, util, c_int, c_void_p, c_size_t, \
-        c_uint64, byref, get_errno, CDLL, string_at, memmove, c_char_p
+from ctypes import cdll, util, c_int, c_void_p, c_size_t, c_char, \
+        c_uint64, c_int64, byref, get_errno, CDLL, string_at, memmove, \
+        c_char_p, addressof, cast, c_uint32, c_uint16, c_int16, c_long, \
+        c_ulong, Structure, create_string_buffer
+from collections import namedtuple, OrderedDict, deque
+from bisect import bisect_left, insort
+from struct import pack, unpack, unpack_from, pack_into, calcsize
+import threading
+import fcntl
+import time
+import Queue
+import mmap
+import stat
 import os
 import io
 import resource
+import __builtin__
 
 
 libc = CDLL(util.find_library('c'), use_errno=True)
 
+# Operations accepted by the positional I/O engines
+READ, WRITE = ('read', 'write')
 
-def open(path, mode='+', buffered=-1):
-    if buffered == -1:
-        # This size appears on par with kernel buffer sizes
-        # and performance is about the same
-        buffered = 32768
+# Block device ioctls that zero or discard a range of the device
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+
+# Block device ioctls returning the logical and physical block sizes,
+# the minimum and the optimal I/O size
+BLKSSZGET = 0x1268
+BLKPBSZGET = 0x127b
+BLKIOMIN = 0x1278
+BLKIOOPT = 0x1279
+
+# statx(2) flags asking for the O_DIRECT alignment of a file descriptor
+AT_EMPTY_PATH = 0x1000
+STATX_DIOALIGN = 0x2000
+
+# pwritev2(2) flag making a single write durable, like O_DSYNC
+RWF_DSYNC = 0x2
+
+# fallocate(2) modes
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+FALLOC_FL_ZERO_RANGE = 0x10
+
+# The result of a single request submitted to an I/O engine, 'latency'
+# is the seconds between submitting the request and its completion
+Completion = namedtuple('Completion', 'id op offset result error latency')
 
+# A traced I/O, 'time' is when it was issued and 'op' one of TRACE_OPS;
+# the trace file is a TRACE_HEADER then TRACE_RECORD's, see TraceRecorder
+TraceRecord = namedtuple('TraceRecord', 'time op offset length latency')
+TRACE_OPS = (READ, WRITE, 'zeroout', 'discard', 'punch', 'zero-range',
+        'fallocate', 'flush')
+TRACE_CODES = dict((op, code) for code, op in enumerate(TRACE_OPS))
+TRACE_MAGIC, TRACE_VERSION = ('DIOT', 1)
+TRACE_HEADER = '<4sII'
+TRACE_RECORD = '<dQIfB3x'
+TRACE_RECORD_SIZE = calcsize(TRACE_RECORD)
+
+# The I/O sizes of a device in bytes; 'logical' is the alignment O_DIRECT
+# requires, 'optimal' is 0 when the device has no preference
+Geometry = namedtuple('Geometry', 'logical physical minimum optimal')
+
+
+def open(path, mode='+', buffered=-1, trace=None, cache=None):
     if 'r' in mode:
-        raw = RawDirect(path, mode=os.O_RDONLY)
-        return io.BufferedReader(raw, buffer_size=buffered)
-    if 'w' in mode or 'a' in mode:
-        raw = RawDirect(path, mode=os.O_WRONLY)
-        return io.BufferedWriter(raw, buffer_size=buffered)
-    if '+' in mode:
-        raw = RawDirect(path)
-        return io.BufferedRandom(raw, buffer_size=buffered)
-    raise ValueError("unknown mode: '%s'", mode)
+        raw, buffer_class = (RawDirect(path, mode=os.O_RDONLY, trace=trace,
+            cache=cache), io.BufferedReader)
+    elif 'w' in mode or 'a' in mode:
+        raw, buffer_class = (RawDirect(path, mode=os.O_WRONLY, trace=trace,
+            cache=cache), io.BufferedWriter)
+    elif '+' in mode:
+        raw, buffer_class = (RawDirect(path, trace=trace, cache=cache),
+                io.BufferedRandom)
+    else:
+        raise ValueError("unknown mode: '%s'", mode)
 
+    if buffered == 0:
+        # Callers doing aligned I/O gain nothing from re-buffering,
+        # hand them the raw handle instead
+        return raw
+    if buffered == -1:
+        buffered = buffer_size(raw.geometry)
+    return buffer_class(raw, buffer_size=buffered)
 
-class RawDirect(io.RawIOBase):
 
-    def __init__(self, path, mode=os.O_RDWR):
-        self._fd = os.open(path, os.O_DIRECT | mode)
-        self._closed = False
-        # There is currently no file system-independent interface
-        # for an application to discover the byte alignment restrictions
-        # for a given file or file system,  So we default to 512
-        self._byte_alignment = 512
+def buffer_size(geometry):
+    # 32768 appears on par with kernel buffer sizes, round it up to
+    # whole optimal I/Os so a RAID gets full stripe writes
+    optimal = max(geometry.optimal, geometry.logical)
+    return ((32768 + optimal - 1) / optimal) * optimal
+
+
+def _ioctl_size(fd, request, default):
+    try:
+        return unpack('I', fcntl.ioctl(fd, request, pack('I', 0)))[0]
+    except IOError:
+        return default
+
+
+def _dio_alignment(fd):
+    # Kernels since 6.1 report the O_DIRECT alignment of a file, 0 if not
+    statx = getattr(libc, 'statx', None)
+    if statx is None:
+        return 0
+    buf = create_string_buffer(256)
+    if statx(fd, '', AT_EMPTY_PATH, STATX_DIOALIGN, buf) != 0:
+        return 0
+    mask, = unpack_from('I', buf.raw)
+    if not mask & STATX_DIOALIGN:
+        return 0
+    # stx_dio_offset_align
+    return unpack_from('I', buf.raw, 156)[0]
+
+
+def geometry(fd):
+    # Ask a block device for its block and I/O sizes, for files use the
+    # O_DIRECT alignment the file system reports and its st_blksize.
+    # Without either we fall back to 512, the smallest any device uses
+    info = os.fstat(fd)
+    if stat.S_ISBLK(info.st_mode):
+        logical = _ioctl_size(fd, BLKSSZGET, 512)
+        physical = _ioctl_size(fd, BLKPBSZGET, logical)
+        return Geometry(logical, physical,
+                _ioctl_size(fd, BLKIOMIN, physical),
+                _ioctl_size(fd, BLKIOOPT, 0))
+    logical = _dio_alignment(fd) or 512
+    blksize = max(info.st_blksize, logical)
+    return Geometry(logical, blksize, blksize, blksize)
+
+
+def allocate(size):
+    # Anonymous maps are page aligned, which satisfies any O_DIRECT
+    # alignment; the returned buffer can be passed to write() and
+    # readinto() without copying
+    return mmap.mmap(-1, size)
+
 
-        # Tell python about our libc calls
+def view(buf, length, offset=0):
+    # A zero copy window of 'length' bytes into a writable buffer
+    return (c_char * length).from_buffer(buf, offset)
+
+
+def address_of(buf):
+    # Return the memory address of 'buf' if we can reach it without
+    # copying, writable buffers (bytearray, mmap, ctypes arrays) and str
+    try:
+        return addressof((c_char * len(buf)).from_buffer(buf))
+    except TypeError:
+        pass
+    if isinstance(buf, str):
+        return cast(c_char_p(buf), c_void_p).value
+    return None
+
+
+class BufferPool(object):
+    # Allocating aligned buffers for every read and write is expensive,
+    # keep the released buffers around keyed by size and free the least
+    # recently released ones once 'max_bytes' are held by the pool
+
+    def __init__(self, alignment=4096, max_bytes=16777216):
+        self.alignment = alignment
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._free = {}
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
         self._memalign = libc.posix_memalign
         self._memalign.argtypes = [c_void_p, c_size_t, c_size_t]
-        self._memalign.errcheck = self.error_check
-        self._cread = libc.read
-        self._cread.argtypes = [c_int, c_void_p, c_size_t]
-        self._cread.errcheck = self.error_check
-        self._cwrite = libc.write
-        self._cwrite.argtypes = [c_int, c_void_p, c_size_t]
-        self._cwrite.errcheck = self.error_check
         self._cfree = libc.free
         self._cfree.argtypes = [c_void_p]
-        self._cfree.errcheck = self.error_check
+        self._cfree.restype = None
+
+    def acquire(self, length):
+        with self._lock:
+            buffers = self._free.get(length)
+            if buffers:
+                address = buffers.pop()
+                del self._lru[address]
+                self.size = self.size - length
+                return address
+        c_buf = c_void_p()
+        result = self._memalign(byref(c_buf), self.alignment, length)
+        if result != 0:
+            raise OSError(result, os.strerror(result))
+        return c_buf.value
+
+    def release(self, address, length):
+        if length > self.max_bytes:
+            return self._cfree(address)
+        with self._lock:
+            self._free.setdefault(length, []).append(address)
+            self._lru[address] = length
+            self.size = self.size + length
+            # Evict the least recently released buffers
+            while self.size > self.max_bytes:
+                address, length = self._lru.popitem(last=False)
+                self._free[length].remove(address)
+                self.size = self.size - length
+                self._cfree(address)
+
+    def clear(self):
+        with self._lock:
+            for address in self._lru:
+                self._cfree(address)
+            self._free, self._lru, self.size = ({}, OrderedDict(), 0)
+
+
+# Shared by every RawDirect unless given a pool of their own
+buffers = BufferPool()
+
+
+def cache_key(info):
+    # What a BlockCache files reads under, from the os.stat() of a file
+    # or device; a file changed by anyone usually gets a new key, but not
+    # when rewritten at the same size within one timestamp tick
+    if stat.S_ISBLK(info.st_mode):
+        return ('block', info.st_rdev)
+    return ('file', info.st_dev, info.st_ino, info.st_size, info.st_mtime,
+            info.st_ctime)
+
+
+class BlockCache(object):
+    # Aligned reads kept in memory up to 'max_bytes', the least recently
+    # used go first. Reads are filed under the file or device they came
+    # from, so every RawDirect on the same device shares them, and any
+    # write through a RawDirect with the cache drops the reads it
+    # overlaps. A read that was in flight while an overlapping write
+    # completed is not cached, see generation() and put()
+
+    def __init__(self, max_bytes=67108864, write_log=4096):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # (key, offset, length) => data in least recently used order
+        self._entries = OrderedDict()
+        # key => sorted (offset, length) of its entries and the longest
+        self._ranges = {}
+        self._longest = {}
+        # key => the number of writes so far and the last 'write_log'
+        # of them as (generation, offset, end)
+        self._generations = {}
+        self._writes = {}
+        self._write_log = write_log
+        self._lock = threading.Lock()
+
+    def get(self, key, offset, length):
+        with self._lock:
+            data = self._entries.pop((key, offset, length), None)
+            if data is None:
+                self.misses = self.misses + 1
+                return None
+            self._entries[(key, offset, length)] = data
+            self.hits = self.hits + 1
+            return data
+
+    def generation(self, key):
+        # Take before reading, then hand to put() with the data
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def put(self, key, offset, length, data, generation):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if self._written(key, offset, offset + length, generation):
+                return
+            if (key, offset, length) in self._entries:
+                return
+            self._entries[(key, offset, length)] = data
+            insort(self._ranges.setdefault(key, []), (offset, length))
+            self._longest[key] = max(self._longest.get(key, 0), length)
+            self.size = self.size + len(data)
+            while self.size > self.max_bytes:
+                self._evict(*next(iter(self._entries)))
+
+    def _written(self, key, offset, end, generation):
+        # True if a write since 'generation' overlapped the range
+        if self._generations.get(key, 0) == generation:
+            return False
+        writes = self._writes.get(key)
+        if not writes or writes[0][0] > generation + 1:
+            # The log no longer goes back that far
+            return True
+        for written, first, last in writes:
+            if written > generation and first < end and last > offset:
+                return True
+        return False
+
+    def _evict(self, key, offset, length):
+        data = self._entries.pop((key, offset, length))
+        ranges = self._ranges[key]
+        del ranges[bisect_left(ranges, (offset, length))]
+        if not ranges:
+            del self._ranges[key]
+            del self._longest[key]
+        self.size = self.size - len(data)
+
+    def invalidate(self, key, offset, length):
+        # Drop the reads that overlap a write of 'length' at 'offset'
+        end = offset + length
+        with self._lock:
+            generation = self._generations.get(key, 0) + 1
+            self._generations[key] = generation
+            writes = self._writes.setdefault(key,
+                    deque(maxlen=self._write_log))
+            writes.append((generation, offset, end))
+            ranges = self._ranges.get(key)
+            if not ranges:
+                return
+            first = bisect_left(ranges, (offset - self._longest[key] + 1,))
+            for start, size in ranges[first:bisect_left(ranges, (end,))]:
+                if start + size > offset:
+                    self._evict(key, start, size)
+
+    def forget(self, key):
+        # Drop everything read from a device, e.g. before it is removed
+        # and its major:minor handed to another
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._writes.pop(key, None)
+            for start, size in list(self._ranges.get(key, [])):
+                self._evict(key, start, size)
+
+    def forget_path(self, path):
+        self.forget(cache_key(os.stat(path)))
+
+    def clear(self):
+        with self._lock:
+            self._entries, self._ranges, self._longest = (OrderedDict(),
+                    {}, {})
+            self.size = 0
+
+
+class TraceRecorder(object):
+    # Records the (time, op, offset, length, latency) of each I/O in a
+    # preallocated ring of fixed size binary records, so tracing costs a
+    # pack_into() per I/O. With a 'path' the ring is appended to the file
+    # each time it fills and on flush(), otherwise it keeps the last
+    # 'capacity' I/Os in memory like a flight recorder
+
+    def __init__(self, path=None, capacity=65536):
+        self.path = path
+        self.capacity = capacity
+        self.ring = bytearray(capacity * TRACE_RECORD_SIZE)
+        # Every record below 'flushed' is in the file
+        self.recorded = 0
+        self.flushed = 0
+        self.lock = threading.Lock()
+        if path:
+            with __builtin__.open(path, 'wb') as file:
+                file.write(pack(TRACE_HEADER, TRACE_MAGIC, TRACE_VERSION,
+                    TRACE_RECORD_SIZE))
+
+    def record(self, op, offset, length, start, latency):
+        with self.lock:
+            pack_into(TRACE_RECORD, self.ring, (self.recorded % self.capacity)
+                    * TRACE_RECORD_SIZE, start, offset, length, latency,
+                    TRACE_CODES[op])
+            self.recorded = self.recorded + 1
+            if self.path and self.recorded - self.flushed == self.capacity:
+                self._flush()
+
+    def _flush(self):
+        first = (self.flushed % self.capacity) * TRACE_RECORD_SIZE
+        last = (self.recorded % self.capacity) * TRACE_RECORD_SIZE
+        with __builtin__.open(self.path, 'ab') as file:
+            if last <= first:
+                file.write(buffer(self.ring, first))
+                first = 0
+            file.write(buffer(self.ring, first, last - first))
+        self.flushed = self.recorded
+
+    def flush(self):
+        with self.lock:
+            if self.path and self.recorded > self.flushed:
+                self._flush()
+
+    def records(self):
+        # The records still in the ring, oldest first
+        with self.lock:
+            first = max(0, self.recorded - self.capacity)
+            return [_trace_record(self.ring, (index % self.capacity)
+                * TRACE_RECORD_SIZE) for index in xrange(first, self.recorded)]
+
+
+def _trace_record(data, offset):
+    start, position, length, latency, code = unpack_from(TRACE_RECORD,
+            data, offset)
+    return TraceRecord(start, TRACE_OPS[code], position, length, latency)
+
+
+def read_trace(path):
+    # Yield the TraceRecord's of a file written by TraceRecorder
+    with __builtin__.open(path, 'rb') as file:
+        header = file.read(calcsize(TRACE_HEADER))
+        if len(header) < calcsize(TRACE_HEADER):
+            raise ValueError("'%s' is not a directio trace" % path)
+        magic, version, size = unpack(TRACE_HEADER, header)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION \
+                or size != TRACE_RECORD_SIZE:
+            raise ValueError("'%s' is not a version %d directio trace"
+                    % (path, TRACE_VERSION))
+        while True:
+            data = file.read(size * 4096)
+            for offset in xrange(0, len(data) - size + 1, size):
+                yield _trace_record(data, offset)
+            if len(data) < size * 4096:
+                return
+
+
+def _error_check(result, func, args):
+    if result < 0:
+        errno = get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+
+def _libc_function(name, *argtypes):
+    # Tell python about our libc calls once, not on every open
+    function = getattr(libc, name)
+    function.argtypes = list(argtypes)
+    function.errcheck = _error_check
+    return function
+
+
+_cread = _libc_function('read', c_int, c_void_p, c_size_t)
+_cwrite = _libc_function('write', c_int, c_void_p, c_size_t)
+_cpread = _libc_function('pread', c_int, c_void_p, c_size_t, c_int64)
+_cpwrite = _libc_function('pwrite', c_int, c_void_p, c_size_t, c_int64)
+_cfallocate = _libc_function('fallocate', c_int, c_int, c_int64, c_int64)
+# glibc 2.26 and later
+_cpwritev2 = None
+if hasattr(libc, 'pwritev2'):
+    _cpwritev2 = _libc_function('pwritev2', c_int, c_void_p, c_int, c_int64,
+            c_int)
+
+
+class IOVec(Structure):
+    _fields_ = [('iov_base', c_void_p), ('iov_len', c_size_t)]
+
+
+def _dsync_pwrite(fd, address, length, offset):
+    return _cpwritev2(fd, byref(IOVec(address, length)), 1, offset,
+            RWF_DSYNC)
+
+
+def _dsync_write(fd, address, length):
+    # An offset of -1 writes at the file position
+    return _dsync_pwrite(fd, address, length, -1)
+
+
+class RawDirect(io.RawIOBase):
+
+    def __init__(self, path, mode=os.O_RDWR, pool=None, trace=None,
+            cache=None):
+        self._fd = os.open(path, os.O_DIRECT | mode)
+        self._closed = False
+        self.geometry = geometry(self._fd)
+        # O_DIRECT lengths and offsets must be multiples of the
+        # logical block size
+        self._byte_alignment = self.geometry.logical
+        self._pool = pool or buffers
+        self._cread, self._cwrite = (_cread, _cwrite)
+        self._cpread, self._cpwrite = (_cpread, _cpwrite)
+        self._cfallocate = _cfallocate
+        # Write through the device's cache with RWF_DSYNC, see set_dsync()
+        self.dsync = False
+        # Record every I/O in a TraceRecorder
+        self.trace = trace
+        # Serve cached_pread() from a BlockCache, every write drops the
+        # cached reads it overlaps
+        self.cache = cache
+        self.cache_key = cache_key(os.fstat(self._fd)) if cache else None
 
     def _get_closed(self):
         return self._closed
@@ -59,32 +486,97 @@ class RawDirect(io.RawIOBase):
             "Returns True if the file handle is closed")
 
     def error_check(self, result, func, args):
-        if result < 0:
-            errno = get_errno()
-            raise OSError(errno, os.strerror(errno))
-        return result
+        return _error_check(result, func, args)
 
     def write(self, buf):
-        if isinstance(buf, memoryview):
-            buf = buf.tobytes()
+        return self._write(buf, None)
+
+    def pwrite(self, buf, offset):
+        # Write at 'offset' without moving the file position, this
+        # allows many threads to share the same file descriptor
+        return self._write(buf, offset)
 
+    def _write(self, buf, offset):
         length = len(buf)
+        self._check_alignment(length, "write a buffer")
+        address = address_of(buf)
+        # Aligned buffers are written directly without a copy
+        if address is not None and address % self._byte_alignment == 0:
+            return self._write_io(address, length, offset)
+
+        if address is None:
+            buf = buf.tobytes()
+            address = address_of(buf)
+        # Copy the bytes into a mem aligned c buffer from the pool
+        c_buf = self._pool.acquire(length)
+        try:
+            memmove(c_buf, address, length)
+            return self._write_io(c_buf, length, offset)
+        finally:
+            self._pool.release(c_buf, length)
+
+    def _io(self, func, pfunc, address, length, offset):
+        if self.trace:
+            return self._traced(READ if func is _cread else WRITE, offset,
+                    length, self._untraced_io, func, pfunc, address, length,
+                    offset)
+        return self._untraced_io(func, pfunc, address, length, offset)
+
+    def _untraced_io(self, func, pfunc, address, length, offset):
+        if offset is None:
+            return func(self._fd, address, length)
+        return pfunc(self._fd, address, length, offset)
+
+    def _traced(self, op, offset, length, function, *args):
+        if offset is None:
+            offset = os.lseek(self._fd, 0, os.SEEK_CUR)
+        start = time.time()
+        try:
+            return function(*args)
+        finally:
+            self.trace.record(op, offset, length, start, time.time() - start)
+
+    def _write_io(self, address, length, offset):
+        if self.cache:
+            position = offset
+            if offset is None:
+                position = os.lseek(self._fd, 0, os.SEEK_CUR)
+            try:
+                return self._uncached_write_io(address, length, offset)
+            finally:
+                self.invalidate(position, length)
+        return self._uncached_write_io(address, length, offset)
+
+    def _uncached_write_io(self, address, length, offset):
+        if self.dsync:
+            return self._io(_dsync_write, _dsync_pwrite, address, length,
+                    offset)
+        return self._io(self._cwrite, self._cpwrite, address, length, offset)
+
+    def invalidate(self, offset, length):
+        # Drop the cached reads a change of the range made stale
+        if self.cache:
+            self.cache.invalidate(self.cache_key, offset, length)
+
+    def cached_pread(self, length, offset):
+        # Like pread() but served from the BlockCache when it has the
+        # same read, for data such as metadata that is read repeatedly
+        if not self.cache:
+            return self.pread(length, offset)
+        data = self.cache.get(self.cache_key, offset, length)
+        if data is None:
+            generation = self.cache.generation(self.cache_key)
+            data = self.pread(length, offset)
+            self.cache.put(self.cache_key, offset, length, data, generation)
+        return data
+
+    def _check_alignment(self, length, action):
         block, remainder = divmod(length, self._byte_alignment)
-        # As long as the buf size is a multiple of the byte alignment
-        if remainder == 0:
-            # Allocate the a mem aligned c buffer
-            c_buf = c_void_p()
-            self._memalign(byref(c_buf), self._byte_alignment, length)
-            # Copy the bytes into the c_buf
-            memmove(c_buf, c_char_p(buf), length)
-            # Write out the buffer
-            write_len = self._cwrite(self._fd, c_buf, length)
-            self._cfree(c_buf)
-            return write_len
-
-        raise OSError(22, "Refusing to write a buffer of length %d"\
-                "; length must be a multiple of %d" % (length,
-                    self._byte_alignment))
+        # As long as the length is a multiple of the byte alignment
+        if remainder != 0:
+            raise OSError(22, "Refusing to %s of length %d"\
+                    "; length must be a multiple of %d" % (action, length,
+                        self._byte_alignment))
 
     def read(self, length=None):
         # If length is -1 or None, call self.readall()
@@ -93,42 +585,65 @@ class RawDirect(io.RawIOBase):
 
         return self._read(length)[1]
 
-    def _read(self, length):
-        block, remainder = divmod(length, self._byte_alignment)
-        # As long as the length is a multiple of the byte alignment
-        if remainder == 0:
-            # Allocate the a mem aligned c buffer
-            c_buf = c_void_p()
-            self._memalign(byref(c_buf), self._byte_alignment, length)
-            length = self._cread(self._fd, c_buf, length)
+    def pread(self, length, offset):
+        # Read from 'offset' without moving the file position
+        return self._read(length, offset)[1]
+
+    def _read(self, length, offset=None):
+        self._check_alignment(length, "read buffer")
+        c_buf = self._pool.acquire(length)
+        try:
+            result = self._io(self._cread, self._cpread, c_buf, length, offset)
             # Copy the contents of the c_buf
-            string = string_at(c_buf, length)
-            # Free the c_buf and return the read value
-            self._cfree(c_buf)
-            return (length, string)
+            return (result, string_at(c_buf, result))
+        finally:
+            self._pool.release(c_buf, length)
 
-        raise OSError(22, "Refusing to read buffer of length %d"\
-                "; length must be a multiple of %d" % (length,
-                    self._byte_alignment))
+    def _readinto(self, buf, offset):
+        length = len(buf)
+        self._check_alignment(length, "read buffer")
+        address = address_of(buf)
+        if address is None or isinstance(buf, str):
+            # Not a writable buffer we can reach, copy the result in
+            result, string = self._read(length, offset)
+            buf[0:result] = string
+            return result
+
+        # Aligned buffers are read into directly without a copy
+        if address % self._byte_alignment == 0:
+            return self._io(self._cread, self._cpread, address, length, offset)
+
+        c_buf = self._pool.acquire(length)
+        try:
+            result = self._io(self._cread, self._cpread, c_buf, length, offset)
+            memmove(address, c_buf, result)
+            return result
+        finally:
+            self._pool.release(c_buf, length)
 
     def close(self):
-        # TODO: Free the memalign buffer (self._buf)
+        if self._closed:
+            return
         self._closed = True
+        if self.trace:
+            self.trace.flush()
         return os.close(self._fd)
 
     def readall(self):
         result = []
         while True:
-            buf = self.read(32768)
+            buf = self.read(buffer_size(self.geometry))
             if len(buf) == 0:
                 break
             result.append(buf)
         return ''.join(result)
 
     def readinto(self, buf):
-        length, string = self._read(len(buf))
-        buf[0:len(buf)] = string
-        return length
+        return self._readinto(buf, None)
+
+    def preadinto(self, buf, offset):
+        # Read into 'buf' from 'offset' without moving the file position
+        return self._readinto(buf, offset)
 
     def fileno(self):
         return self._fd
@@ -162,6 +677,70 @@ class RawDirect(io.RawIOBase):
     def truncate(self, size=None):
         return os.ftruncate(self._fd, size)
 
+    def zeroout(self, offset, length):
+        # Have the block device zero the range itself
+        if self.trace:
+            return self._traced('zeroout', offset, length, self._zeroout,
+                    offset, length)
+        return self._zeroout(offset, length)
+
+    def _zeroout(self, offset, length):
+        try:
+            fcntl.ioctl(self._fd, BLKZEROOUT, pack('QQ', offset, length))
+        finally:
+            self.invalidate(offset, length)
+        return length
+
+    def discard(self, offset, length):
+        # Tell the block device the range is no longer in use
+        if self.trace:
+            return self._traced('discard', offset, length, self._discard,
+                    offset, length)
+        return self._discard(offset, length)
+
+    def _discard(self, offset, length):
+        try:
+            fcntl.ioctl(self._fd, BLKDISCARD, pack('QQ', offset, length))
+        finally:
+            self.invalidate(offset, length)
+        return length
+
+    def fallocate(self, mode, offset, length):
+        if self.trace:
+            op = 'fallocate'
+            if mode & FALLOC_FL_PUNCH_HOLE:
+                op = 'punch'
+            elif mode & FALLOC_FL_ZERO_RANGE:
+                op = 'zero-range'
+            return self._traced(op, offset, length, self._fallocate,
+                    mode, offset, length)
+        return self._fallocate(mode, offset, length)
+
+    def _fallocate(self, mode, offset, length):
+        try:
+            self._cfallocate(self._fd, mode, offset, length)
+        finally:
+            self.invalidate(offset, length)
+        return length
+
+    def datasync(self):
+        # O_DIRECT writes skip the page cache but may sit in the device's
+        # volatile write cache until it is flushed; fdatasync(2) flushes
+        # it and returns the seconds it took
+        start = time.time()
+        os.fdatasync(self._fd)
+        latency = time.time() - start
+        if self.trace:
+            self.trace.record('flush', 0, 0, start, latency)
+        return latency
+
+    def set_dsync(self, enabled=True):
+        # Make every write durable on its own with RWF_DSYNC, the
+        # engines pass the flag with each request
+        if enabled and _cpwritev2 is None:
+            raise OSError(38, "pwritev2() is not available for RWF_DSYNC")
+        self.dsync = enabled
+
     def writable(self):
         if self._closed:
             return False
@@ -169,3 +748,329 @@ class RawDirect(io.RawIOBase):
 
     def writelines(self, lines):
         raise OSError(0, "writelines() Un-Implemented")
+
+
+# Positional I/O engines accept (op, offset, buf) requests where 'buf'
+# is either a buffer to read into or the length to read for READ requests;
+# completions are tracked in submission order so callers can tell how
+# far the I/O has advanced.
+class IOEngine(object):
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._next_id = 0
+        self._outstanding = 0
+        # Every request with an id lower than this has completed
+        self.completed = 0
+        self._done = set()
+
+    def _advance(self, completions):
+        self._outstanding = self._outstanding - len(completions)
+        # Advance the in-order completion mark
+        for completion in completions:
+            self._done.add(completion.id)
+        while self.completed in self._done:
+            self._done.remove(self.completed)
+            self.completed = self.completed + 1
+        return completions
+
+    def drain(self):
+        # Wait for every outstanding request, in submission order
+        return sorted(self.reap(self._outstanding))
+
+    def attach(self, raw):
+        # Point an idle engine at another file, so its threads or AIO
+        # context serve one file after another instead of being torn
+        # down and started again for each
+        if self._outstanding:
+            raise OSError(16, "Unable to attach an engine with '%d' "
+                    "requests in flight" % self._outstanding)
+        self._raw = raw
+
+
+# Issue the requests from a pool of threads
+class ThreadedIO(IOEngine):
+
+    def __init__(self, raw, workers=4, depth=None):
+        IOEngine.__init__(self, raw)
+        # Limit the number of requests queued before submit() blocks
+        self._requests = Queue.Queue(depth or workers * 4)
+        self._completions = Queue.Queue()
+        self._threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            id, op, offset, buf, submitted = request
+            try:
+                if op == READ and isinstance(buf, (int, long)):
+                    result = self._raw.pread(buf, offset)
+                elif op == READ:
+                    result = self._raw.preadinto(buf, offset)
+                else:
+                    result = self._raw.pwrite(buf, offset)
+                self._completions.put(Completion(id, op, offset, result,
+                    None, time.time() - submitted))
+            except (OSError, IOError), e:
+                self._completions.put(Completion(id, op, offset, None, e,
+                    time.time() - submitted))
+
+    def submit(self, requests):
+        ids = []
+        for op, offset, buf in requests:
+            self._requests.put((self._next_id, op, offset, buf, time.time()))
+            ids.append(self._next_id)
+            self._next_id = self._next_id + 1
+            self._outstanding = self._outstanding + 1
+        return ids
+
+    def reap(self, min_nr=1, timeout=None):
+        # Wait for at least 'min_nr' completions, then collect any others
+        # that are ready without blocking
+        completions = []
+        while len(completions) < self._outstanding:
+            try:
+                if len(completions) < min_nr:
+                    completion = self._completions.get(True, timeout)
+                else:
+                    completion = self._completions.get(False)
+            except Queue.Empty:
+                break
+            completions.append(completion)
+        return self._advance(completions)
+
+    def close(self):
+        for thread in self._threads:
+            self._requests.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+# Linux native AIO (io_setup(2) and friends) system call numbers, libaio
+# is often not installed so we make the system calls ourselves
+AIO_SYSCALLS = {
+    'x86_64': (206, 207, 208, 209, 210),
+    'aarch64': (0, 1, 4, 2, 3),
+    'ppc64le': (227, 228, 229, 230, 231),
+}
+IOCB_CMD_PREAD, IOCB_CMD_PWRITE = (0, 1)
+
+
+class IOCB(Structure):
+    _fields_ = [('aio_data', c_uint64), ('aio_key', c_uint32),
+            ('aio_rw_flags', c_uint32), ('aio_lio_opcode', c_uint16),
+            ('aio_reqprio', c_int16), ('aio_fildes', c_uint32),
+            ('aio_buf', c_uint64), ('aio_nbytes', c_uint64),
+            ('aio_offset', c_int64), ('aio_reserved2', c_uint64),
+            ('aio_flags', c_uint32), ('aio_resfd', c_uint32)]
+
+
+class IOEvent(Structure):
+    _fields_ = [('data', c_uint64), ('obj', c_uint64),
+            ('res', c_int64), ('res2', c_int64)]
+
+
+class Timespec(Structure):
+    _fields_ = [('tv_sec', c_long), ('tv_nsec', c_long)]
+
+
+# Keep up to 'depth' reads and writes in flight from a single thread
+# using the kernel's native AIO interface; requests past the queue depth
+# wait for a completion to make room.
+class AsyncIO(IOEngine):
+
+    def __init__(self, raw, depth=32):
+        IOEngine.__init__(self, raw)
+        try:
+            (self._sys_setup, self._sys_destroy, self._sys_getevents,
+                    self._sys_submit, self._sys_cancel) = \
+                            AIO_SYSCALLS[os.uname()[4]]
+        except KeyError:
+            raise OSError(38, "Native AIO is not supported on '%s'"
+                    % os.uname()[4])
+        self._depth = depth
+        self._syscall = libc.syscall
+        self._syscall.restype = c_long
+        self._ctx = c_ulong(0)
+        self._check(self._syscall(self._sys_setup, c_long(depth),
+            byref(self._ctx)))
+        self._events = (IOEvent * depth)()
+        self._inflight = {}
+        self._ready = []
+
+    def _check(self, result):
+        if result < 0:
+            errno = get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
+
+    def submit(self, requests):
+        ids = []
+        for op, offset, buf in requests:
+            # Make room in the queue if it is full
+            while len(self._inflight) >= self._depth:
+                self._ready.extend(self._getevents(1))
+            try:
+                self._submit_one(self._next_id, op, offset, buf)
+            except (OSError, IOError), e:
+                # Report the failure like any other completion
+                self._ready.append(Completion(self._next_id, op, offset,
+                    None, e, 0.0))
+            ids.append(self._next_id)
+            self._next_id = self._next_id + 1
+            self._outstanding = self._outstanding + 1
+        return ids
+
+    def _submit_one(self, id, op, offset, buf):
+        if op == READ and isinstance(buf, (int, long)):
+            length, address = (buf, None)
+        else:
+            length, address = (len(buf), address_of(buf))
+        self._raw._check_alignment(length,
+                "read buffer" if op == READ else "write a buffer")
+
+        # Unaligned or unreachable buffers go through the pool
+        c_buf = None
+        if address is None or address % self._raw._byte_alignment != 0:
+            c_buf = self._raw._pool.acquire(length)
+            if op == WRITE:
+                if address is None:
+                    buf = buf.tobytes()
+                    address = address_of(buf)
+                memmove(c_buf, address, length)
+
+        iocb = IOCB()
+        iocb.aio_data = id
+        iocb.aio_lio_opcode = IOCB_CMD_PREAD if op == READ \
+                else IOCB_CMD_PWRITE
+        if op == WRITE and self._raw.dsync:
+            iocb.aio_rw_flags = RWF_DSYNC
+        iocb.aio_fildes = self._raw.fileno()
+        iocb.aio_buf = c_buf or address
+        iocb.aio_nbytes = length
+        iocb.aio_offset = offset
+        iocbs = (c_void_p * 1)(addressof(iocb))
+        try:
+            self._check(self._syscall(self._sys_submit, self._ctx,
+                c_long(1), iocbs))
+        except OSError:
+            if c_buf:
+                self._raw._pool.release(c_buf, length)
+            raise
+        # Hold a reference to everything the kernel is using
+        self._inflight[id] = (iocb, op, offset, buf, address, c_buf, length,
+                time.time())
+
+    def _getevents(self, min_nr, timeout=None):
+        if timeout is not None:
+            timeout = byref(Timespec(int(timeout),
+                int((timeout % 1) * 1000000000)))
+        count = self._check(self._syscall(self._sys_getevents, self._ctx,
+            c_long(min_nr), c_long(self._depth), self._events, timeout))
+        completions, now = ([], time.time())
+        for event in self._events[:count]:
+            id = int(event.data)
+            iocb, op, offset, buf, address, c_buf, length, submitted = \
+                    self._inflight.pop(id)
+            result, error = (event.res, None)
+            if result < 0:
+                result, error = (None, OSError(-event.res,
+                    os.strerror(-event.res)))
+            elif op == READ and isinstance(buf, (int, long)):
+                result = string_at(c_buf, result)
+            elif op == READ and c_buf:
+                if address is None:
+                    buf[0:result] = string_at(c_buf, result)
+                else:
+                    memmove(address, c_buf, result)
+            if c_buf:
+                self._raw._pool.release(c_buf, length)
+            if self._raw.trace:
+                self._raw.trace.record(op, offset, length, submitted,
+                        now - submitted)
+            if op == WRITE:
+                self._raw.invalidate(offset, length)
+            completions.append(Completion(id, op, offset,
+                result, error, now - submitted))
+        return completions
+
+    def reap(self, min_nr=1, timeout=None):
+        # Wait for at least 'min_nr' completions, then collect any others
+        # that are ready without blocking
+        completions, self._ready = (self._ready, [])
+        min_nr = min(min_nr, self._outstanding)
+        while len(completions) < min_nr:
+            events = self._getevents(min_nr - len(completions), timeout)
+            if not events and timeout is not None:
+                break
+            completions.extend(events)
+        if self._inflight:
+            completions.extend(self._getevents(0))
+        return self._advance(completions)
+
+    def close(self):
+        if self._inflight:
+            self._ready.extend(self._getevents(len(self._inflight)))
+        if self._ctx.value:
+            self._syscall(self._sys_destroy, self._ctx)
+            self._ctx = c_ulong(0)
+
+
+class FlushPolicy(object):
+    # When to flush writes to the media with RWF_DSYNC or fdatasync(2);
+    # a flush on every write wrecks throughput, so it can be held until
+    #  'end'     the whole job has been written
+    #  'area'    each unit of work the caller defines has been written
+    #  'bytes'   'amount' bytes have been written since the last flush
+    #  'seconds' 'amount' seconds have passed since the last flush
+    #  'dsync'   never, each write is durable on its own with RWF_DSYNC
+    MODES = ('end', 'area', 'bytes', 'seconds', 'dsync')
+
+    def __init__(self, mode='end', amount=0):
+        if mode not in self.MODES:
+            raise ValueError("unknown flush policy: '%s'" % mode)
+        if mode in ('bytes', 'seconds') and amount <= 0:
+            raise ValueError("flush policy '%s' needs an amount" % mode)
+        self.mode = mode
+        self.amount = amount
+        self.pending = 0
+        self.last = time.time()
+
+    def written(self, length):
+        # Count 'length' bytes written, returns True when a flush is due
+        self.pending = self.pending + length
+        if self.mode == 'bytes':
+            return self.pending >= self.amount
+        if self.mode == 'seconds':
+            return time.time() - self.last >= self.amount
+        return False
+
+    def area(self):
+        # The caller finished an area, returns True when a flush is due
+        return self.mode == 'area' and self.pending > 0
+
+    def flushed(self):
+        self.pending = 0
+        self.last = time.time()
+
+    def __repr__(self):
+        if self.mode in ('bytes', 'seconds'):
+            return '%s:%s' % (self.mode, self.amount)
+        return self.mode
+
+
+def engine(raw, depth=32):
+    # Prefer the kernel's native AIO, fall back to a pool of threads
+    # when it isn't available on this kernel or architecture
+    try:
+        return AsyncIO(raw, depth=depth)
+    except OSError:
+        return ThreadedIO(raw, workers=depth)
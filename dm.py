@@ -0,0 +1,541 @@
+#! /usr/bin/env python
+
+from struct import pack, pack_into, unpack_from, calcsize
+from subprocess import Popen, PIPE
+from array import array
+from bisect import bisect_right
+import logging
+import errno
+import fcntl
+import stat
+import time
+import os
+import re
+
+log = logging.getLogger('scrub-snapshot')
+
+SYSFS = '/sys'
+CONTROL = '/dev/mapper/control'
+
+# struct dm_ioctl and struct dm_target_spec from <linux/dm-ioctl.h>
+DM_IOCTL_FORMAT = '=3IIIIiIIIQ128s129s7s'
+DM_IOCTL_SIZE = calcsize(DM_IOCTL_FORMAT)
+DM_TARGET_FORMAT = '=QQiI16s'
+DM_TARGET_SIZE = calcsize(DM_TARGET_FORMAT)
+
+# Fields of an unpacked struct dm_ioctl
+DATA_START, TARGET_COUNT, FLAGS, DEV, UUID = (4, 5, 7, 10, 12)
+
+# Any kernel with the version 4 interface accepts a minor of 0
+DM_VERSION = (4, 0, 0)
+
+DM_VERSION_CMD = 0
+DM_DEV_CREATE = 3
+DM_DEV_REMOVE = 4
+DM_DEV_SUSPEND = 6
+DM_DEV_STATUS = 7
+DM_TABLE_LOAD = 9
+DM_TABLE_CLEAR = 10
+DM_TABLE_STATUS = 12
+DM_TARGET_MSG = 14
+
+DM_SUSPEND_FLAG = 1 << 1
+DM_STATUS_TABLE_FLAG = 1 << 4
+DM_BUFFER_FULL_FLAG = 1 << 8
+
+
+def dm_ioctl(command):
+    # _IOWR(DM_IOCTL, command, struct dm_ioctl)
+    return (3 << 30) | (DM_IOCTL_SIZE << 16) | (0xfd << 8) | command
+
+
+class DMError(RuntimeError):
+
+    def __init__(self, message, errno=None):
+        RuntimeError.__init__(self, message)
+        self.errno = errno
+
+
+def format_table(table):
+    # [(0, 204800, 'linear', '8:16 4194688')] => "0 204800 linear 8:16 4194688"
+    return '\n'.join('%d %d %s %s' % target for target in table)
+
+
+def parse_table(text):
+    table = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        start, length, target, params = (line.split(None, 3) + [''])[:4]
+        table.append((int(start), int(length), target, params))
+    return table
+
+
+def error_table(table):
+    # A table of the same size that fails every I/O
+    return [(0, sum(target[1] for target in table), 'error', '')]
+
+
+def marshal_targets(table):
+    # Each dm_target_spec is followed by its params, the kernel expects
+    # 'next' to be the offset from this spec to the next, 8 byte aligned
+    data = []
+    for start, length, target, params in table:
+        size = (DM_TARGET_SIZE + len(params) + 1 + 7) & ~7
+        data.append(pack(DM_TARGET_FORMAT, start, length, 0, size, target))
+        data.append(params.ljust(size - DM_TARGET_SIZE, '\0'))
+    return ''.join(data)
+
+
+def unmarshal_targets(buf, data_start, count):
+    # The kernel returns 'next' as an offset from the start of the data
+    table, offset = ([], data_start)
+    for index in xrange(count):
+        start, length, status, next, target = \
+                unpack_from(DM_TARGET_FORMAT, buf, offset)
+        params = buf[offset + DM_TARGET_SIZE:].tostring().split('\0', 1)[0]
+        table.append((start, length, target.rstrip('\0'), params))
+        offset = data_start + next
+    return table
+
+
+class PhysicalMap(object):
+    # Where each sector of a device-mapper device lands on the devices
+    # below it, as (start, length, device, physical start) segments in
+    # sectors sorted by start. 'device' is None for targets we can't
+    # see through, such as striped or error, whose sectors are kept in
+    # place
+
+    def __init__(self, segments):
+        self.segments = sorted(segments)
+        self.starts = [segment[0] for segment in self.segments]
+
+    def __len__(self):
+        return len(self.segments)
+
+    def devices(self):
+        return sorted(set(segment[2] for segment in self.segments
+            if segment[2]))
+
+    def split(self, offset, length):
+        # Split the byte range into (offset, length, device, physical
+        # offset) pieces, one for each segment it covers
+        pieces, end = ([], offset + length)
+        index = max(0, bisect_right(self.starts, offset >> 9) - 1)
+        while offset < end:
+            if index >= len(self.segments):
+                pieces.append((offset, end - offset, None, offset))
+                break
+            start, sectors, device, physical = self.segments[index]
+            stop = min(end, (start + sectors) << 9)
+            if stop <= offset:
+                index = index + 1
+                continue
+            pieces.append((offset, stop - offset, device,
+                (physical << 9) + offset - (start << 9)))
+            offset, index = (stop, index + 1)
+        return pieces
+
+
+def physical_map(backend, name, depth=8):
+    # Follow the linear targets of 'name' down through any device-mapper
+    # devices stacked below it, e.g. a cow-zero over the cow over a PV:
+    #  "0 204800 linear 253:3 0" and "0 204800 linear 8:16 4194688"
+    segments = []
+    for start, length, target, params in backend.table(name):
+        if target != 'linear':
+            segments.append((start, length, None, start))
+            continue
+        device, offset = params.split()[:2]
+        offset, lower = (int(offset), backend.name(device))
+        if lower is None or depth == 0:
+            segments.append((start, length, device, offset))
+            continue
+        # Clip each segment of the lower device to the range we map
+        for low_start, low_length, low_device, low_physical in \
+                physical_map(backend, lower, depth - 1).segments:
+            first = max(offset, low_start)
+            last = min(offset + length, low_start + low_length)
+            if first < last:
+                segments.append((start + first - offset, last - first,
+                    low_device, low_physical + first - low_start))
+    return PhysicalMap(segments)
+
+
+class Backend(object):
+    # What every device-mapper backend shares; devices are named by
+    # looking them up in sysfs rather than guessing from their paths
+
+    def path(self, name):
+        return os.path.join('/dev/mapper', name)
+
+    def name(self, device):
+        # 'device' is the path of a device node or a 'major:minor'
+        if not re.match(r'^\d+:\d+$', device):
+            try:
+                info = os.stat(device)
+            except OSError:
+                return None
+            if not stat.S_ISBLK(info.st_mode):
+                return None
+            device = '%d:%d' % (os.major(info.st_rdev),
+                    os.minor(info.st_rdev))
+        try:
+            with open(os.path.join(SYSFS, 'dev/block', device, 'dm/name')) \
+                    as file:
+                return file.read().strip()
+        except IOError:
+            return None
+
+    def snapshot_cow(self, snapshot):
+        # The cow is the second device of the snapshot target,
+        # e.g. "0 16384 snapshot 253:1 253:2 P 8" => 253:2
+        name = self.name(snapshot)
+        if name is None:
+            raise DMError("'%s' is not a device-mapper device" % snapshot)
+        for start, length, target, params in self.table(name):
+            if target == 'snapshot':
+                cow = self.name(params.split()[1])
+                if cow:
+                    return cow
+        raise DMError("'%s' is not a snapshot" % snapshot)
+
+    def volume_origin(self, path):
+        # The origin LVM records for the volume at 'path', '' for a volume
+        # that isn't a snapshot; device-mapper tables don't tell a thin
+        # snapshot from any other thin volume
+        cmd = ['lvs', '--noheadings', '-o', 'origin', path]
+        log.debug(' '.join(cmd))
+        process = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        out, err = process.communicate()
+        if process.returncode:
+            raise DMError("Command '%s' failed: %s"
+                    % (' '.join(cmd), err.strip()))
+        return out.strip()
+
+    def remove_volume(self, path):
+        log.info("lvremove %s -ff" % path)
+        process = Popen(['lvremove', path, '-ff'])
+        if process.wait():
+            raise DMError("lvremove of '%s' returned non-zero exit status"
+                    % path)
+
+
+class DeviceMapper(Backend):
+    # Talk to the kernel through /dev/mapper/control, this avoids a fork
+    # and exec for every change which matters while the origin is suspended
+
+    def __init__(self, control=CONTROL):
+        self.fd = os.open(control, os.O_RDWR)
+        try:
+            self._ioctl(DM_VERSION_CMD)
+        except DMError:
+            os.close(self.fd)
+            raise
+
+    def _ioctl(self, command, name='', flags=0, table=None, size=16384,
+            data=''):
+        if table:
+            data = marshal_targets(table)
+        size = max(size, DM_IOCTL_SIZE + len(data))
+        while True:
+            buf = array('B', '\0' * size)
+            pack_into(DM_IOCTL_FORMAT, buf, 0, DM_VERSION[0], DM_VERSION[1],
+                    DM_VERSION[2], size, DM_IOCTL_SIZE,
+                    len(table or ()), 0, flags, 0, 0, 0, name, '', '')
+            buf[DM_IOCTL_SIZE:DM_IOCTL_SIZE + len(data)] = array('B', data)
+            try:
+                fcntl.ioctl(self.fd, dm_ioctl(command), buf, True)
+            except IOError, e:
+                raise DMError("device-mapper ioctl %d on '%s' failed: %s"
+                        % (command, name, e.strerror), e.errno)
+            header = unpack_from(DM_IOCTL_FORMAT, buf)
+            # The kernel ran out of room for the results, try again bigger
+            if header[FLAGS] & DM_BUFFER_FULL_FLAG:
+                size = size * 4
+                continue
+            return header, buf
+
+    def _node(self, name, dev):
+        # Without udev nobody else creates the node, do what dmsetup does
+        major, minor = ((dev >> 8) & 0xfff, (dev & 0xff) | ((dev >> 12)
+                & 0xfff00))
+        try:
+            os.mknod(self.path(name), 0600 | stat.S_IFBLK,
+                    os.makedev(major, minor))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise DMError("mknod of '%s' failed: %s"
+                        % (self.path(name), e.strerror), e.errno)
+
+    def exists(self, name):
+        try:
+            self._ioctl(DM_DEV_STATUS, name)
+        except DMError, e:
+            if e.errno == errno.ENXIO:
+                return False
+            raise
+        return True
+
+    def table(self, name):
+        header, buf = self._ioctl(DM_TABLE_STATUS, name, DM_STATUS_TABLE_FLAG)
+        return unmarshal_targets(buf, header[DATA_START], header[TARGET_COUNT])
+
+    def uuid(self, name):
+        header, buf = self._ioctl(DM_DEV_STATUS, name)
+        return header[UUID].rstrip('\0')
+
+    def status(self, name):
+        header, buf = self._ioctl(DM_TABLE_STATUS, name)
+        return unmarshal_targets(buf, header[DATA_START], header[TARGET_COUNT])
+
+    def create(self, name, table):
+        log.debug("creating '%s'" % name)
+        header, buf = self._ioctl(DM_DEV_CREATE, name)
+        try:
+            self._ioctl(DM_TABLE_LOAD, name, table=table)
+            self._ioctl(DM_DEV_SUSPEND, name)
+        except DMError:
+            self._ioctl(DM_DEV_REMOVE, name)
+            raise
+        self._node(name, header[DEV])
+
+    def load(self, name, table):
+        # Loads the inactive table, which goes live on the next resume
+        log.debug("loading table of '%s'" % name)
+        self._ioctl(DM_TABLE_LOAD, name, table=table)
+
+    def clear(self, name):
+        self._ioctl(DM_TABLE_CLEAR, name)
+
+    def suspend(self, name):
+        self._ioctl(DM_DEV_SUSPEND, name, DM_SUSPEND_FLAG)
+
+    def resume(self, name):
+        self._ioctl(DM_DEV_SUSPEND, name)
+
+    def message(self, name, sector, message):
+        # struct dm_target_msg is the sector followed by the message
+        log.debug("message '%s' to '%s'" % (message, name))
+        self._ioctl(DM_TARGET_MSG, name, data=pack('=Q', sector)
+                + message + '\0')
+
+    def remove(self, name, force=False):
+        log.debug("removing '%s'" % name)
+        try:
+            self._ioctl(DM_DEV_REMOVE, name)
+        except DMError, e:
+            if not force or e.errno != errno.EBUSY:
+                raise
+            # Like 'dmsetup remove -f' fail the I/O of whoever holds it open
+            self.load(name, error_table(self.table(name)))
+            self.resume(name)
+            self._ioctl(DM_DEV_REMOVE, name)
+        # Remove the node if we made it and udev hasn't beaten us to it
+        try:
+            os.unlink(self.path(name))
+        except OSError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DMSetup(Backend):
+    # Shell out to dmsetup, for when /dev/mapper/control can't be used
+
+    def _dmsetup(self, args, table=None):
+        cmd = ['dmsetup'] + args
+        log.debug(' '.join(cmd))
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        out, err = process.communicate(
+                format_table(table) + '\n' if table else None)
+        if process.returncode:
+            raise DMError("Command '%s' failed: %s"
+                    % (' '.join(cmd), err.strip()))
+        return out
+
+    def exists(self, name):
+        try:
+            self._dmsetup(['info', name])
+        except DMError:
+            return False
+        return True
+
+    def table(self, name):
+        return parse_table(self._dmsetup(['table', name]))
+
+    def uuid(self, name):
+        return self._dmsetup(['info', '-c', '--noheadings', '-o', 'uuid',
+            name]).strip()
+
+    def status(self, name):
+        return parse_table(self._dmsetup(['status', name]))
+
+    def create(self, name, table):
+        self._dmsetup(['create', name], table)
+
+    def load(self, name, table):
+        self._dmsetup(['load', name], table)
+
+    def clear(self, name):
+        self._dmsetup(['clear', name])
+
+    def suspend(self, name):
+        self._dmsetup(['suspend', name])
+
+    def resume(self, name):
+        self._dmsetup(['resume', name])
+
+    def message(self, name, sector, message):
+        self._dmsetup(['message', name, str(sector), message])
+
+    def remove(self, name, force=False):
+        self._dmsetup(['remove'] + (['-f'] if force else []) + [name])
+
+    def close(self):
+        pass
+
+
+class FakeDeviceMapper(Backend):
+    # A device-mapper kept in memory so the scrub workflow can be tested
+    # and timed without root. The node of each device is a symlink in
+    # 'root' to the file named by its linear target, or an empty file.
+    # Every call is recorded in 'calls' as (time, operation, name) and
+    # takes 'latency' seconds.
+
+    def __init__(self, root, latency=0):
+        self.root = root
+        self.latency = latency
+        self.devices = {}
+        self.calls = []
+
+    def _call(self, operation, name, exists=True):
+        if self.latency:
+            time.sleep(self.latency)
+        self.calls.append((time.time(), operation, name))
+        if exists and name not in self.devices:
+            raise DMError("No such device '%s'" % name, errno.ENXIO)
+        return self.devices.get(name)
+
+    def _link(self, name):
+        path = self.path(name)
+        if os.path.lexists(path):
+            os.unlink(path)
+        start, length, target, params = self.devices[name]['table'][0]
+        if target == 'linear' and os.path.exists(params.split()[0]):
+            os.symlink(params.split()[0], path)
+        else:
+            open(path, 'w').close()
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def name(self, device):
+        for name, entry in self.devices.items():
+            if device in (entry['dev'], self.path(name)):
+                return name
+        return None
+
+    def add_snapshot(self, name, cow_image):
+        # Create a snapshot whose cow is the file 'cow_image'
+        sectors = os.path.getsize(cow_image) / 512
+        self.create(name + '-cow', [(0, sectors, 'linear', cow_image + ' 0')])
+        self.devices[name + '-cow']['uuid'] = 'LVM-%s-cow' % name
+        self.create(name, [(0, sectors, 'snapshot', '253:0 %s P 8'
+            % self.devices[name + '-cow']['dev'])])
+        self.devices[name]['status'] = [(0, sectors, 'snapshot', '%d/%d 16'
+            % (os.stat(cow_image).st_blocks, sectors))]
+        return self.path(name)
+
+    def add_thin_snapshot(self, name, data_image, dev_id, block_sectors=128,
+            origin='origin'):
+        # Create thin device 'dev_id' in a pool whose data device is the
+        # file 'data_image', the metadata device is an empty node. With
+        # 'origin' None it is an ordinary thin volume, not a snapshot
+        sectors = os.path.getsize(data_image) / 512
+        self.create(name + '-pool_tdata', [(0, sectors, 'linear',
+            data_image + ' 0')])
+        self.create(name + '-pool_tmeta', [(0, 8, 'error', '')])
+        self.create(name + '-pool', [(0, sectors, 'thin-pool', '%s %s %d 0 0'
+            % (self.devices[name + '-pool_tmeta']['dev'],
+                self.devices[name + '-pool_tdata']['dev'], block_sectors))])
+        self.create(name, [(0, sectors, 'thin', '%s %d'
+            % (self.devices[name + '-pool']['dev'], dev_id))])
+        self.devices[name]['origin'] = origin or ''
+        return self.path(name)
+
+    def exists(self, name):
+        return self._call('exists', name, exists=False) is not None
+
+    def table(self, name):
+        return list(self._call('table', name)['table'])
+
+    def uuid(self, name):
+        return self._call('uuid', name).get('uuid', '')
+
+    def status(self, name):
+        entry = self._call('status', name)
+        return list(entry.get('status', entry['table']))
+
+    def create(self, name, table):
+        if self._call('create', name, exists=False):
+            raise DMError("Device '%s' already exists" % name, errno.EBUSY)
+        self.devices[name] = {'dev': '253:%d' % (len(self.calls) + 1),
+                'table': list(table), 'inactive': None, 'suspended': False}
+        self._link(name)
+
+    def load(self, name, table):
+        self._call('load', name)['inactive'] = list(table)
+
+    def clear(self, name):
+        self._call('clear', name)['inactive'] = None
+
+    def suspend(self, name):
+        self._call('suspend', name)['suspended'] = True
+
+    def resume(self, name):
+        entry = self._call('resume', name)
+        if entry['inactive']:
+            entry['table'], entry['inactive'] = (entry['inactive'], None)
+            self._link(name)
+        entry['suspended'] = False
+
+    def message(self, name, sector, message):
+        self._call('message %s' % message, name)
+
+    def volume_origin(self, path):
+        name = self.name(path)
+        if name is None:
+            raise DMError("No such volume '%s'" % path)
+        return self._call('origin', name).get('origin', '')
+
+    def remove(self, name, force=False):
+        self._call('remove', name)
+        del self.devices[name]
+        os.unlink(self.path(name))
+
+    def remove_volume(self, path):
+        name = self.name(path)
+        if name is None:
+            raise DMError("No such volume '%s'" % path)
+        table = self.devices[name]['table']
+        cow = self.snapshot_cow(path) if table[0][2] == 'snapshot' else None
+        self.remove(name)
+        if cow:
+            self.remove(cow)
+
+    def close(self):
+        pass
+
+
+def backend(kind='auto'):
+    # The ioctl backend when we can open the control device, else dmsetup
+    if kind in ('auto', 'ioctl'):
+        try:
+            return DeviceMapper()
+        except (OSError, DMError), e:
+            if kind == 'ioctl':
+                raise DMError("Unable to use '%s': %s" % (CONTROL, e))
+            log.debug("Using dmsetup, unable to use '%s': %s" % (CONTROL, e))
+    return DMSetup()
@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+
+from ctypes import util, CDLL, c_void_p, c_char_p, c_int, byref, memmove
+import threading
+import os
+
+# AES-256 in counter mode from libcrypto turns a buffer into random data
+# at several GB/s a core, os.urandom() is used when libcrypto is missing
+libcrypto = None
+if util.find_library('crypto'):
+    libcrypto = CDLL(util.find_library('crypto'))
+    try:
+        libcrypto.EVP_aes_256_ctr.restype = c_void_p
+        libcrypto.EVP_CIPHER_CTX_new.restype = c_void_p
+        libcrypto.EVP_CIPHER_CTX_free.argtypes = [c_void_p]
+        libcrypto.EVP_EncryptInit_ex.argtypes = [c_void_p, c_void_p,
+                c_void_p, c_char_p, c_char_p]
+        libcrypto.EVP_EncryptUpdate.argtypes = [c_void_p, c_void_p,
+                c_void_p, c_void_p, c_int]
+    except AttributeError:
+        libcrypto = None
+
+# EVP_EncryptUpdate() takes an int length
+MAX_UPDATE = 1 << 30
+
+
+def aes_ctr(address, length):
+    # Encrypt 'length' bytes at 'address' in place with a random key,
+    # whatever was in the buffer comes out as keystream
+    ctx = libcrypto.EVP_CIPHER_CTX_new()
+    if not ctx:
+        raise MemoryError("EVP_CIPHER_CTX_new() failed")
+    try:
+        if libcrypto.EVP_EncryptInit_ex(ctx, libcrypto.EVP_aes_256_ctr(),
+                None, os.urandom(32), os.urandom(16)) != 1:
+            raise OSError(0, "EVP_EncryptInit_ex() failed")
+        written = c_int()
+        for offset in xrange(0, length, MAX_UPDATE):
+            size = min(MAX_UPDATE, length - offset)
+            if libcrypto.EVP_EncryptUpdate(ctx, address + offset,
+                    byref(written), address + offset, size) != 1:
+                raise OSError(0, "EVP_EncryptUpdate() failed")
+    finally:
+        libcrypto.EVP_CIPHER_CTX_free(ctx)
+
+
+def urandom(address, length):
+    for offset in xrange(0, length, 1048576):
+        data = os.urandom(min(1048576, length - offset))
+        memmove(address + offset, data, len(data))
+
+
+def fill(address, length, threads=1):
+    # Fill the buffer at 'address' with random bytes, split across
+    # 'threads'; ctypes drops the GIL so each slice gets its own core
+    generate = aes_ctr if libcrypto else urandom
+    size = (((length + threads - 1) / threads) + 15) & ~15
+    slices = [(address + offset, min(size, length - offset))
+            for offset in xrange(0, length, size)]
+    if len(slices) == 1:
+        return generate(*slices[0])
+
+    errors = []
+
+    def worker(address, length):
+        try:
+            generate(address, length)
+        except Exception, e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=piece) for piece in slices]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if errors:
+        raise errors[0]
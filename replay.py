@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+
+import sys
+import time
+import directio
+from optparse import OptionParser
+
+# Operations that change the target, skipped with --reads-only
+MODIFYING = (directio.WRITE, 'zeroout', 'discard', 'punch', 'zero-range',
+        'fallocate')
+
+
+def percentile(latencies, percent):
+    # 'latencies' must already be sorted
+    if not latencies:
+        return 0.0
+    index = int(round((len(latencies) - 1) * percent / 100.0))
+    return latencies[index]
+
+
+def wait_until(record, first, started, timing):
+    # Sleep until the record was issued relative to the first one
+    if timing != 'original':
+        return
+    delay = (record.time - first) - (time.time() - started)
+    if delay > 0:
+        time.sleep(delay)
+
+
+def issue(fd, record, buf):
+    # Run one record synchronously, returns its latency
+    start = time.time()
+    if record.op == directio.READ:
+        fd.pread(record.length, record.offset)
+    elif record.op == directio.WRITE:
+        fd.pwrite(directio.view(buf, record.length), record.offset)
+    elif record.op == 'zeroout':
+        fd.zeroout(record.offset, record.length)
+    elif record.op == 'discard':
+        fd.discard(record.offset, record.length)
+    elif record.op == 'punch':
+        fd.fallocate(directio.FALLOC_FL_PUNCH_HOLE
+                | directio.FALLOC_FL_KEEP_SIZE, record.offset, record.length)
+    elif record.op == 'zero-range':
+        fd.fallocate(directio.FALLOC_FL_ZERO_RANGE
+                | directio.FALLOC_FL_KEEP_SIZE, record.offset, record.length)
+    elif record.op == 'fallocate':
+        fd.fallocate(0, record.offset, record.length)
+    elif record.op == 'flush':
+        fd.datasync()
+    return time.time() - start
+
+
+def replay(records, fd, timing='fast', depth=1, reads_only=False):
+    # Rerun the trace 'records' against 'fd' and return the recorded
+    # and replayed latencies of each op. Reads and writes go through an
+    # engine keeping 'depth' in flight, anything else waits for them.
+    buf = directio.allocate(max([record.length for record in records]
+        + [4096]))
+    engine = directio.engine(fd, depth=depth) if depth > 1 else None
+    recorded, replayed = ({}, {})
+
+    def completed(completions):
+        for completion in completions:
+            if completion.error:
+                raise completion.error
+            replayed.setdefault(completion.op, []).append(completion.latency)
+
+    started = time.time()
+    try:
+        for record in records:
+            if reads_only and record.op in MODIFYING:
+                continue
+            wait_until(record, records[0].time, started, timing)
+            recorded.setdefault(record.op, []).append(record.latency)
+            if engine and record.op == directio.READ:
+                engine.submit([(record.op, record.offset, record.length)])
+            elif engine and record.op == directio.WRITE:
+                engine.submit([(record.op, record.offset,
+                    directio.view(buf, record.length))])
+            else:
+                if engine:
+                    completed(engine.drain())
+                replayed.setdefault(record.op, []).append(
+                        issue(fd, record, buf))
+            if engine:
+                completed(engine.reap(0))
+        if engine:
+            completed(engine.drain())
+    finally:
+        if engine:
+            engine.close()
+    return (time.time() - started, recorded, replayed)
+
+
+def report(records, elapsed, recorded, replayed):
+    span = records[-1].time + records[-1].latency - records[0].time \
+            if records else 0
+    print "Replayed %d I/Os in %.3fs, recorded over %.3fs" \
+            % (sum(len(latencies) for latencies in replayed.values()),
+                    elapsed, span)
+    for op in directio.TRACE_OPS:
+        if op not in replayed:
+            continue
+        was, now = (sorted(recorded[op]), sorted(replayed[op]))
+        size = sum(record.length for record in records if record.op == op)
+        print "%-9s %8d ios %10.1f MB  p50 %.6fs -> %.6fs  " \
+                "p99 %.6fs -> %.6fs" % (op, len(now), size / 1048576.0,
+                    percentile(was, 50), percentile(now, 50),
+                    percentile(was, 99), percentile(now, 99))
+
+
+if __name__ == "__main__":
+    description = "Replay a directio trace, such as one recorded with " \
+            "scrub-snapshot.py --trace, against a file or device"
+    parser = OptionParser(usage="Usage: %prog <trace> <file or device> [-h]",
+            description=description)
+    parser.add_option('-t', '--timing', default='fast',
+            choices=['fast', 'original'],
+            help="Issue each I/O as soon as possible or at the time it was "
+                "recorded (default: %default)")
+    parser.add_option('-q', '--queue-depth', type='int', default=1,
+            help="Reads and writes to keep in flight (default: %default)")
+    parser.add_option('-r', '--reads-only', const=True, action='store_const',
+            help="Skip writes and anything else that changes the target")
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        records = list(directio.read_trace(args[0]))
+    except (IOError, ValueError), e:
+        print "-- %s" % e
+        sys.exit(1)
+
+    fd = directio.open(args[1], 'r' if options.reads_only else '+',
+            buffered=0)
+    try:
+        elapsed, recorded, replayed = replay(records, fd, options.timing,
+                options.queue_depth, options.reads_only)
+    finally:
+        fd.close()
+    report(records, elapsed, recorded, replayed)
@@ -0,0 +1,2362 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import stat
+import re
+import json
+import glob
+import time
+import hashlib
+import errno
+import fcntl
+import Queue
+import signal
+import socket
+import SocketServer
+import threading
+import directio
+import thin
+import keystream
+import dm
+import logging
+from array import array
+from fractions import gcd
+from itertools import islice, count
+from bisect import bisect_left
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
+from multiprocessing import cpu_count
+from struct import pack, unpack_from
+from optparse import OptionParser
+
+logging.basicConfig(format='-- %(message)s')
+log = logging.getLogger('scrub-snapshot')
+
+# Array type used to hold uint64 chunk numbers, 8 bytes on 64-bit linux
+CHUNK_TYPE = 'L'
+
+# Bytes of keystream beyond the largest write in the buffer of a random
+# pass, see PatternWriter
+RANDOM_BUFFER = 16777216
+
+# Magic of the binary changed chunk export, see export_changed()
+EXTENT_MAGIC = 'CBT1'
+
+# The device-mapper backend in use, see device_mapper()
+dm_backend = None
+
+# Engines and buffers reused between scrubs, set when running as a daemon
+resources = None
+
+# Metadata reads of every cow scrubbed in this process, see metadata_cache()
+block_cache = None
+
+# What a scrub reports as it goes, see Metrics.event(); 'type' is one of
+#  area     a metadata store was read; 'store' and its 'exceptions'
+#  extent   a run was written; the 'pass', 'offset' and 'length'
+#  progress 'done' of 'total' exceptions or blocks and the 'bytes' zeroed
+#  error    the scrub failed with 'message'
+#  done     the scrub finished, the 'report' of its metrics
+Event = namedtuple('Event', 'type snapshot time data')
+
+
+class ScrubError(RuntimeError):
+    pass
+
+
+# The table is scanned in another thread while the scrub writes and
+# reads, so no I/O may go through the shared file offset; seek() then
+# read() from two threads reads or writes the wrong place
+
+
+def write(fd, offset, buf):
+    try:
+        return fd.pwrite(buf, offset)
+    except (OSError, IOError), e:
+        raise ScrubError("Failed to scrub chunk at offset '%d'" % offset)
+
+
+def read(fd, offset, length):
+    try:
+        return fd.pread(length, offset)
+    except (OSError, IOError), e:
+        raise ScrubError("Read Failed with: %s" % e)
+
+
+def cached_read(fd, offset, length):
+    # Like read() but served from the block cache of the cow, if any
+    if not fd.cache:
+        return read(fd, offset, length)
+    try:
+        return fd.cached_pread(length, offset)
+    except (OSError, IOError), e:
+        raise ScrubError("Read Failed with: %s" % e)
+
+
+def check_completions(completions, metrics=None, name='zero',
+        throttle=None):
+    # Report the first failed write in submission order, the latency of
+    # each is fed to the throttle
+    for completion in sorted(completions):
+        if metrics:
+            metrics.observe(name, completion.latency)
+        if throttle:
+            throttle.observe(completion.latency)
+        if completion.error:
+            raise ScrubError("Failed to scrub chunk at offset '%d'"
+                    % completion.offset)
+
+
+def area_offset(chunk_size, index):
+    # exception = { uint64 old_chunk, uint64 new_chunkc }
+    # if the size of each exception metadata is 16 bytes,
+    # exceptions_per_chunk is how many exceptions can fit in one chunk
+    exceptions_per_chunk = chunk_size / 16
+    # Offset where the exception metadata store begins
+    # 1 + for the header chunk, then + 1 to take into
+    # account the exception metadata chunk
+    return chunk_size * (1 + ((exceptions_per_chunk + 1) * index))
+
+
+def decode_area(store):
+    # Decode every exception in the metadata store at once, returns
+    # the old and new chunk arrays up to the first unused exception
+    # and True if this was the last store in the cow
+    records = array(CHUNK_TYPE)
+    records.fromstring(store[:len(store) - (len(store) % 16)])
+    if sys.byteorder != 'little':
+        records.byteswap()
+    old_chunks, new_chunks = (records[0::2], records[1::2])
+    try:
+        # new_chunk of zero means we reached the last exception
+        end = new_chunks.index(0)
+    except ValueError:
+        return (old_chunks, new_chunks, False)
+    return (old_chunks[:end], new_chunks[:end], True)
+
+
+def scan_areas(fd, chunk_size, batch=1, first=0):
+    # Read the metadata stores and yield the decoded (index, old_chunks,
+    # new_chunks) for each until the last store. With 'batch' greater
+    # than 1 the reads of the next 'batch' stores are always in flight
+    # while the current store is decoded, so the device never waits on us
+    if batch < 2:
+        index = first
+        while True:
+            store = cached_read(fd, area_offset(chunk_size, index),
+                    chunk_size)
+            old_chunks, new_chunks, last = decode_area(store)
+            yield (index, old_chunks, new_chunks)
+            # A short read means we ran off the end of the cow
+            if last or len(store) < chunk_size:
+                return
+            index = index + 1
+
+    engine = open_engine(fd, batch)
+    cache, key = (fd.cache, fd.cache_key)
+    # The store index and cache generation of each read in flight, and
+    # those that completed ahead of the store we are waiting on
+    indexes, ready = ({}, {})
+    index, ahead = (first, first)
+    try:
+        while True:
+            while ahead < index + batch:
+                offset = area_offset(chunk_size, ahead)
+                store = cache.get(key, offset, chunk_size) if cache else None
+                if store is not None:
+                    ready[ahead] = (directio.Completion(None,
+                        directio.READ, offset, store, None, 0.0), None)
+                else:
+                    id, = engine.submit([(directio.READ, offset,
+                        chunk_size)])
+                    indexes[id] = (ahead,
+                            cache.generation(key) if cache else None)
+                ahead = ahead + 1
+            while index not in ready:
+                for completion in engine.reap():
+                    position, generation = indexes.pop(completion.id)
+                    ready[position] = (completion, generation)
+            completion, generation = ready.pop(index)
+            if completion.error:
+                raise ScrubError("Read Failed with: %s" % completion.error)
+            store = completion.result
+            # Only cache the stores, not what was read ahead past the last
+            if cache and completion.id is not None:
+                cache.put(key, completion.offset, chunk_size, store,
+                        generation)
+            old_chunks, new_chunks, last = decode_area(store)
+            yield (index, old_chunks, new_chunks)
+            # A short read means we ran off the end of the cow
+            if last or len(store) < chunk_size:
+                return
+            index = index + 1
+    finally:
+        close_engine(engine)
+
+
+class ExceptionTable(object):
+    # The (old_chunk, new_chunk) pairs of every exception in the cow, held
+    # in arrays rather than python ints. 'areas' holds the position of the
+    # first exception from each metadata store
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.old_chunks = array(CHUNK_TYPE)
+        self.new_chunks = array(CHUNK_TYPE)
+        self.areas = array(CHUNK_TYPE)
+
+    def __len__(self):
+        return len(self.new_chunks)
+
+    def append(self, old_chunks, new_chunks):
+        self.areas.append(len(self.new_chunks))
+        self.old_chunks.extend(old_chunks)
+        self.new_chunks.extend(new_chunks)
+
+    def area(self, index):
+        # Return the old and new chunks of the metadata store 'index'
+        start, end = (self.areas[index], len(self))
+        if index + 1 < len(self.areas):
+            end = self.areas[index + 1]
+        return (self.old_chunks[start:end], self.new_chunks[start:end])
+
+
+def read_exception_table(fd, chunk_size, batch=1):
+    table = ExceptionTable(chunk_size)
+    for index, old_chunks, new_chunks in scan_areas(fd, chunk_size, batch):
+        table.append(old_chunks, new_chunks)
+    return table
+
+
+class TableScanner(threading.Thread):
+    # Read the exception table in the background, so the scrub of the
+    # first metadata stores overlaps the reads of the ones after them
+
+    def __init__(self, fd, chunk_size, batch=1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fd = fd
+        self.batch = batch
+        self.table = ExceptionTable(chunk_size)
+        self.done = False
+        self.error = None
+        self.elapsed = 0.0
+        self._stop = False
+        self._cond = threading.Condition()
+
+    def run(self):
+        start = time.time()
+        try:
+            for index, old_chunks, new_chunks in scan_areas(self.fd,
+                    self.table.chunk_size, self.batch):
+                with self._cond:
+                    self.table.append(old_chunks, new_chunks)
+                    self._cond.notify_all()
+                if self._stop:
+                    break
+        except Exception, e:
+            self.error = e
+        finally:
+            with self._cond:
+                self.elapsed = time.time() - start
+                self.done = True
+                self._cond.notify_all()
+
+    def wait(self, store=None):
+        # Block until metadata store 'store' has been read, or every store
+        # when None. Returns False once 'store' is past the last store
+        with self._cond:
+            while not self.done and (store is None
+                    or store >= len(self.table.areas)):
+                self._cond.wait()
+        if self.error:
+            raise self.error
+        return store is not None and store < len(self.table.areas)
+
+    def stop(self):
+        self._stop = True
+        self.join()
+
+
+def changed_extents(old_chunks):
+    # The origin chunks written since the snapshot was taken, run-length
+    # encoded into sorted (first chunk, number of chunks) extents
+    extents, start, count = ([], None, 0)
+    for chunk in sorted(old_chunks):
+        if start is not None and chunk < start + count:
+            continue
+        if start is not None and chunk == start + count:
+            count = count + 1
+            continue
+        if start is not None:
+            extents.append((start, count))
+        start, count = (chunk, 1)
+    if start is not None:
+        extents.append((start, count))
+    return extents
+
+
+def export_changed(table, path, format='json'):
+    # Write the changed origin chunks for incremental backups. The binary
+    # format is the magic, the chunk size in bytes and the number of
+    # extents ('<4sIQ') followed by a '<QQ' (first chunk, number of chunks)
+    # for every extent
+    extents = changed_extents(table.old_chunks)
+    with open(path + '.tmp', 'wb') as file:
+        if format == 'json':
+            json.dump({'chunk_size': table.chunk_size,
+                'changed_chunks': sum(count for start, count in extents),
+                'extents': extents}, file)
+        else:
+            file.write(pack('<4sIQ', EXTENT_MAGIC, table.chunk_size,
+                len(extents)))
+            records = array(CHUNK_TYPE)
+            for extent in extents:
+                records.extend(extent)
+            if sys.byteorder != 'little':
+                records.byteswap()
+            file.write(records.tostring())
+    os.rename(path + '.tmp', path)
+    return extents
+
+
+def read_changed(path):
+    # Return the chunk size and extents of either export format
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(EXTENT_MAGIC):
+        export = json.loads(data)
+        return (export['chunk_size'],
+                [tuple(extent) for extent in export['extents']])
+    magic, chunk_size, count = unpack_from('<4sIQ', data)
+    records = array(CHUNK_TYPE)
+    records.fromstring(data[16:16 + (count * 16)])
+    if sys.byteorder != 'little':
+        records.byteswap()
+    return (chunk_size, zip(records[0::2], records[1::2]))
+
+
+def coalesce(offsets, chunk_size, max_write):
+    # Sort the exception offsets and merge adjacent chunks into
+    # runs of (offset, length) no larger than 'max_write' bytes. Runs
+    # never cross a multiple of 'max_write', so when it is a whole number
+    # of RAID stripes every full length run is a full stripe write
+    start, length = (None, 0)
+    for offset in sorted(offsets):
+        if start is not None and offset == start + length \
+                and length + chunk_size <= max_write \
+                and offset % max_write != 0:
+            length = length + chunk_size
+            continue
+        if start is not None:
+            yield (start, length)
+        start, length = (offset, chunk_size)
+    if start is not None:
+        yield (start, length)
+
+
+def elevator(runs, layout):
+    # Order (offset, length) runs by where they land on the physical
+    # devices, splitting those that span segments of the dm.PhysicalMap,
+    # so each disk sweeps across once in ascending order however the
+    # segments of the device are laid out
+    pieces = []
+    for offset, length in runs:
+        pieces.extend(layout.split(offset, length))
+    pieces.sort(key=lambda piece: (piece[2], piece[3]))
+    return [(offset, length) for offset, length, device, physical in pieces]
+
+
+def read_runs(fd, engine, runs, batch, metrics=None):
+    # Read each (offset, length) run, 'batch' at a time when given an
+    # engine, and yield (offset, data) in order
+    runs = iter(runs)
+    while True:
+        requests = [(directio.READ, offset, length)
+                for offset, length in islice(runs, batch if engine else 1)]
+        if not requests:
+            return
+        if not engine:
+            offset, length = requests[0][1:]
+            start = time.time()
+            data = read(fd, offset, length)
+            if metrics:
+                metrics.observe('read', time.time() - start)
+                metrics.count('read_bytes', len(data))
+            yield (offset, data)
+            continue
+        engine.submit(requests)
+        for completion in engine.drain():
+            if completion.error:
+                raise ScrubError("Read Failed with: %s" % completion.error)
+            if metrics:
+                metrics.observe('read', completion.latency)
+                metrics.count('read_bytes', len(completion.result))
+            yield (completion.offset, completion.result)
+
+
+def find_nonzero(offset, data, chunk_size, zeros):
+    # Return the offset of every chunk in 'data' which is not all NULL's,
+    # comparing whole runs first as most of them will be clean
+    if data == zeros[:len(data)]:
+        return []
+    zeros = zeros[:chunk_size]
+    return [offset + index for index in xrange(0, len(data), chunk_size)
+            if data[index:index + chunk_size] != zeros]
+
+
+def table_runs(table, max_write):
+    # Yield the coalesced (offset, length) runs for every store in the table
+    chunk_size = table.chunk_size
+    for store in xrange(len(table.areas)):
+        old_chunks, new_chunks = table.area(store)
+        offsets = [chunk * chunk_size for chunk in new_chunks]
+        for run in coalesce(offsets, chunk_size, max_write):
+            yield run
+
+
+def verify(fd, engine, runs, chunk_size, max_write, batch, metrics=None):
+    # Read back every scrubbed (offset, length) run and report any
+    # chunks that are not zero
+    zeros, bad, chunks = ('\0' * max_write, 0, 0)
+    for offset, data in read_runs(fd, engine, runs, batch, metrics):
+        chunks = chunks + (len(data) / chunk_size)
+        for chunk in find_nonzero(offset, data, chunk_size, zeros):
+            log.error("Exception at offset '%d' is not zero" % chunk)
+            bad = bad + 1
+    if bad:
+        raise ScrubError("Verify failed; '%d' exceptions are not zero" % bad)
+    log.info("Verified '%d' exceptions are zero" % chunks)
+
+
+class Histogram(object):
+    # Latencies counted into buckets that double from 50us to ~26s
+    BOUNDS = [0.00005 * (2 ** index) for index in xrange(20)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.BOUNDS, value)] += 1
+        self.count = self.count + 1
+        self.sum = self.sum + value
+
+    def percentile(self, percent):
+        # Upper bound of the bucket holding the percentile, latencies
+        # past the last bucket are reported as the last bound
+        rank, seen = (self.count * percent / 100.0, 0)
+        for index, count in enumerate(self.buckets):
+            seen = seen + count
+            if count and seen >= rank:
+                return self.BOUNDS[min(index, len(self.BOUNDS) - 1)]
+        return 0.0
+
+    def report(self):
+        return {'count': self.count, 'sum': self.sum,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': zip(self.BOUNDS + ['+Inf'], self.buckets)}
+
+
+def label_value(value):
+    # Escape a prometheus label value, e.g. a"b\c => a\"b\\c
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+
+
+class Metrics(object):
+    # Phase timings, I/O counters and latency histograms for the scrub of
+    # one snapshot, reported as JSON or a node-exporter textfile
+
+    def __init__(self, snapshot, progress=0):
+        self.snapshot = snapshot
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+        self.info = OrderedDict()
+        self.progress_interval = progress
+        self.started = time.time()
+        self.last_progress = self.started
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - start)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, latency):
+        with self.lock:
+            self.histograms.setdefault(name, Histogram()).observe(latency)
+
+    def event(self, type, **data):
+        # Called as the scrub makes progress, see Event
+        pass
+
+    def progress(self, done, total, started):
+        # Log how far along the scrub is every 'progress_interval' seconds
+        self.event('progress', done=done, total=total,
+                bytes=self.counters.get('zeroed_bytes', 0))
+        now = time.time()
+        if not self.progress_interval or \
+                now - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = now
+        rate = done / max(now - started, 0.001)
+        eta = (total - done) / rate if rate else 0
+        log.info("%s: scrubbed %d of %d exceptions (%.1f%%), ETA %ds"
+                % (self.snapshot, done, total,
+                    (done * 100.0) / max(total, 1), eta))
+
+    def report(self):
+        elapsed = time.time() - self.started
+        with self.lock:
+            report = OrderedDict([('snapshot', self.snapshot),
+                ('elapsed', elapsed), ('info', self.info),
+                ('phases', self.phases), ('counters', self.counters),
+                ('histograms', dict((name, histogram.report())
+                    for name, histogram in self.histograms.items()))])
+        scrub_time = self.phases.get('scrub')
+        if scrub_time:
+            report['zeroed_mbps'] = (self.counters.get('zeroed_bytes', 0)
+                    / 1048576.0) / scrub_time
+        return report
+
+    def textfile(self, families):
+        # Add our samples to 'families', a dict of
+        # metric name => (type, lines) in the prometheus text format
+        def add(metric, kind, line):
+            families.setdefault(metric, (kind, []))[1].append(line)
+
+        label = 'snapshot="%s"' % label_value(self.snapshot)
+        with self.lock:
+            for name, seconds in self.phases.items():
+                add('scrub_snapshot_phase_seconds', 'gauge',
+                        '{%s,phase="%s"} %f' % (label, label_value(name),
+                            seconds))
+            for name, value in self.counters.items():
+                add('scrub_snapshot_%s_total' % name, 'counter',
+                        '{%s} %d' % (label, value))
+            metric = 'scrub_snapshot_io_latency_seconds'
+            for name, histogram in self.histograms.items():
+                seen = 0
+                for bound, count in zip(Histogram.BOUNDS + ['+Inf'],
+                        histogram.buckets):
+                    seen = seen + count
+                    add(metric, 'histogram', '_bucket{%s,op="%s",le="%s"} %d'
+                            % (label, label_value(name), bound, seen))
+                add(metric, 'histogram', '_sum{%s,op="%s"} %f'
+                        % (label, label_value(name), histogram.sum))
+                add(metric, 'histogram', '_count{%s,op="%s"} %d'
+                        % (label, label_value(name), histogram.count))
+        return families
+
+
+def write_reports(metrics, options):
+    # Write the metrics of every scrubbed snapshot, the textfile is
+    # renamed into place so node-exporter never sees a partial file
+    if options.report_json:
+        with open(options.report_json, 'w') as file:
+            json.dump([entry.report() for entry in metrics], file, indent=2)
+    if options.textfile:
+        families = OrderedDict()
+        for entry in metrics:
+            entry.textfile(families)
+        with open(options.textfile + '.tmp', 'w') as file:
+            for metric, (kind, lines) in families.items():
+                file.write('# TYPE %s %s\n' % (metric, kind))
+                for line in lines:
+                    file.write(metric + line + '\n')
+        os.rename(options.textfile + '.tmp', options.textfile)
+
+
+class Journal(object):
+    # Records how many metadata stores of a cow have been fully scrubbed
+    # so an interrupted scrub can resume where it stopped. The journal is
+    # keyed by which cow it is, see cow_identity(); 'content' is a hash of
+    # what the cow held when the journal was written and must still match
+    # before a scrub resumes from it
+
+    def __init__(self, directory, key, chunk_size, content=None):
+        self.directory = directory
+        self.path = os.path.join(directory, key + '.json')
+        self.chunk_size = chunk_size
+        self.content = content
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                record = json.load(file)
+        except IOError:
+            return 0
+        except ValueError:
+            log.warning("Ignoring corrupt journal '%s'" % self.path)
+            return 0
+        if record.get('chunk_size') != self.chunk_size:
+            return 0
+        if record.get('content') != self.content:
+            log.warning("Ignoring journal '%s' of a cow whose contents have "
+                    "changed" % self.path)
+            return 0
+        return record.get('store', 0)
+
+    def record(self, store):
+        # Write the new record beside the old one and rename it into
+        # place, so a crash leaves one or the other intact
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump({'chunk_size': self.chunk_size,
+                'content': self.content, 'store': store}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(tmp, self.path)
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def cow_identity(path):
+    # Which cow 'path' is; the same after its -zero device is recreated,
+    # never the same as another cow however alike their contents. The
+    # dm uuid of the cow LV (the -zero device has none of its own), or
+    # its name without one; the device or inode of anything else
+    backend = device_mapper()
+    name = backend.name(path)
+    if name:
+        if name.endswith('-zero') and backend.exists(name[:-len('-zero')]):
+            name = name[:-len('-zero')]
+        uuid = backend.uuid(name)
+        return 'dm-uuid:%s' % uuid if uuid else 'dm-name:%s' % name
+    info = os.stat(path)
+    if stat.S_ISBLK(info.st_mode):
+        return 'block:%d:%d' % (os.major(info.st_rdev),
+                os.minor(info.st_rdev))
+    return 'file:%d:%d' % (info.st_dev, info.st_ino)
+
+
+def open_journal(directory, path, fd, chunk_size):
+    # The journal is keyed by which cow 'path' is and its chunk size; the
+    # size and first metadata store of the cow, which don't change until
+    # it is removed, must match before the journal is resumed from
+    try:
+        identity = cow_identity(path)
+    except (OSError, dm.DMError), e:
+        log.warning("Unable to identify cow '%s' (%s); scrub progress will "
+                "not be recorded" % (path, e))
+        return None
+    key = hashlib.sha1("%s:%d" % (identity, chunk_size))
+    content = hashlib.sha1("%d:" % fd.seek(0, os.SEEK_END))
+    content.update(cached_read(fd, area_offset(chunk_size, 0),
+        chunk_size))
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    except OSError, e:
+        log.warning("Unable to create journal directory '%s' (%s); "
+                "scrub progress will not be recorded" % (directory, e))
+        return None
+    return Journal(directory, key.hexdigest(), chunk_size,
+            content.hexdigest())
+
+
+class ResourcePool(object):
+    # I/O engines and buffers of NULL's kept warm between scrubs by the
+    # daemon; an idle engine is attached to the next cow instead of
+    # starting threads or an AIO context for every scrub
+
+    def __init__(self):
+        self.engines = {}
+        self.zeros = {}
+        self.lock = threading.Lock()
+
+    def engine(self, fd, depth, threaded=False):
+        key = (threaded, depth)
+        with self.lock:
+            idle = self.engines.get(key)
+            engine = idle.pop() if idle else None
+        if engine is None:
+            engine = new_engine(fd, depth, threaded)
+            engine.resource_key = key
+        else:
+            engine.attach(fd)
+        return engine
+
+    def release(self, engine):
+        try:
+            # A failed scrub may leave requests in flight
+            engine.drain()
+        except (OSError, IOError):
+            return engine.close()
+        with self.lock:
+            self.engines.setdefault(engine.resource_key, []).append(engine)
+
+    def zero_buffer(self, size):
+        # Only ever read by the zeroers, so scrubs can share them
+        with self.lock:
+            if size not in self.zeros:
+                self.zeros[size] = directio.allocate(size)
+            return self.zeros[size]
+
+    def close(self):
+        with self.lock:
+            engines, self.engines = (self.engines, {})
+            self.zeros = {}
+        for idle in engines.values():
+            for engine in idle:
+                engine.close()
+
+
+def new_engine(fd, depth, threaded=False):
+    if threaded:
+        return directio.ThreadedIO(fd, workers=depth)
+    return directio.engine(fd, depth=depth)
+
+
+def open_engine(fd, depth, threaded=False):
+    # Native AIO keeping 'depth' requests in flight or, when 'threaded',
+    # 'depth' threads; from the daemon's pool when there is one
+    if resources:
+        return resources.engine(fd, depth, threaded)
+    return new_engine(fd, depth, threaded)
+
+
+def close_engine(engine):
+    if resources:
+        return resources.release(engine)
+    engine.close()
+
+
+def zero_buffer(size):
+    # An aligned buffer of NULL's the size of the largest write
+    if resources:
+        return resources.zero_buffer(size)
+    return directio.allocate(size)
+
+
+def write_size(chunk_size, geometry, max_write):
+    # The largest multiple of both the chunk size and the optimal I/O
+    # size that fits in 'max_write', or just the chunk size
+    step = chunk_size
+    if geometry.optimal:
+        step = chunk_size * geometry.optimal / gcd(chunk_size,
+                geometry.optimal)
+    if max_write < step:
+        step = chunk_size
+    return max(step, max_write - (max_write % step))
+
+
+def read_header(fd, options):
+    SECTOR_SHIFT = 9
+    SNAPSHOT_DISK_MAGIC = 0x70416e53
+    SNAPSHOT_DISK_VERSION = 1
+    SNAPSHOT_VALID_FLAG = 1
+
+    # Read the cow metadata, a 4Kn device can't read less than 4096 bytes
+    header = unpack_from("<IIII", cached_read(fd, 0,
+        max(512, fd.geometry.logical)))
+
+    if header[0] != SNAPSHOT_DISK_MAGIC:
+        raise ScrubError(
+            "Invalid COW device; header magic doesn't match")
+
+    if header[1] != SNAPSHOT_VALID_FLAG:
+        log.warning(
+            "Inactive COW device; valid flag not set '%d' got '%d'"\
+                % (SNAPSHOT_VALID_FLAG, header[1]))
+
+    if header[2] != SNAPSHOT_DISK_VERSION:
+        raise ScrubError(
+            "Unknown metadata version; expected '%d' got '%d' "\
+                % (SNAPSHOT_DISK_VERSION, header[2]))
+
+    log.info("Magic: %X" % header[0])
+    log.info("Valid: %d" % header[1])
+    log.info("Version: %d" % header[2])
+    log.info("Chunk Size: %d" % header[3])
+
+    header = list(header)
+    # Chunk size is byte aligned to 512 bytes
+    # (0 << SECTOR_SHIFT) == 512
+    return header[3] << SECTOR_SHIFT
+
+
+def estimate_exceptions(chunk_size, cow_bytes):
+    # The most exceptions 'cow_bytes' of a cow can hold, every chunk past
+    # the header is a metadata store or one of the chunk_size / 16
+    # exceptions a store describes
+    per_store = chunk_size / 16
+    chunks = max(cow_bytes / chunk_size - 1, 0)
+    return chunks * per_store / (per_store + 1)
+
+
+def parse_passes(passes, verify=False):
+    # 'random,0xff,zero' => ['random', '0xff', 'zero']
+    names = [name.strip().lower() for name in passes.split(',')]
+    for name in names:
+        if name not in ('zero', 'random') \
+                and not re.match(r'^0x[0-9a-f]{1,2}$', name):
+            raise ScrubError("Unknown pass '%s'; expected 'zero', 'random' "
+                    "or a byte like '0xff'" % name)
+    if verify and names[-1] != 'zero':
+        raise ScrubError("--verify needs 'zero' as the last pass")
+    return names
+
+
+def pattern_buffer(pattern, max_write):
+    # Random passes get a buffer of keystream larger than the largest
+    # write, generated once on every core and reused for the whole scrub
+    if pattern == 'random':
+        buf = directio.allocate(max_write + RANDOM_BUFFER)
+        keystream.fill(directio.address_of(buf), len(buf), cpu_count())
+        return buf
+    buf = directio.allocate(max_write)
+    buf.write(chr(int(pattern, 16)) * max_write)
+    return buf
+
+
+def parse_flush(policy):
+    # 'end', 'area', 'dsync', a number of bytes such as '256M' or a time
+    # such as '500ms' or '2s' => directio.FlushPolicy
+    match = re.match(r'^(\d+(?:\.\d+)?)(ms|s|[kmg]?)$', policy.lower())
+    try:
+        if policy in directio.FlushPolicy.MODES:
+            return directio.FlushPolicy(policy)
+        if match and match.group(2) in ('ms', 's'):
+            scale = 0.001 if match.group(2) == 'ms' else 1
+            return directio.FlushPolicy('seconds',
+                    float(match.group(1)) * scale)
+        if match:
+            scale = 1024 ** ' kmg'.index(match.group(2) or ' ')
+            return directio.FlushPolicy('bytes',
+                    int(float(match.group(1)) * scale))
+    except ValueError, e:
+        raise ScrubError("Invalid flush policy '%s': %s" % (policy, e))
+    raise ScrubError("Unknown flush policy '%s'; expected 'end', 'area', "
+            "'dsync', bytes like '256M' or a time like '500ms'" % policy)
+
+
+def flush_writes(fd, pool, metrics, flush=None):
+    # Wait for the writes in flight, then flush them from the device's
+    # write cache to the media
+    if pool:
+        check_completions(pool.drain(), metrics)
+    metrics.observe('flush', fd.datasync())
+    metrics.count('flushes')
+    if flush:
+        flush.flushed()
+
+
+def overwrite(fd, runs, passes, pool, chunk_size, throttle, metrics,
+        flush=None):
+    # Make each pass over the (offset, length) runs in turn; a pass must
+    # reach the disk before the next starts or the writes could be
+    # reordered or merged in the device's cache
+    for index, (name, writer) in enumerate(passes):
+        for offset, length in runs:
+            log.info("Scrubing %d exceptions at %d"
+                    % (length / chunk_size, offset))
+            if throttle:
+                throttle.wait(length)
+            start = time.time()
+            writer.zero(offset, length)
+            metrics.event('extent', offset=offset, length=length,
+                    **{'pass': name})
+            if flush and flush.written(length):
+                flush_writes(fd, pool, metrics, flush)
+            if name == 'zero':
+                metrics.count('zeroed_bytes', length)
+            if len(passes) > 1:
+                metrics.count('pass%d_%s_bytes' % (index + 1, name), length)
+            if pool:
+                # Collect what completed so far without waiting, the
+                # throttle adapts to the latency of the writes in flight
+                check_completions(pool.reap(0), metrics, throttle=throttle)
+            else:
+                metrics.observe('zero', time.time() - start)
+                if throttle:
+                    throttle.observe(time.time() - start)
+        if index + 1 < len(passes):
+            flush_writes(fd, pool, metrics, flush)
+
+
+def check_writers(options):
+    # Parse the passes and flush policy, raises ScrubError if either or
+    # the journal interval is invalid; done before the cow is opened so
+    # nothing needs closing
+    if options.journal_interval < 1:
+        # Also the number of stores each pass and flush covers
+        raise ScrubError("--journal-interval must be at least 1, not '%d'"
+                % options.journal_interval)
+    return (parse_passes(options.passes, options.verify),
+            parse_flush(options.flush))
+
+
+def open_writers(fd, options, max_write, metrics):
+    # Return the engine the writes go through (None when they are made
+    # one at a time), the (name, writer) of each pass, the throttle and
+    # the flush policy
+    names, flush = check_writers(options)
+    if options.display_only:
+        names = ['zero']
+    if flush.mode == 'dsync' and not options.display_only:
+        try:
+            fd.set_dsync()
+        except OSError, e:
+            raise ScrubError("Unable to flush with RWF_DSYNC: %s" % e)
+    if not options.display_only:
+        metrics.info['flush'] = repr(flush)
+
+    pool = None
+    if options.queue_depth > 1 and not options.display_only:
+        # Keep many writes in flight with native AIO where available
+        pool = open_engine(fd, options.queue_depth)
+    elif options.workers > 1 and not options.display_only:
+        # Spread the scrub writes across a pool of threads
+        pool = open_engine(fd, options.workers, threaded=True)
+
+    try:
+        method = options.zero_method
+        if method == 'auto':
+            method = detect_zero_method(fd)
+        if not options.display_only:
+            log.info("Zeroing exceptions with '%s'" % method)
+        # Create an aligned buffer of nulls the size of the largest write
+        zeroer = ZEROERS[method](fd, zero_buffer(max_write), pool)
+
+        # Each pass is the zeroer or a writer of a pattern buffer
+        passes = [(name, zeroer if name == 'zero' else PatternWriter(fd,
+            pattern_buffer(name, max_write), pool)) for name in names]
+        if len(passes) > 1 and not options.display_only:
+            log.info("Overwriting exceptions with passes '%s'"
+                    % ', '.join(name for name, writer in passes))
+            metrics.info['passes'] = [name for name, writer in passes]
+
+        throttle = None
+        if options.max_mbps or options.max_iops or options.target_latency:
+            throttle = Throttle(options.max_mbps, options.max_iops,
+                    options.target_latency, stat_paths(fd))
+    except:
+        if pool:
+            close_engine(pool)
+        raise
+    return (pool, passes, throttle, flush)
+
+
+def open_trace(options, metrics):
+    # A directio.TraceRecorder writing each I/O of the scrub to --trace
+    if not options.trace:
+        return None
+    path = options.trace.replace('%(snapshot)s',
+            os.path.basename(metrics.snapshot))
+    log.info("Tracing I/O to '%s'" % path)
+    return directio.TraceRecorder(path)
+
+
+def metadata_cache(cow, options):
+    # The block cache for the header and metadata stores of 'cow'. Only
+    # a cow nothing else writes to may be cached; an image, or the -zero
+    # device once the cow is fenced off with the error table. A live cow
+    # scanned with --display-only is always read from the device. An
+    # image could have been rewritten since it was cached without its
+    # key changing, so its reads are only reused within one scrub
+    global block_cache
+    if not options.cache_mb:
+        return None
+    if not (os.path.isfile(cow) or cow.endswith('-zero')):
+        return None
+    if block_cache is None:
+        block_cache = directio.BlockCache(options.cache_mb << 20)
+    if not cow.endswith('-zero'):
+        forget_cached(cow)
+    return block_cache
+
+
+def forget_cached(path):
+    # Drop the cached reads of a device that is about to be removed or
+    # was just created, its major:minor may be reused by another device
+    if block_cache is None:
+        return
+    try:
+        block_cache.forget_path(path)
+    except OSError:
+        pass
+
+
+def scrub(cow, options, metrics=None):
+    metrics = metrics or Metrics(cow)
+    # Refuse bad options before anything is opened
+    check_writers(options)
+    try:
+        log.info("Opening Cow '%s'" % cow)
+        # Open the cow block device
+        # All our I/O is aligned, skip the buffered layer
+        fd = directio.open(cow, buffered=0, trace=open_trace(options,
+            metrics), cache=metadata_cache(cow, options))
+    except OSError, e:
+        raise ScrubError("Failed to open cow '%s'" % e)
+
+    pool, reader, scanner = (None, None, None)
+    try:
+        # Read the meta data header
+        with metrics.phase('header'):
+            chunk_size = read_header(fd, options)
+
+        if chunk_size % fd.geometry.logical:
+            raise ScrubError("Chunk size '%d' is not a multiple of the '%d' "
+                    "byte logical blocks of '%s'" % (chunk_size,
+                        fd.geometry.logical, cow))
+
+        # The table is still being read while the first stores are
+        # scrubbed, until then progress is against the exceptions the
+        # allocated part of the cow (or the whole cow) can hold
+        estimate = estimate_exceptions(chunk_size,
+                metrics.info.get('cow_allocated_bytes')
+                or fd.seek(0, os.SEEK_END))
+
+        # Largest write we will issue, rounded down to a multiple of the chunk
+        # and of the device's optimal I/O size (the stripe width of a RAID)
+        max_write = write_size(chunk_size, fd.geometry, options.max_write)
+        log.info("Device geometry: %s, largest write %d bytes"
+                % (fd.geometry, max_write))
+        pool, passes, throttle, flush = open_writers(fd, options, max_write,
+                metrics)
+        # The writes of a group of stores are sorted by physical offset
+        layout = None
+        if not options.display_only and options.elevator:
+            layout = physical_layout(cow, metrics)
+        # Every pass over a group of stores finishes before the next pass;
+        # --flush area flushes each store, so a single pass sorts and
+        # writes one store at a time
+        group = options.journal_interval
+        if len(passes) == 1 and (not layout or flush.mode == 'area'):
+            group = 1
+
+        # Reads for --skip-zero and --verify are batched like the writes
+        batch = max(options.queue_depth, options.workers)
+        reader = None
+        if batch > 1 and (options.skip_zero or options.verify):
+            reader = open_engine(fd, batch)
+        zeros, skipped = ('\0' * max_write, 0)
+
+        journal, resume = (None, 0)
+        if options.journal and not options.display_only:
+            journal = open_journal(options.journal, cow, fd, chunk_size)
+
+        # Scrub each metadata store as soon as it has been read, the
+        # whole table is needed first to display or export it
+        scanner = TableScanner(fd, chunk_size, options.scan_batch)
+        scanner.start()
+        table = scanner.table
+        if options.display_only or options.export_changed:
+            scanner.wait()
+
+        if options.export_changed:
+            # Hand the changed origin chunks to the backups before
+            # they are lost
+            path = options.export_changed.replace('%(snapshot)s',
+                    os.path.basename(metrics.snapshot))
+            with metrics.phase('export'):
+                extents = export_changed(table, path, options.export_format)
+            log.info("Exported '%d' changed extents to '%s'"
+                    % (len(extents), path))
+
+        # Skip the metadata stores a previous scrub already finished
+        if journal:
+            resume = journal.load()
+            scanner.wait(resume)
+            resume = min(resume, len(table.areas))
+        if resume:
+            skipped = len(table)
+            if resume < len(table.areas):
+                skipped = table.areas[resume]
+            log.info("Resuming scrub at metadata store '%d', skipping '%d' "
+                    "exceptions" % (resume, skipped))
+
+        started, pending = (time.time(), [])
+        for store in count(resume):
+            if not scanner.wait(store):
+                break
+            old_chunks, new_chunks = table.area(store)
+            metrics.event('area', store=store, exceptions=len(new_chunks))
+            offsets = [chunk * chunk_size for chunk in new_chunks]
+            if options.verbose > 1:
+                # Reading every chunk to log it would be its own slowdown,
+                # --trace records the I/O
+                for chunk, offset in zip(old_chunks, offsets):
+                    log.debug("Exception of origin chunk '%d' at offset '%d'"
+                            % (chunk, offset))
+
+            if options.display_only:
+                continue
+
+            if options.skip_zero:
+                # Only scrub the exceptions that are not already zero
+                runs = coalesce(offsets, chunk_size, max_write)
+                dirty = []
+                for offset, data in read_runs(fd, reader, runs, batch,
+                        metrics):
+                    dirty.extend(find_nonzero(offset, data, chunk_size, zeros))
+                skipped = skipped + len(offsets) - len(dirty)
+                offsets = dirty
+
+            # Write over each run of adjacent exceptions
+            pending.extend(coalesce(offsets, chunk_size, max_write))
+            if (store + 1) % group == 0:
+                if layout:
+                    pending = elevator(pending, layout)
+                overwrite(fd, pending, passes, pool, chunk_size, throttle,
+                        metrics, flush)
+                pending = []
+                if flush.area():
+                    flush_writes(fd, pool, metrics, flush)
+
+            if journal and (store + 1) % options.journal_interval == 0:
+                # Only record stores whose writes have reached the disk
+                flush_writes(fd, pool, metrics, flush)
+                journal.record(store + 1)
+
+            finished = scanner.done
+            done, total = (len(table), len(table))
+            if store + 1 < len(table.areas):
+                done = table.areas[store + 1]
+            if not finished:
+                total = max(estimate, total)
+            metrics.progress(done, total, started)
+
+        if pending:
+            if layout:
+                pending = elevator(pending, layout)
+            overwrite(fd, pending, passes, pool, chunk_size, throttle,
+                    metrics, flush)
+        if pool:
+            # Wait for the workers to finish the remaining writes
+            check_completions(pool.drain(), metrics)
+        if not options.display_only:
+            # Nothing is removed until the scrub is on the media
+            flush_writes(fd, pool, metrics, flush)
+        metrics.add_phase('scan', scanner.elapsed)
+        metrics.add_phase('scrub', time.time() - started)
+        metrics.count('metadata_bytes', len(table.areas) * chunk_size)
+        metrics.count('exceptions', len(table))
+        requests = sum(writer.requests for name, writer in passes)
+        metrics.count('zero_requests', requests)
+        metrics.count('skipped_exceptions', skipped)
+        if options.display_only:
+            log.info("Counted '%d' exceptions in the cow" % len(table))
+        else:
+            log.info("Scrubbed '%d' exceptions in '%d' requests"
+                    % (len(table) - skipped, requests))
+        if skipped:
+            log.info("Skipped '%d' exceptions that were already zero "
+                    "or scrubbed before" % skipped)
+        if options.verify and not options.display_only:
+            with metrics.phase('verify'):
+                verify(fd, reader, table_runs(table, max_write), chunk_size,
+                        max_write, batch, metrics)
+        if journal:
+            journal.remove()
+    finally:
+        if scanner:
+            scanner.stop()
+        if pool:
+            close_engine(pool)
+        if reader:
+            close_engine(reader)
+        fd.close()
+
+
+def extent_runs(extents, block_size, max_write):
+    # Split (first block, number of blocks) extents into (offset, length)
+    # runs no larger than 'max_write' that never cross a multiple of it
+    for first, count in extents:
+        offset, end = (first * block_size, (first + count) * block_size)
+        while offset < end:
+            length = min(end, ((offset / max_write) + 1) * max_write) - offset
+            yield (offset, length)
+            offset = offset + length
+
+
+def scrub_thin(snapshot, extents, options, metrics=None):
+    # Scrub the data blocks of a thin snapshot, 'extents' are the
+    # (first block, number of blocks) on the pool's data device that
+    # no other thin device maps
+    metrics = metrics or Metrics(snapshot.data)
+    block_size = snapshot.block_size
+    blocks = sum(count for first, count in extents)
+    metrics.count('thin_blocks', blocks)
+    log.info("Thin device '%d' has '%d' blocks of %d bytes in '%d' extents "
+            "no other device shares" % (snapshot.dev_id, blocks, block_size,
+                len(extents)))
+    if options.display_only:
+        return
+
+    # Refuse bad options before anything is opened
+    check_writers(options)
+    try:
+        log.info("Opening thin-pool data '%s'" % snapshot.data)
+        fd = directio.open(snapshot.data, buffered=0,
+                trace=open_trace(options, metrics))
+    except OSError, e:
+        raise ScrubError("Failed to open thin-pool data '%s'" % e)
+
+    pool, reader = (None, None)
+    try:
+        # Whole blocks, or whole stripes of them, in each write
+        max_write = write_size(block_size, fd.geometry, options.max_write)
+        runs = list(extent_runs(extents, block_size, max_write))
+        layout = options.elevator and physical_layout(snapshot.data, metrics)
+        if layout:
+            runs = elevator(runs, layout)
+        pool, passes, throttle, flush = open_writers(fd, options, max_write,
+                metrics)
+        batch = max(options.queue_depth, options.workers)
+        if batch > 1 and options.verify:
+            reader = open_engine(fd, batch)
+        started = time.time()
+        overwrite(fd, runs, passes, pool, block_size, throttle, metrics,
+                flush)
+        flush_writes(fd, pool, metrics, flush)
+        metrics.progress(blocks, blocks, started)
+        metrics.add_phase('scrub', time.time() - started)
+        requests = sum(writer.requests for name, writer in passes)
+        metrics.count('zero_requests', requests)
+        log.info("Scrubbed '%d' thin blocks in '%d' requests"
+                % (blocks, requests))
+        if options.verify:
+            with metrics.phase('verify'):
+                verify(fd, reader, runs, block_size, max_write, batch,
+                        metrics)
+    finally:
+        if pool:
+            close_engine(pool)
+        if reader:
+            close_engine(reader)
+        fd.close()
+
+
+class WriteZeroer(object):
+    # Zero ranges of the cow by writing a buffer of NULL's over them
+    method = 'write'
+
+    def __init__(self, fd, scrub_buf, pool=None):
+        self.fd = fd
+        self.scrub_buf = scrub_buf
+        self.pool = pool
+        self.requests = 0
+
+    def zero(self, offset, length):
+        self.requests = self.requests + 1
+        buf = directio.view(self.scrub_buf, length)
+        if self.pool:
+            return self.pool.submit([(directio.WRITE, offset, buf)])
+        return write(self.fd, offset, buf)
+
+
+class PatternWriter(WriteZeroer):
+    # Overwrite ranges of the cow from a pattern buffer, the writes walk
+    # through the buffer a page aligned length at a time and wrap at its
+    # end, so no two chunks get the same data until it has all been used
+    method = 'pattern'
+
+    def __init__(self, fd, pattern_buf, pool=None):
+        WriteZeroer.__init__(self, fd, pattern_buf, pool)
+        self.position = 0
+
+    def zero(self, offset, length):
+        self.requests = self.requests + 1
+        if self.position + length > len(self.scrub_buf):
+            self.position = 0
+        buf = directio.view(self.scrub_buf, length, self.position)
+        self.position = self.position + ((length + 4095) & ~4095)
+        if self.pool:
+            return self.pool.submit([(directio.WRITE, offset, buf)])
+        return write(self.fd, offset, buf)
+
+
+class OffloadZeroer(WriteZeroer):
+    # Have the device or file system zero ranges itself, if it refuses
+    # we fall back to writing NULL's for the rest of the scrub
+
+    def __init__(self, fd, scrub_buf, pool=None):
+        WriteZeroer.__init__(self, fd, scrub_buf, pool)
+        self.offload = True
+
+    def zero(self, offset, length):
+        if self.offload:
+            try:
+                self._offload(offset, length)
+                self.requests = self.requests + 1
+                return length
+            except (OSError, IOError), e:
+                log.warning("%s failed at offset '%d' (%s); "
+                        "falling back to writing NULL's"
+                        % (self.method, offset, e))
+                self.offload = False
+        return WriteZeroer.zero(self, offset, length)
+
+
+class ZeroOutZeroer(OffloadZeroer):
+    method = 'zeroout'
+
+    def _offload(self, offset, length):
+        return self.fd.zeroout(offset, length)
+
+
+class DiscardZeroer(OffloadZeroer):
+    method = 'discard'
+
+    def _offload(self, offset, length):
+        return self.fd.discard(offset, length)
+
+
+class PunchZeroer(OffloadZeroer):
+    method = 'punch'
+
+    def _offload(self, offset, length):
+        return self.fd.fallocate(directio.FALLOC_FL_PUNCH_HOLE
+                | directio.FALLOC_FL_KEEP_SIZE, offset, length)
+
+
+class ZeroRangeZeroer(OffloadZeroer):
+    method = 'zero-range'
+
+    def _offload(self, offset, length):
+        return self.fd.fallocate(directio.FALLOC_FL_ZERO_RANGE
+                | directio.FALLOC_FL_KEEP_SIZE, offset, length)
+
+
+ZEROERS = dict((zeroer.method, zeroer) for zeroer in (WriteZeroer,
+    ZeroOutZeroer, DiscardZeroer, PunchZeroer, ZeroRangeZeroer))
+
+
+class TokenBucket(object):
+    # Hands out 'rate' tokens a second, saving up no more than 'burst';
+    # takers sleep off any debt they run up
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def take(self, amount):
+        now = time.time()
+        self.tokens = min(self.burst,
+                self.tokens + ((now - self.last) * self.rate))
+        self.last = now
+        self.tokens = self.tokens - amount
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+class Throttle(object):
+    # Limit scrub I/O to 'mbps' and 'iops'. Given a 'target_latency' in
+    # milliseconds the limits are halved whenever the average latency of
+    # the devices in 'stat_paths' (or of our own requests) goes over the
+    # target, and slowly raised back while it stays under.
+    SAMPLE_INTERVAL = 0.5
+    MIN_SCALE = 1.0 / 64
+
+    def __init__(self, mbps=0, iops=0, target_latency=0, stat_paths=()):
+        if target_latency and not mbps:
+            mbps = 1024
+        self.limits = (mbps * 1048576, iops)
+        self.target_latency = target_latency
+        self.stat_paths = stat_paths
+        self.scale = 1.0
+        self.bytes, self.ios = [TokenBucket(limit, max(limit / 10, 1))
+                if limit else None for limit in self.limits]
+        self.last_sample = (time.time(), self._device_stats())
+        self.timings = [0.0, 0]
+
+    def wait(self, length):
+        if self.target_latency:
+            self._adapt()
+        if self.bytes:
+            self.bytes.take(length)
+        if self.ios:
+            self.ios.take(1)
+
+    def observe(self, latency):
+        # Record the latency in seconds of one of our own requests
+        self.timings[0] = self.timings[0] + latency
+        self.timings[1] = self.timings[1] + 1
+
+    def _device_stats(self):
+        # Sum the (ios, ticks in ms) for reads and writes from
+        # /sys/block/<dev>/stat of every device we watch
+        ios, ticks = (0, 0)
+        for path in self.stat_paths:
+            try:
+                with open(path) as file:
+                    fields = [int(field) for field in file.read().split()]
+            except (IOError, ValueError):
+                continue
+            ios = ios + fields[0] + fields[4]
+            ticks = ticks + fields[3] + fields[7]
+        return (ios, ticks)
+
+    def _adapt(self):
+        now = time.time()
+        if now - self.last_sample[0] < self.SAMPLE_INTERVAL:
+            return
+        ios, ticks = self._device_stats()
+        last_ios, last_ticks = self.last_sample[1]
+        self.last_sample = (now, (ios, ticks))
+        if ios > last_ios:
+            latency = float(ticks - last_ticks) / (ios - last_ios)
+        elif self.timings[1]:
+            latency = (self.timings[0] / self.timings[1]) * 1000
+        else:
+            return
+        self.timings = [0.0, 0]
+
+        if latency > self.target_latency:
+            scale = max(self.scale / 2, self.MIN_SCALE)
+        else:
+            scale = min(self.scale + 0.05, 1.0)
+        if scale != self.scale:
+            log.debug("Latency %.1fms, scaling scrub rate to %d%%"
+                    % (latency, scale * 100))
+        self.scale = scale
+        for bucket, limit in zip((self.bytes, self.ios), self.limits):
+            if bucket:
+                bucket.rate = limit * scale
+
+
+def stat_paths(fd):
+    # The sysfs stat of the device backing 'fd'; for device-mapper
+    # devices, the stat of the devices underneath, which are shared with
+    # the origin
+    rdev = os.fstat(fd.fileno()).st_rdev
+    path = '/sys/dev/block/%d:%d' % (os.major(rdev), os.minor(rdev))
+    slaves = glob.glob(os.path.join(path, 'slaves', '*', 'stat'))
+    if slaves:
+        return slaves
+    if os.path.exists(os.path.join(path, 'stat')):
+        return [os.path.join(path, 'stat')]
+    return []
+
+
+def queue_limit(fd, name):
+    # Read a queue limit for the block device from sysfs, partitions
+    # share the queue of the disk they belong to
+    rdev = os.fstat(fd.fileno()).st_rdev
+    path = '/sys/dev/block/%d:%d' % (os.major(rdev), os.minor(rdev))
+    for queue in (os.path.join(path, 'queue'),
+            os.path.join(path, '..', 'queue')):
+        try:
+            with open(os.path.join(queue, name)) as file:
+                return int(file.read())
+        except (IOError, ValueError):
+            continue
+    return 0
+
+
+def detect_zero_method(fd):
+    # Files can have the range punched out, which also frees the space
+    if not stat.S_ISBLK(os.fstat(fd.fileno()).st_mode):
+        return PunchZeroer.method
+    if queue_limit(fd, 'write_zeroes_max_bytes') > 0:
+        return ZeroOutZeroer.method
+    # Discard is only safe if the device promises to read back zeros
+    if queue_limit(fd, 'discard_zeroes_data') == 1:
+        return DiscardZeroer.method
+    return WriteZeroer.method
+
+
+def device_mapper():
+    # The device-mapper backend, see dm.py; tests swap in a fake
+    global dm_backend
+    if dm_backend is None:
+        dm_backend = dm.backend()
+    return dm_backend
+
+
+def prepare_cow(cow, metrics=None):
+    backend = device_mapper()
+    # Don't attempt to re-create a -zero linear device if it already exists
+    if backend.exists(cow + '-zero'):
+        return
+    metrics = metrics or Metrics(cow)
+
+    # Work out both tables before the origin is suspended
+    # e.g. "0 204800 linear 8:16 4194688" => "0 204800 error"
+    cow_table = backend.table(cow)
+    error_table = dm.error_table(cow_table)
+
+    suspended = None
+    try:
+        # create a new handle to the same blocks as in use by the cow
+        backend.create(cow + '-zero', cow_table)
+        forget_cached(backend.path(cow + '-zero'))
+        # load the table that makes the cow always return io errors, it
+        # goes live when the cow is resumed
+        backend.load(cow, error_table)
+        # suspend the cow (this will essentially suspend the origin)
+        suspended = time.time()
+        backend.suspend(cow)
+    except dm.DMError, e:
+        # If somthing went wrong, drop the error table and the cow-zero
+        try:
+            backend.clear(cow)
+        except dm.DMError:
+            pass
+        if backend.exists(cow + '-zero'):
+            backend.remove(cow + '-zero')
+        raise ScrubError("Failed to prepare cow '%s': %s" % (cow, e))
+    finally:
+        # resume the cow to let writes start happening back on the origin
+        if suspended:
+            backend.resume(cow)
+            window = time.time() - suspended
+            metrics.add_phase('suspend', window)
+            log.info("Origin of '%s' was suspended for %.3fms"
+                    % (cow, window * 1000))
+
+
+def cow_paths(snapshot):
+    # Ask device-mapper which device is the cow of our snapshot
+    backend = device_mapper()
+    try:
+        cow_device = backend.snapshot_cow(snapshot)
+    except dm.DMError, e:
+        raise ScrubError("%s; invalid snapshot volume?" % e)
+    return (cow_device, backend.path(cow_device))
+
+
+def physical_devices(cow_device):
+    # The major:minor of each device backing the cow,
+    # e.g. "0 204800 linear 8:16 4194688" => ['8:16']
+    backend = device_mapper()
+    for device in (cow_device + '-zero', cow_device):
+        try:
+            table = dm.format_table(backend.table(device))
+        except dm.DMError:
+            continue
+        devices = sorted(set(re.findall(r'\b(\d+:\d+)\b', table)))
+        if devices:
+            return devices
+    return ['unknown']
+
+
+def snapshot_usage(snapshot):
+    # The sectors allocated in the cow out of its total size,
+    # e.g. "0 16384 snapshot 32/16384 16" => (32, 16384)
+    backend = device_mapper()
+    try:
+        status = dm.format_table(backend.status(backend.name(snapshot)))
+    except dm.DMError:
+        return None
+    match = re.search(r'snapshot (\d+)/(\d+)', status)
+    if match:
+        return (int(match.group(1)), int(match.group(2)))
+    return None
+
+
+def physical_layout(path, metrics=None):
+    # The dm.PhysicalMap of the device-mapper device at 'path', or None
+    # for images and devices that are not device-mapper
+    backend = device_mapper()
+    try:
+        name = backend.name(path)
+        if name is None:
+            return None
+        layout = dm.physical_map(backend, name)
+    except dm.DMError, e:
+        log.warning("Unable to map '%s' to its physical devices (%s); "
+                "writing in device order" % (path, e))
+        return None
+    log.info("'%s' maps to %d segments on %s" % (path, len(layout),
+        ', '.join(layout.devices()) or 'no devices we can see'))
+    if metrics:
+        metrics.info['segments'] = len(layout)
+    return layout
+
+
+def is_image(snapshot):
+    # A cow image in a file (see cowgen.py) is scrubbed directly
+    return os.path.isfile(snapshot) and device_mapper().name(snapshot) is None
+
+
+def prepare_thin(snapshot, options, metrics=None):
+    # Find the blocks only the thin snapshot maps, returns the snapshot
+    # and its (first block, number of blocks) extents
+    metrics = metrics or Metrics(snapshot.data)
+    try:
+        if snapshot.name and not options.display_only:
+            # Fail any I/O to the snapshot so no blocks are mapped or
+            # written after we read the metadata
+            with metrics.phase('prepare'):
+                fence_thin(snapshot.name, metrics)
+        if options.thin_dump:
+            metadata = thin.parse_thin_dump(options.thin_dump)
+        else:
+            with metrics.phase('dump'):
+                metadata = thin.dump_metadata(device_mapper(), snapshot)
+        extents = thin.exclusive_extents(metadata, snapshot.dev_id)
+    except (thin.ThinError, dm.DMError, SyntaxError), e:
+        raise ScrubError("Failed to read the thin metadata of device '%d': "
+                "%s" % (snapshot.dev_id, e))
+    return (snapshot._replace(block_size=metadata.block_size), extents)
+
+
+def fence_thin(name, metrics):
+    backend = device_mapper()
+    backend.load(name, dm.error_table(backend.table(name)))
+    suspended = time.time()
+    backend.suspend(name)
+    backend.resume(name)
+    metrics.add_phase('suspend', time.time() - suspended)
+
+
+def prepare_snapshot(snapshot, options, metrics=None):
+    # Return the path of the cow to scrub, or for a thin snapshot the
+    # snapshot and the extents of its data to scrub
+    if not os.path.exists(snapshot):
+        raise ScrubError("snapshot '%s' does not exist" % snapshot)
+
+    if options.thin_id is not None:
+        # The pool's data device or an image of it, with a recorded dump
+        log.info("Scrubbing thin device '%d' in '%s'"
+                % (options.thin_id, snapshot))
+        return prepare_thin(thin.ThinSnapshot(None, None, options.thin_id,
+            None, snapshot, None), options, metrics)
+
+    if is_image(snapshot):
+        log.info("Scrubbing cow image '%s'" % snapshot)
+        return snapshot
+
+    metrics = metrics or Metrics(snapshot)
+    try:
+        thin_snapshot = thin.thin_snapshot(device_mapper(), snapshot)
+    except (thin.ThinError, dm.DMError), e:
+        raise ScrubError("Failed to read the thin-pool of '%s': %s"
+                % (snapshot, e))
+    if thin_snapshot:
+        # Every thin volume has a thin target, only LVM knows which are
+        # snapshots; never fence and zero a volume that has no origin
+        try:
+            origin = device_mapper().volume_origin(snapshot)
+        except dm.DMError, e:
+            raise ScrubError("Failed to find the origin of '%s': %s"
+                    % (snapshot, e))
+        if not origin:
+            raise ScrubError("'%s' is a thin volume, not a snapshot"
+                    % snapshot)
+        log.info("Snapshot '%s' of '%s' is thin device '%d' in pool '%s'"
+                % (snapshot, origin, thin_snapshot.dev_id,
+                    thin_snapshot.pool))
+        return prepare_thin(thin_snapshot, options, metrics)
+
+    cow_device, cow = cow_paths(snapshot)
+
+    usage = snapshot_usage(snapshot)
+    if usage:
+        log.info("Snapshot '%s' has %d of %d cow sectors allocated"
+                % (snapshot, usage[0], usage[1]))
+        metrics.info['cow_allocated_bytes'] = usage[0] * 512
+        metrics.info['cow_size_bytes'] = usage[1] * 512
+
+    # The -zero device might already exist if recovering from a botched scrub
+    if not options.display_only:
+        with metrics.phase('prepare'):
+            prepare_cow(cow_device, metrics)
+
+    if os.path.exists(cow + '-zero'):
+        cow = cow + '-zero'
+    return cow
+
+
+def teardown_snapshot(snapshot, target, options, metrics=None):
+    # 'target' is what prepare_snapshot() returned
+    if is_image(snapshot) or options.thin_id is not None:
+        return
+    if options.skip_remove:
+        log.info("skip-remove requested, not removing '%s'" % snapshot)
+        return
+
+    if not options.display_only:
+        log.info("Removing snapshot '%s'" % snapshot)
+        metrics = metrics or Metrics(snapshot)
+        backend = device_mapper()
+        try:
+            # Remove the cow-zero, thin snapshots don't have one
+            if isinstance(target, basestring):
+                cow_device, cow = cow_paths(snapshot)
+                forget_cached(cow + '-zero')
+                with metrics.phase('dmremove'):
+                    backend.remove(cow_device + '-zero', force=True)
+            # Remove the snapshot
+            with metrics.phase('lvremove'):
+                backend.remove_volume(snapshot)
+        except dm.DMError, e:
+            raise ScrubError("Failed to remove snapshot '%s': %s"
+                    % (snapshot, e))
+
+
+def scrub_target(target, options, metrics=None):
+    # Scrub what prepare_snapshot() returned
+    if isinstance(target, basestring):
+        return scrub(target, options, metrics)
+    return scrub_thin(target[0], target[1], options, metrics)
+
+
+def target_devices(snapshot, target):
+    # The major:minor of the physical devices the scrub will write to
+    if isinstance(target, basestring) and not is_image(snapshot):
+        return physical_devices(cow_paths(snapshot)[0])
+    path = target if isinstance(target, basestring) else target[0].data
+    name = device_mapper().name(path)
+    if name:
+        return physical_devices(name)
+    info = os.stat(path)
+    device = info.st_rdev if stat.S_ISBLK(info.st_mode) else info.st_dev
+    return ['%d:%d' % (os.major(device), os.minor(device))]
+
+
+def remove_snapshot(snapshot, options, metrics=None):
+    metrics = metrics or Metrics(snapshot)
+    target = prepare_snapshot(snapshot, options, metrics)
+    # scrub the cow
+    scrub_target(target, options, metrics)
+    teardown_snapshot(snapshot, target, options, metrics)
+
+
+class Scheduler(object):
+    # Limits how many scrubs run at once on the host and on each physical
+    # device, so spindles don't thrash while other devices sit idle.
+    # Device-mapper changes are made one at a time.
+
+    def __init__(self, max_scrubs, max_per_device):
+        self.host = threading.Semaphore(max_scrubs)
+        self.max_per_device = max_per_device
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.dm_lock = threading.Lock()
+
+    def acquire(self, devices):
+        # Always take the device slots in the same order, then the host
+        with self.lock:
+            slots = [self.devices.setdefault(device,
+                threading.Semaphore(self.max_per_device))
+                for device in sorted(devices)]
+        for slot in slots:
+            slot.acquire()
+        self.host.acquire()
+        return slots
+
+    def release(self, slots):
+        self.host.release()
+        for slot in reversed(slots):
+            slot.release()
+
+
+def batch_remove(scheduler, snapshot, options, metrics, failures):
+    try:
+        with scheduler.dm_lock:
+            target = prepare_snapshot(snapshot, options, metrics)
+            devices = target_devices(snapshot, target)
+        slots = scheduler.acquire(devices)
+        try:
+            log.info("Scrubbing '%s' on device(s) %s"
+                    % (snapshot, ', '.join(devices)))
+            scrub_target(target, options, metrics)
+        finally:
+            scheduler.release(slots)
+        with scheduler.dm_lock:
+            teardown_snapshot(snapshot, target, options, metrics)
+    except Exception, e:
+        log.error("Failed to scrub '%s': %s" % (snapshot, e))
+        metrics.info['error'] = str(e)
+        failures.append(snapshot)
+
+
+def remove_snapshots(snapshots, options, metrics):
+    # Scrub many snapshots at once; while some are being scrubbed the
+    # device-mapper preparation and removal of the others carries on
+    scheduler = Scheduler(options.max_scrubs, options.max_device_scrubs)
+    failures, threads = ([], [])
+    for snapshot, entry in zip(snapshots, metrics):
+        thread = threading.Thread(target=batch_remove,
+                args=(scheduler, snapshot, options, entry, failures))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise ScrubError("Failed to scrub %d of %d snapshots: %s"
+                % (len(failures), len(snapshots), ', '.join(failures)))
+
+
+class EventMetrics(Metrics):
+    # Hands the events of a scrub to a ScrubTask, blocking the scrub
+    # while the task's queue is full
+
+    def __init__(self, snapshot, task):
+        Metrics.__init__(self, snapshot, task.options.progress)
+        self.task = task
+
+    def event(self, type, **data):
+        self.task.put(Event(type, self.snapshot, time.time(), data))
+
+
+class ScrubTask(threading.Thread):
+    # Scrub a snapshot or cow image in a thread and queue its events for
+    # the caller. At most 'backlog' events are queued, past that the
+    # scrub waits for the caller to catch up. fileno() is readable while
+    # events are queued, so an event loop can wait on many tasks with
+    # select(), poll() or asyncio's add_reader() and collect them with
+    # events() without blocking
+    #   task = ScrubTask('/tmp/cow.img', scrub_options(journal=''))
+    #   task.start()
+    #   while not task.finished:
+    #       select.select([task], [], [])
+    #       for event in task.events():
+    #           ...
+
+    def __init__(self, snapshot, options=None, backlog=1024):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.snapshot = snapshot
+        self.options = options or scrub_options()
+        self.queue = Queue.Queue(backlog)
+        self.cancelled = threading.Event()
+        self.finished = False
+        self.metrics = EventMetrics(snapshot, self)
+        self.reader, self.writer = os.pipe()
+        for fd in (self.reader, self.writer):
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+
+    def run(self):
+        try:
+            remove_snapshot(self.snapshot, self.options, self.metrics)
+            self.metrics.event('done', report=self.metrics.report())
+        except Exception, e:
+            if not self.cancelled.is_set():
+                log.error("Failed to scrub '%s': %s" % (self.snapshot, e))
+            try:
+                self.metrics.event('error', message=str(e))
+            except ScrubError:
+                pass
+        finally:
+            self.put(None)
+
+    def put(self, event):
+        # Wait for room in the queue, unless the caller has gone
+        while True:
+            if self.cancelled.is_set():
+                if event is None:
+                    return
+                raise ScrubError("Scrub of '%s' was cancelled"
+                        % self.snapshot)
+            try:
+                self.queue.put(event, True, 0.1)
+                break
+            except Queue.Full:
+                continue
+        try:
+            os.write(self.writer, 'e')
+        except OSError, e:
+            # A full pipe is already readable
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def fileno(self):
+        return self.reader
+
+    def _got(self, event):
+        if event is None:
+            self.finished = True
+        return event
+
+    def events(self):
+        # The events queued so far, without blocking
+        try:
+            os.read(self.reader, 65536)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        events = []
+        while True:
+            try:
+                event = self._got(self.queue.get_nowait())
+            except Queue.Empty:
+                return events
+            if event is None:
+                return events
+            events.append(event)
+
+    def next_event(self, timeout=None):
+        # The next event, None once the scrub has finished or no event
+        # came within 'timeout' seconds
+        if self.finished:
+            return None
+        try:
+            return self._got(self.queue.get(True, timeout))
+        except Queue.Empty:
+            return None
+
+    def cancel(self):
+        # Stop the scrub at its next event, e.g. the next metadata store;
+        # it can be resumed from the journal
+        self.cancelled.set()
+
+    def close(self):
+        self.cancel()
+        if self.is_alive():
+            self.join()
+        for fd in (self.reader, self.writer):
+            os.close(fd)
+        self.reader = self.writer = -1
+
+
+def scrub_options(*args, **overrides):
+    # Options for the library API; the command line 'args', then any
+    # option by its attribute name, e.g. scrub_options(queue_depth=8);
+    # invalid options raise ScrubError
+    options, snapshots = option_parser(RequestOptionParser).parse_args(
+            list(args))
+    for name, value in overrides.items():
+        if not hasattr(options, name):
+            raise TypeError("Unknown scrub option '%s'" % name)
+        setattr(options, name, value)
+    return options
+
+
+def scrub_events(snapshot, options=None, backlog=1024):
+    # Scrub a snapshot or cow image and yield its events until it
+    # finishes; closing the generator early cancels the scrub
+    #   for event in scrub_events('/tmp/cow.img', scrub_options(journal='')):
+    #       print event.type, event.data
+    task = ScrubTask(snapshot, options, backlog)
+    task.start()
+    try:
+        while True:
+            event = task.next_event()
+            if event is None:
+                return
+            yield event
+    finally:
+        task.close()
+
+
+class Job(Metrics):
+    # A scrub submitted to the daemon; its progress and state are kept
+    # for clients to poll or watch, a cancelled job stops at the next
+    # metadata store and can be resumed from its journal
+
+    FINISHED = ('done', 'failed', 'cancelled')
+
+    def __init__(self, id, snapshot, options):
+        Metrics.__init__(self, snapshot, options.progress)
+        self.id = id
+        self.options = options
+        self.state = 'queued'
+        self.done = 0
+        self.total = 0
+        self.cancelled = threading.Event()
+        self.changed = threading.Condition()
+        self.version = 0
+
+    def update(self, **fields):
+        with self.changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version = self.version + 1
+            self.changed.notify_all()
+
+    def progress(self, done, total, started):
+        Metrics.progress(self, done, total, started)
+        self.update(done=done, total=total)
+        if self.cancelled.is_set():
+            raise ScrubError("Job '%d' was cancelled" % self.id)
+
+    def status(self):
+        return OrderedDict([('job', self.id), ('snapshot', self.snapshot),
+            ('state', self.state), ('done', self.done),
+            ('total', self.total), ('error', self.info.get('error')),
+            ('elapsed', time.time() - self.started)])
+
+
+class Daemon(object):
+    # Runs the scrubs submitted over a unix socket, see serve(). The
+    # device-mapper backend, the I/O engines and buffers stay warm
+    # between jobs and the scheduler queues jobs per physical device
+
+    def __init__(self, options, history=1000):
+        global resources, block_cache
+        resources = resources or ResourcePool()
+        # Jobs share the cache sized by the daemon's --cache-mb
+        if options.cache_mb and block_cache is None:
+            block_cache = directio.BlockCache(options.cache_mb << 20)
+        device_mapper()
+        self.scheduler = Scheduler(options.max_scrubs,
+                options.max_device_scrubs)
+        self.history = history
+        self.jobs = OrderedDict()
+        self.ids = count(1)
+        self.lock = threading.Lock()
+
+    def submit(self, args):
+        # 'args' are the command line of a scrub, each snapshot
+        # becomes a job of its own
+        options, snapshots = option_parser(
+                RequestOptionParser).parse_args(list(args))
+        for pattern in options.glob:
+            snapshots.extend(sorted(glob.glob(os.path.join('/dev', pattern))))
+        if not snapshots:
+            raise ScrubError("No snapshots to scrub")
+        jobs = []
+        with self.lock:
+            for snapshot in snapshots:
+                job = Job(next(self.ids), snapshot, options)
+                self.jobs[job.id] = job
+                jobs.append(job)
+            self.prune()
+        for job in jobs:
+            thread = threading.Thread(target=self.run, args=(job,))
+            thread.daemon = True
+            thread.start()
+        return jobs
+
+    def prune(self):
+        # Forget the oldest finished jobs past 'history'
+        finished = [job.id for job in self.jobs.values()
+                if job.state in Job.FINISHED]
+        for id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[id]
+
+    def run(self, job):
+        if job.cancelled.is_set():
+            return job.update(state='cancelled')
+        job.update(state='running')
+        failures = []
+        batch_remove(self.scheduler, job.snapshot, job.options, job, failures)
+        try:
+            write_reports([job], job.options)
+        except (IOError, OSError), e:
+            log.error("Failed to write the report of job '%d': %s"
+                    % (job.id, e))
+        if job.cancelled.is_set() and failures:
+            return job.update(state='cancelled')
+        job.update(state='failed' if failures else 'done')
+
+    def job(self, id):
+        with self.lock:
+            if id not in self.jobs:
+                raise ScrubError("No such job '%s'" % id)
+            return self.jobs[id]
+
+    def cancel(self, id):
+        job = self.job(id)
+        job.cancelled.set()
+        return job
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def watch(self, id, timeout=1.0):
+        # Yield the status of a job each time it changes until it finishes
+        job, version = (self.job(id), -1)
+        while True:
+            with job.changed:
+                if job.version == version:
+                    job.changed.wait(timeout)
+                version = job.version
+            status = job.status()
+            yield status
+            if status['state'] in Job.FINISHED:
+                return
+
+    def close(self):
+        for job in self.list():
+            job.cancelled.set()
+        resources.close()
+
+
+class DaemonHandler(SocketServer.StreamRequestHandler):
+    # One JSON request a line, each answered with one JSON line or, for
+    # 'watch', a line each time the job changes until it finishes
+    #  {"command": "submit", "args": ["/dev/volume/backup", "--verify"]}
+    #  {"command": "status", "job": 1}
+    #  {"command": "cancel", "job": 1}
+    #  {"command": "watch", "job": 1}
+    #  {"command": "list"}
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                for reply in self.dispatch(json.loads(line)):
+                    self.wfile.write(json.dumps(reply) + '\n')
+                    self.wfile.flush()
+            except (ScrubError, ValueError, KeyError, TypeError), e:
+                self.wfile.write(json.dumps({'error': str(e)}) + '\n')
+            except socket.error:
+                return
+
+    def dispatch(self, request):
+        daemon, command = (self.server.daemon, request['command'])
+        if command == 'submit':
+            return [{'jobs': [job.id for job in
+                daemon.submit(request['args'])]}]
+        if command == 'status':
+            return [daemon.job(request['job']).status()]
+        if command == 'cancel':
+            return [daemon.cancel(request['job']).status()]
+        if command == 'watch':
+            return daemon.watch(request['job'])
+        if command == 'list':
+            return [{'jobs': [job.status() for job in daemon.list()]}]
+        raise ScrubError("Unknown command '%s'" % command)
+
+
+class DaemonServer(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        if os.path.exists(path):
+            # A socket left behind by a daemon that didn't exit cleanly
+            os.unlink(path)
+        SocketServer.ThreadingUnixStreamServer.__init__(self, path,
+                DaemonHandler)
+        os.chmod(path, 0600)
+        self.daemon = daemon
+
+
+def serve(path, options):
+    daemon = Daemon(options)
+    server = DaemonServer(path, daemon)
+    log.info("Listening for scrub jobs on '%s'" % path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+        daemon.close()
+
+
+def daemon_request(path, request):
+    # Send a request to the daemon listening on 'path' and yield
+    # each reply
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    try:
+        client.sendall(json.dumps(request) + '\n')
+        client.shutdown(socket.SHUT_WR)
+        for line in client.makefile():
+            yield json.loads(line)
+    finally:
+        client.close()
+
+
+class RequestOptionParser(OptionParser):
+    # Parses the options of a daemon request or of scrub_options(), a
+    # bad option raises ScrubError for the caller rather than printing
+    # the usage and exiting the process
+
+    def error(self, msg):
+        raise ScrubError(msg)
+
+    def exit(self, status=0, msg=None):
+        raise ScrubError((msg or "Options that exit can't be used "
+            "here").strip())
+
+
+def option_parser(parser_class=OptionParser):
+    description = "Scrub the COW of an lvm snapshot then delete the snapshot"
+    parser = parser_class(
+            usage="Usage: %prog <snapshot path or cow image> [...] [-h]",
+            description=description)
+    parser.add_option('-v', '--verbose', action='count',
+            help="Be verbose, -vv is very verbose")
+    parser.add_option('-d', '--display-only', const=True, action='store_const',
+            help="Do not scrub the cow, display cow stats & exit; implies -v")
+    parser.add_option('-s', '--skip-remove', const=True, action='store_const',
+            help="Do not remove the snapshot after scrubbing")
+    parser.add_option('-m', '--max-write', type='int', default=1048576,
+            help="Largest write in bytes used when scrubbing adjacent "
+                "exceptions (default: %default)")
+    parser.add_option('-z', '--zero-method', default='auto',
+            choices=['auto'] + sorted(ZEROERS.keys()),
+            help="How to zero exceptions; write NULL's, ask the device to "
+                "zeroout or discard, punch or zero-range a file, or auto "
+                "detect (default: %default)")
+    parser.add_option('--passes', default='zero',
+            help="Comma separated overwrite passes made over the "
+                "exceptions in order; 'zero', 'random' or a byte such as "
+                "'0xff', e.g. 'random,zero' (default: %default)")
+    parser.add_option('--no-elevator', dest='elevator', default=True,
+            action='store_false',
+            help="Write in cow order rather than sorting the writes of "
+                "each --journal-interval of metadata stores (each store "
+                "with --flush area) by their offset on the physical "
+                "devices")
+    parser.add_option('--verify', const=True, action='store_const',
+            help="Read back every exception after scrubbing and fail if "
+                "any are not zero")
+    parser.add_option('--flush', default='end', metavar='POLICY',
+            help="When to flush scrub writes from the device's write "
+                "cache; at the 'end' of the scrub, after each metadata "
+                "'area' (each --journal-interval of them with --passes), "
+                "every number of bytes like '256M', every time like "
+                "'500ms', or 'dsync' every write with RWF_DSYNC "
+                "(default: %default)")
+    parser.add_option('--skip-zero', const=True, action='store_const',
+            help="Read each exception first and only scrub those that "
+                "are not already zero")
+    parser.add_option('-j', '--journal', default='/var/lib/scrub-snapshot',
+            help="Directory recording scrub progress so an interrupted "
+                "scrub can resume, '' to disable (default: %default)")
+    parser.add_option('--journal-interval', type='int', default=64,
+            help="Number of metadata stores scrubbed between journal "
+                "updates (default: %default)")
+    parser.add_option('-b', '--scan-batch', type='int', default=16,
+            help="Number of exception metadata stores to read at once "
+                "(default: %default)")
+    parser.add_option('-w', '--workers', type='int', default=1,
+            help="Number of threads issuing scrub writes in parallel "
+                "(default: %default)")
+    parser.add_option('-q', '--queue-depth', type='int', default=1,
+            help="Number of asynchronous scrub writes to keep in flight, "
+                "uses native AIO or falls back to threads (default: %default)")
+    parser.add_option('--max-mbps', type='float', default=0,
+            help="Limit scrub I/O to this many MB/s (default: unlimited)")
+    parser.add_option('--max-iops', type='float', default=0,
+            help="Limit scrub I/O to this many requests a second "
+                "(default: unlimited)")
+    parser.add_option('--target-latency', type='float', default=0,
+            help="Back off the scrub rate while the latency of the "
+                "underlying devices is over this many milliseconds; "
+                "--max-mbps defaults to 1024 when set")
+    parser.add_option('--report-json', metavar='FILE',
+            help="Write phase timings, I/O counters and latency "
+                "histograms to FILE as JSON")
+    parser.add_option('--textfile', metavar='FILE',
+            help="Write the same metrics to FILE for the node-exporter "
+                "textfile collector")
+    parser.add_option('--progress', type='int', default=10,
+            help="Seconds between progress and ETA messages with -v, "
+                "0 to disable (default: %default)")
+    parser.add_option('--export-changed', metavar='FILE',
+            help="Before scrubbing, write the origin chunks changed since "
+                "the snapshot was taken to FILE; '%(snapshot)s' in FILE is "
+                "replaced with the snapshot name. Use with -d to only export")
+    parser.add_option('--export-format', default='json',
+            choices=['json', 'binary'],
+            help="Format of --export-changed, a JSON or binary list of "
+                "(first chunk, number of chunks) extents (default: %default)")
+    parser.add_option('--trace', metavar='FILE',
+            help="Record the time, offset, length and latency of every "
+                "I/O to FILE for replay.py; '%(snapshot)s' in FILE is "
+                "replaced with the snapshot name")
+    parser.add_option('--cache-mb', type='int', default=64, metavar='MB',
+            help="Keep up to MB of cow headers and metadata stores in "
+                "memory, so later scrubs of the same fenced cow in this "
+                "process don't read them again; 0 disables (default: "
+                "%default)")
+    parser.add_option('--thin-dump', metavar='FILE',
+            help="Read the thin-pool metadata from a thin_dump XML in FILE "
+                "instead of running thin_dump")
+    parser.add_option('--thin-id', type='int', metavar='ID',
+            help="Scrub the blocks of thin device ID in --thin-dump, the "
+                "arguments are the pool's data device or an image of it")
+    parser.add_option('-g', '--glob', action='append', default=[],
+            help="Scrub every snapshot matching a volume group glob, "
+                "e.g. 'volume/backup-*'; may be repeated")
+    parser.add_option('--max-scrubs', type='int', default=4,
+            help="When scrubbing many snapshots, the most to scrub at "
+                "once (default: %default)")
+    parser.add_option('--dm-backend', default='auto',
+            choices=['auto', 'ioctl', 'dmsetup'],
+            help="How to make device-mapper changes; ioctls on %s, the "
+                "dmsetup command, or auto to use ioctls when possible "
+                "(default: %%default)" % dm.CONTROL)
+    parser.add_option('--max-device-scrubs', type='int', default=1,
+            help="When scrubbing many snapshots, the most to scrub at "
+                "once on each physical device (default: %default)")
+    parser.add_option('--daemon', metavar='SOCKET',
+            help="Run scrub jobs submitted as JSON over the unix socket "
+                "SOCKET, see DaemonHandler; --max-scrubs and "
+                "--max-device-scrubs apply to all jobs")
+    return parser
+
+
+def main(argv=None):
+    # The command line of scrub-snapshot.py, returns the exit status
+    global dm_backend
+    parser = option_parser()
+    options, args = parser.parse_args(argv)
+
+    for pattern in options.glob:
+        args.extend(sorted(glob.glob(os.path.join('/dev', pattern))))
+
+    if not len(args) and not options.daemon:
+        parser.print_help()
+        return 1
+
+    if options.verbose == 1:
+        log.setLevel(logging.INFO)
+    if options.verbose > 1:
+        log.setLevel(logging.DEBUG)
+
+    if options.display_only:
+        if options.verbose < 2:
+            log.setLevel(logging.INFO)
+        log.info("Display Only, Not Scrubbing")
+
+    try:
+        dm_backend = dm.backend(options.dm_backend)
+    except dm.DMError, e:
+        print "-- %s" % e
+        return 1
+
+    if options.daemon:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            serve(options.daemon, options)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    for name, path in (('export-changed', options.export_changed),
+            ('trace', options.trace)):
+        if len(args) > 1 and path and '%(snapshot)s' not in path:
+            print "-- --%s needs '%%(snapshot)s' in the file name when " \
+                    "scrubbing many snapshots" % name
+            return 1
+
+    metrics = [Metrics(snapshot, options.progress) for snapshot in args]
+    try:
+        if len(args) == 1:
+            remove_snapshot(args[0], options, metrics[0])
+        else:
+            remove_snapshots(args, options, metrics)
+    except (ScrubError, dm.DMError), e:
+        print "-- %s" % e
+        return 1
+    finally:
+        write_reports(metrics, options)
+    return 0
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+
+import unittest
+import bench
+
+
+def result(mbps, op='read', block_size=4096):
+    return {'op': op, 'pattern': 'sequential', 'block_size': block_size,
+            'buffered': 0, 'concurrency': 1, 'stride': 1, 'mbps': mbps}
+
+
+class TestBench(unittest.TestCase):
+
+    def test_offsets(self):
+        self.assertEquals(bench.offsets('sequential', 4096, 16384, 257, 0),
+                [0, 4096, 8192, 12288])
+        # The random pattern touches every block once, the same way for
+        # the same seed
+        blocks = bench.offsets('random', 4096, 65536, 257, 1)
+        self.assertEquals(sorted(blocks), range(0, 65536, 4096))
+        self.assertEquals(blocks, bench.offsets('random', 4096, 65536, 257, 1))
+        self.assertNotEquals(blocks,
+                bench.offsets('random', 4096, 65536, 257, 2))
+        # Strided skips the first block like the header of a cow
+        self.assertEquals(bench.offsets('strided', 4096, 40960, 4, 0),
+                [4096, 20480, 36864])
+        self.assertRaises(ValueError, bench.offsets, 'zigzag', 4096, 4096,
+                1, 0)
+
+    def test_percentile(self):
+        self.assertEquals(bench.percentile([], 50), 0.0)
+        latencies = [float(index) for index in range(1, 101)]
+        self.assertEquals(bench.percentile(latencies, 50), 51.0)
+        self.assertEquals(bench.percentile(latencies, 99), 99.0)
+        self.assertEquals(bench.percentile(latencies, 100), 100.0)
+        self.assertEquals(bench.percentile([0.5], 99), 0.5)
+
+    def test_compare(self):
+        baseline = [result(100.0), result(100.0, op='write'),
+                result(50.0, block_size=65536)]
+        results = [result(95.0), result(80.0, op='write'),
+                result(10.0, block_size=1048576)]
+        # Only the write lost more than the 10% tolerance, runs with no
+        # baseline are never regressions
+        self.assertEquals(bench.compare(results, baseline, 0.1),
+                [results[1]])
+        self.assertEquals(results[0]['baseline_mbps'], 100.0)
+        self.assertFalse('baseline_mbps' in results[2])
+        self.assertEquals(bench.compare(results, baseline, 0.25), [])
+
+    def test_select_ops(self):
+        self.assertEquals(bench.select_ops(None, None), ['read', 'write'])
+        # A target the user gave is only written to when asked
+        self.assertEquals(bench.select_ops(None, '/dev/sdb'), ['read'])
+        self.assertRaises(ValueError, bench.select_ops, 'read,write',
+                '/dev/sdb')
+        self.assertEquals(bench.select_ops('write', '/dev/sdb', write=True),
+                ['write'])
+        self.assertRaises(ValueError, bench.select_ops, 'trim', None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -202,6 +202,340 @@ class TestRawDirect(unittest.TestCase):
         self.assertEquals(raw.read(512), ('B' * 512))
         self.assertEquals(raw.tell(), 1024)
 
+    def test_punch_hole(self):
+        raw = RawDirect(self.file)
+        raw.write('A' * 8192)
+        mode = directio.FALLOC_FL_PUNCH_HOLE | directio.FALLOC_FL_KEEP_SIZE
+        self.assertEquals(raw.fallocate(mode, 4096, 4096), 4096)
+        self.assertEquals(raw.pread(8192, 0), 'A' * 4096 + '\0' * 4096)
+        raw.close()
+        self.assertEquals(os.stat(self.file).st_size, 1048576)
+
+    @unittest.skipIf(cannot_create_loopback(), "requires a loopback device")
+    def test_zeroout(self):
+        with open(self.file, 'w') as file:
+            file.write('A' * 8192)
+
+        try:
+            device = find_loopback_device()
+            call("losetup %s %s" % (device, self.file), shell=True)
+            raw = RawDirect(device)
+            self.assertEquals(raw.zeroout(4096, 4096), 4096)
+            self.assertEquals(raw.pread(8192, 0), 'A' * 4096 + '\0' * 4096)
+            raw.close()
+        finally:
+            call("losetup -d %s" % device, shell=True)
+
+    @unittest.skipIf(cannot_create_loopback(), "requires a loopback device")
+    def test_geometry(self):
+        try:
+            # A loop device with 4096 byte logical blocks, like a 4Kn drive
+            device = find_loopback_device()
+            call("losetup -b 4096 %s %s" % (device, self.file), shell=True)
+            raw = RawDirect(device)
+            self.assertEquals(raw.geometry.logical, 4096)
+            self.assertEquals(raw.pread(4096, 0), '\0' * 4096)
+            self.assertRaises(OSError, raw.pread, 512, 0)
+            raw.close()
+        finally:
+            call("losetup -d %s" % device, shell=True)
+
+    def test_buffer_size(self):
+        self.assertEquals(directio.buffer_size(
+            directio.Geometry(512, 4096, 4096, 0)), 32768)
+        # Three 256k stripe units
+        self.assertEquals(directio.buffer_size(
+            directio.Geometry(512, 4096, 262144, 786432)), 786432)
+
+    def test_pread_pwrite(self):
+        raw = RawDirect(self.file)
+        self.assertEquals(raw.pwrite('A' * 512, 4096), 512)
+        # Positional I/O does not move the file position
+        self.assertEquals(raw.tell(), 0)
+        self.assertEquals(raw.pread(512, 4096), 'A' * 512)
+        self.assertEquals(raw.read(512), '\0' * 512)
+        self.assertRaises(OSError, raw.pwrite, 'A' * 10, 0)
+        raw.close()
+
+    def test_dsync(self):
+        raw = RawDirect(self.file)
+        raw.set_dsync()
+        self.assertEquals(raw.pwrite('D' * 512, 4096), 512)
+        self.assertEquals(raw.write('E' * 512), 512)
+        self.assertEquals(raw.pread(1024, 4096), 'D' * 512 + '\0' * 512)
+        self.assertEquals(raw.pread(512, 0), 'E' * 512)
+        self.assertTrue(raw.datasync() >= 0)
+        raw.close()
+
+    def test_flush_policy(self):
+        policy = directio.FlushPolicy('bytes', 4096)
+        self.assertFalse(policy.written(2048))
+        self.assertTrue(policy.written(2048))
+        policy.flushed()
+        self.assertFalse(policy.written(2048))
+        self.assertFalse(policy.area())
+        policy = directio.FlushPolicy('area')
+        self.assertFalse(policy.area())
+        policy.written(512)
+        self.assertTrue(policy.area())
+        self.assertRaises(ValueError, directio.FlushPolicy, 'bytes')
+        self.assertRaises(ValueError, directio.FlushPolicy, 'sometimes')
+
+    def test_aligned_buffers(self):
+        raw = RawDirect(self.file)
+        buf = directio.allocate(4096)
+        buf.write('C' * 4096)
+        self.assertEquals(raw.write(buf), 4096)
+        # Only write the first 512 bytes of the buffer
+        self.assertEquals(raw.write(directio.view(buf, 512)), 512)
+        raw.seek(0)
+        into = directio.allocate(4608)
+        self.assertEquals(raw.readinto(into), 4608)
+        self.assertEquals(into[:], 'C' * 4608)
+        # Unaligned buffers are read through the pool
+        into = bytearray(512)
+        self.assertEquals(raw.preadinto(into, 0), 512)
+        self.assertEquals(into, 'C' * 512)
+        raw.close()
+
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.file = tempfile.mkstemp(dir='/tmp')
+        os.write(fd, '\0' * 1048576)
+        os.close(fd)
+        self.trace = self.file + '.trace'
+
+    def tearDown(self):
+        os.unlink(self.file)
+        if os.path.exists(self.trace):
+            os.unlink(self.trace)
+
+    def test_trace(self):
+        # A ring smaller than the trace is appended to the file as it fills
+        raw = RawDirect(self.file, trace=directio.TraceRecorder(self.trace,
+            capacity=4))
+        for index in range(0, 10):
+            raw.pwrite('A' * 4096, index * 8192)
+        raw.seek(4096)
+        raw.read(512)
+        raw.datasync()
+        raw.close()
+        records = list(directio.read_trace(self.trace))
+        self.assertEquals([(record.op, record.offset, record.length)
+            for record in records], [(directio.WRITE, index * 8192, 4096)
+                for index in range(0, 10)] + [(directio.READ, 4096, 512),
+                    ('flush', 0, 0)])
+        self.assertEquals(records, sorted(records))
+        self.assertTrue(all(record.latency >= 0 for record in records))
+
+    def test_ring(self):
+        trace = directio.TraceRecorder(capacity=4)
+        raw = RawDirect(self.file, trace=trace)
+        aio = directio.AsyncIO(raw, depth=4)
+        aio.submit([(directio.WRITE, i * 4096, 'B' * 4096)
+            for i in range(0, 6)])
+        aio.drain()
+        aio.close()
+        raw.close()
+        # Only the last 4 are kept in memory
+        self.assertEquals(sorted(record.offset for record
+            in trace.records()), [8192, 12288, 16384, 20480])
+
+    def test_invalid_trace(self):
+        with open(self.trace, 'w') as file:
+            file.write('not a trace')
+        self.assertRaises(ValueError, list, directio.read_trace(self.trace))
+
+
+class TestBlockCache(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.file = tempfile.mkstemp(dir='/tmp')
+        os.write(fd, '\0' * 1048576)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.file)
+
+    def test_cached_pread(self):
+        raw = RawDirect(self.file)
+        raw.pwrite('A' * 4096, 8192)
+        raw.close()
+        cache = directio.BlockCache()
+        raw = RawDirect(self.file, cache=cache)
+        self.assertEquals(raw.cached_pread(4096, 8192), 'A' * 4096)
+        self.assertEquals((cache.hits, cache.misses), (0, 1))
+        # Another handle on the same file shares the cached read
+        other = RawDirect(self.file, cache=cache)
+        self.assertEquals(other.cached_pread(4096, 8192), 'A' * 4096)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+        # A write that overlaps drops it, one that doesn't leaves it
+        other.pwrite('B' * 4096, 0)
+        self.assertEquals(raw.cached_pread(4096, 8192), 'A' * 4096)
+        self.assertEquals(cache.hits, 2)
+        other.seek(12288 - 512)
+        other.write('C' * 512)
+        self.assertEquals(raw.cached_pread(4096, 8192), 'A' * 3584
+                + 'C' * 512)
+        self.assertEquals(cache.misses, 2)
+        other.close()
+        raw.close()
+
+    def test_aio_invalidate(self):
+        cache = directio.BlockCache()
+        raw = RawDirect(self.file, cache=cache)
+        raw.cached_pread(8192, 0)
+        aio = directio.AsyncIO(raw, depth=4)
+        aio.submit([(directio.WRITE, 4096, 'D' * 4096)])
+        aio.drain()
+        aio.close()
+        self.assertEquals(raw.cached_pread(8192, 0), '\0' * 4096
+                + 'D' * 4096)
+        self.assertEquals(cache.hits, 0)
+        raw.close()
+
+    def test_eviction(self):
+        cache = directio.BlockCache(max_bytes=16384)
+        raw = RawDirect(self.file, cache=cache)
+        for offset in range(0, 20480, 4096):
+            raw.cached_pread(4096, offset)
+        # The least recently used read was evicted
+        self.assertEquals(cache.size, 16384)
+        self.assertEquals(cache.get(raw.cache_key, 0, 4096), None)
+        self.assertEquals(cache.get(raw.cache_key, 4096, 4096), '\0' * 4096)
+        cache.forget(raw.cache_key)
+        self.assertEquals(cache.size, 0)
+        raw.close()
+
+    def test_write_in_flight(self):
+        # A read that raced an overlapping write isn't cached
+        cache = directio.BlockCache()
+        key = ('file', 1, 2, 3, 4)
+        generation = cache.generation(key)
+        cache.invalidate(key, 65536, 4096)
+        cache.put(key, 0, 4096, 'A' * 4096, generation)
+        cache.put(key, 63488, 4096, 'B' * 4096, generation)
+        self.assertEquals(cache.get(key, 0, 4096), 'A' * 4096)
+        self.assertEquals(cache.get(key, 63488, 4096), None)
+
+
+class TestBufferPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = directio.BufferPool(max_bytes=8192)
+        address = pool.acquire(4096)
+        self.assertEquals(address % 4096, 0)
+        pool.release(address, 4096)
+        self.assertEquals(pool.size, 4096)
+        self.assertEquals(pool.acquire(4096), address)
+        self.assertEquals(pool.size, 0)
+        pool.release(address, 4096)
+        pool.clear()
+
+    def test_eviction(self):
+        pool = directio.BufferPool(max_bytes=8192)
+        addresses = [pool.acquire(4096) for i in range(0, 3)]
+        for address in addresses:
+            pool.release(address, 4096)
+        # The least recently released buffer was freed
+        self.assertEquals(pool.size, 8192)
+        self.assertEquals(sorted(pool._lru.keys()), sorted(addresses[1:]))
+        pool.clear()
+        self.assertEquals(pool.size, 0)
+
+
+class TestThreadedIO(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.file = tempfile.mkstemp(dir='/tmp')
+        os.write(fd, '\0' * 1048576)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.file)
+
+    def test_submit_drain(self):
+        raw = RawDirect(self.file)
+        pool = directio.ThreadedIO(raw, workers=4)
+        ids = pool.submit([(directio.WRITE, i * 4096, chr(65 + i) * 4096)
+            for i in range(0, 16)])
+        completions = pool.drain()
+        self.assertEquals([c.id for c in completions], ids)
+        self.assertEquals(pool.completed, 16)
+        completions = pool.submit([(directio.READ, 4096, 4096)])
+        self.assertEquals(pool.drain()[0].result, 'B' * 4096)
+        pool.close()
+        raw.close()
+
+    def test_errors(self):
+        raw = RawDirect(self.file)
+        pool = directio.ThreadedIO(raw, workers=2)
+        pool.submit([(directio.WRITE, 0, 'A' * 10)])
+        completion = pool.drain()[0]
+        self.assertEquals(completion.result, None)
+        self.assertTrue(isinstance(completion.error, OSError))
+        pool.close()
+        raw.close()
+
+
+def cannot_use_aio():
+    try:
+        directio.AsyncIO(None, depth=1).close()
+    except OSError:
+        return True
+    return False
+
+
+@unittest.skipIf(cannot_use_aio(), "requires native AIO")
+class TestAsyncIO(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.file = tempfile.mkstemp(dir='/tmp')
+        os.write(fd, '\0' * 1048576)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.file)
+
+    def test_submit_drain(self):
+        raw = RawDirect(self.file)
+        aio = directio.AsyncIO(raw, depth=4)
+        # More requests than the queue depth
+        ids = aio.submit([(directio.WRITE, i * 4096, chr(65 + i) * 4096)
+            for i in range(0, 16)])
+        self.assertEquals([c.id for c in aio.drain()], ids)
+        self.assertEquals(aio.completed, 16)
+        buf = directio.allocate(4096)
+        aio.submit([(directio.READ, 4096, 4096), (directio.READ, 8192, buf)])
+        completions = aio.drain()
+        self.assertEquals(completions[0].result, 'B' * 4096)
+        self.assertEquals(completions[1].result, 4096)
+        self.assertEquals(buf[:], 'C' * 4096)
+        aio.close()
+        raw.close()
+
+    def test_dsync(self):
+        raw = RawDirect(self.file)
+        raw.set_dsync()
+        aio = directio.AsyncIO(raw, depth=4)
+        aio.submit([(directio.WRITE, i * 4096, chr(65 + i) * 4096)
+            for i in range(0, 8)])
+        self.assertEquals([c.error for c in aio.drain()], [None] * 8)
+        self.assertEquals(raw.pread(4096, 4096), 'B' * 4096)
+        aio.close()
+        raw.close()
+
+    def test_errors(self):
+        raw = RawDirect(self.file)
+        aio = directio.AsyncIO(raw, depth=4)
+        aio.submit([(directio.WRITE, 0, 'A' * 10)])
+        completion = aio.drain()[0]
+        self.assertTrue(isinstance(completion.error, OSError))
+        aio.close()
+        raw.close()
+
 
 class TestBufferedDirect(unittest.TestCase):
 
@@ -220,6 +554,13 @@ class TestBufferedDirect(unittest.TestCase):
             fd.seek(0)
             self.assertEquals(fd.read(512), 'A' * 512)
 
+    def test_open_unbuffered(self):
+        with directio.open(self.file, buffered=0) as fd:
+            self.assertTrue(isinstance(fd, RawDirect))
+            self.assertEquals(fd.write('A' * 512), 512)
+            fd.seek(0)
+            self.assertEquals(fd.read(512), 'A' * 512)
+
     def test_open_read_only(self):
         fd = directio.open(self.file, 'r')
         self.assertRaises(UnsupportedOperation, fd.write, ('\0' * 512))
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+
+from struct import pack_into
+from array import array
+import unittest
+import tempfile
+import shutil
+import dm
+import os
+
+
+class TestIoctl(unittest.TestCase):
+
+    def test_struct_sizes(self):
+        self.assertEquals(dm.DM_IOCTL_SIZE, 312)
+        self.assertEquals(dm.DM_TARGET_SIZE, 40)
+        self.assertEquals(dm.dm_ioctl(dm.DM_TABLE_STATUS), 0xc138fd0c)
+        self.assertEquals(dm.dm_ioctl(dm.DM_DEV_SUSPEND), 0xc138fd06)
+
+    def test_marshal_targets(self):
+        data = dm.marshal_targets([(0, 2048, 'linear', '8:16 0'),
+            (2048, 2048, 'error', '')])
+        # 40 byte spec + 7 bytes of params, padded to 8 bytes
+        self.assertEquals(len(data), 48 + 48)
+        self.assertEquals(data[40:47], '8:16 0\0')
+        self.assertEquals(data[48 + 24:48 + 29], 'error')
+
+    def test_unmarshal_targets(self):
+        # The kernel's 'next' is relative to the start of the data
+        buf = array('B', '\0' * 512)
+        pack_into(dm.DM_TARGET_FORMAT, buf, 312, 0, 2048, 0, 56, 'linear')
+        buf[352:359] = array('B', '8:16 0\0')
+        pack_into(dm.DM_TARGET_FORMAT, buf, 368, 2048, 1024, 0, 0, 'error')
+        self.assertEquals(dm.unmarshal_targets(buf, 312, 2),
+            [(0, 2048, 'linear', '8:16 0'), (2048, 1024, 'error', '')])
+
+    def test_tables(self):
+        table = dm.parse_table("0 204800 linear 8:16 4194688\n"
+                "204800 100 linear 8:32 0\n")
+        self.assertEquals(table[1], (204800, 100, 'linear', '8:32 0'))
+        self.assertEquals(dm.format_table(dm.error_table(table)),
+                "0 204900 error ")
+
+
+class TestBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(dir='/tmp')
+
+    def tearDown(self):
+        dm.SYSFS = '/sys'
+        shutil.rmtree(self.dir)
+
+    def test_sysfs_name(self):
+        dm.SYSFS = self.dir
+        os.makedirs(os.path.join(self.dir, 'dev/block/253:2/dm'))
+        with open(os.path.join(self.dir, 'dev/block/253:2/dm/name'), 'w') \
+                as file:
+            file.write('volume-backup-cow\n')
+        backend = dm.DMSetup()
+        self.assertEquals(backend.name('253:2'), 'volume-backup-cow')
+        self.assertEquals(backend.name('253:3'), None)
+        # Regular files are never device-mapper devices
+        self.assertEquals(backend.name(file.name), None)
+
+    def test_physical_map(self):
+        fake = dm.FakeDeviceMapper(self.dir)
+        fake.create('lower', [(0, 100, 'linear', '8:16 1000'),
+            (100, 100, 'linear', '8:32 0')])
+        fake.create('upper', [(0, 50, 'linear', '%s 75'
+            % fake.devices['lower']['dev']), (50, 50, 'linear', '8:16 0'),
+            (100, 8, 'error', '')])
+        layout = dm.physical_map(fake, 'upper')
+        self.assertEquals(layout.segments, [(0, 25, '8:16', 1075),
+            (25, 25, '8:32', 0), (50, 50, '8:16', 0), (100, 8, None, 100)])
+        self.assertEquals(layout.devices(), ['8:16', '8:32'])
+        # A range across three segments, in bytes
+        self.assertEquals(layout.split(24 * 512, 30 * 512), [
+            (24 * 512, 512, '8:16', 1099 * 512),
+            (25 * 512, 25 * 512, '8:32', 0),
+            (50 * 512, 4 * 512, '8:16', 0)])
+
+    def test_fake_snapshot(self):
+        image = os.path.join(self.dir, 'cow')
+        with open(image, 'w') as file:
+            file.truncate(1048576)
+        fake = dm.FakeDeviceMapper(self.dir)
+        snapshot = fake.add_snapshot('volume-backup', image)
+        self.assertEquals(fake.snapshot_cow(snapshot), 'volume-backup-cow')
+        self.assertEquals(os.path.realpath(fake.path('volume-backup-cow')),
+                image)
+        # A loaded table only goes live on resume
+        fake.load('volume-backup-cow', [(0, 2048, 'error', '')])
+        self.assertEquals(fake.table('volume-backup-cow')[0][2], 'linear')
+        fake.suspend('volume-backup-cow')
+        fake.resume('volume-backup-cow')
+        self.assertEquals(fake.table('volume-backup-cow')[0][2], 'error')
+        fake.remove_volume(snapshot)
+        self.assertEquals(fake.devices, {})
+        self.assertRaises(dm.DMError, fake.table, 'volume-backup')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,882 @@
+#! /usr/bin/env python
+
+from test_directio import find_loopback_device, cannot_create_loopback
+from test_thin import THIN_DUMP
+from subprocess import call
+from struct import pack
+import unittest
+import json
+import threading
+import tempfile
+import shutil
+import time
+import scrub_snapshot
+import replay
+import select
+import cowgen
+import dm
+import os
+
+
+def parse(*args):
+    options, args = scrub_snapshot.option_parser().parse_args(list(args))
+    return options
+
+
+def thin_pool(directory):
+    # A pool data image of 32 64k blocks full of data and a dump of its
+    # metadata, returns their paths
+    data, dump = (os.path.join(directory, 'data'),
+            os.path.join(directory, 'thin_dump.xml'))
+    with open(data, 'w') as file:
+        file.write(chr(0x88) * 32 * 65536)
+    with open(dump, 'w') as file:
+        file.write(THIN_DUMP)
+    return (data, dump)
+
+
+def nonzero_blocks(path, block_size):
+    with open(path) as file:
+        blocks = iter(lambda: file.read(block_size), '')
+        return [block for block, data in enumerate(blocks)
+                if data != '\0' * block_size]
+
+
+def nonzero_chunks(path, chunk_size):
+    # Count the exception chunks that still hold data
+    fd = scrub_snapshot.directio.open(path, buffered=0)
+    try:
+        table = scrub_snapshot.read_exception_table(fd, chunk_size)
+        return len([chunk for chunk in table.new_chunks
+            if fd.pread(chunk_size, chunk * chunk_size)
+            != '\0' * chunk_size])
+    finally:
+        fd.close()
+
+
+class TestScrub(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(dir='/tmp')
+        self.cow = os.path.join(self.dir, 'cow')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read_exception_table(self):
+        # 2 sector chunks hold 64 exceptions in each store
+        chunk_size = cowgen.generate(self.cow, 200, chunk_sectors=2,
+                fragmentation=0.5)
+        fd = scrub_snapshot.directio.open(self.cow, buffered=0)
+        table = scrub_snapshot.read_exception_table(fd, chunk_size, batch=3)
+        fd.close()
+        self.assertEquals(len(table), 200)
+        self.assertEquals(list(table.areas), [0, 64, 128, 192])
+        old_chunks, new_chunks = table.area(3)
+        self.assertEquals(len(new_chunks), 8)
+        self.assertEquals(sorted(new_chunks), range(197, 205))
+
+    def test_full_last_store(self):
+        # The store after a full store holds no exceptions
+        chunk_size = cowgen.generate(self.cow, 128, chunk_sectors=2)
+        fd = scrub_snapshot.directio.open(self.cow, buffered=0)
+        table = scrub_snapshot.read_exception_table(fd, chunk_size)
+        fd.close()
+        self.assertEquals(len(table), 128)
+
+    def test_table_scanner(self):
+        chunk_size = cowgen.generate(self.cow, 200, chunk_sectors=2)
+        fd = scrub_snapshot.directio.open(self.cow, buffered=0)
+        # More stores in flight than there are stores in the cow
+        scanner = scrub_snapshot.TableScanner(fd, chunk_size, batch=8)
+        scanner.start()
+        self.assertTrue(scanner.wait(3))
+        self.assertFalse(scanner.wait(4))
+        scanner.stop()
+        fd.close()
+        self.assertEquals(len(scanner.table), 200)
+        self.assertEquals(list(scanner.table.areas), [0, 64, 128, 192])
+
+    def test_coalesce(self):
+        runs = scrub_snapshot.coalesce([4096, 0, 1024, 512, 8192, 1536],
+                512, 1024)
+        self.assertEquals(list(runs), [(0, 1024), (1024, 1024),
+            (4096, 512), (8192, 512)])
+
+    def test_coalesce_boundaries(self):
+        # Runs are split at multiples of the largest write
+        runs = scrub_snapshot.coalesce(range(512, 4096, 512), 512, 2048)
+        self.assertEquals(list(runs), [(512, 1536), (2048, 2048)])
+
+    def test_write_size(self):
+        geometry = scrub_snapshot.directio.Geometry(512, 4096, 65536, 196608)
+        # A whole number of both 3 disk stripes and 4k chunks
+        self.assertEquals(scrub_snapshot.write_size(4096, geometry, 1048576),
+                983040)
+        self.assertEquals(scrub_snapshot.write_size(4096, geometry, 65536),
+                65536)
+
+    def test_scrub(self):
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2,
+                fragmentation=0.2)
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 300)
+        options = parse('--journal', '', '--verify', '-z', 'write')
+        scrub_snapshot.scrub(self.cow, options)
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+
+    def test_scrub_engines(self):
+        for args in (['-w', '4'], ['-q', '8'], ['-z', 'punch'],
+                ['--skip-zero', '-q', '4']):
+            chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+            options = parse('--journal', '', '--verify', *args)
+            scrub_snapshot.scrub(self.cow, options)
+            self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+
+    @unittest.skipIf(cannot_create_loopback(), "requires a loopback device")
+    def test_scrub_4kn(self):
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=8)
+        device = find_loopback_device()
+        try:
+            call("losetup -b 4096 %s %s" % (device, self.cow), shell=True)
+            scrub_snapshot.scrub(device, parse('--journal', '', '--verify'))
+        finally:
+            call("losetup -d %s" % device, shell=True)
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+
+    @unittest.skipIf(cannot_create_loopback(), "requires a loopback device")
+    def test_chunk_smaller_than_block(self):
+        cowgen.generate(self.cow, 10, chunk_sectors=2)
+        device = find_loopback_device()
+        try:
+            call("losetup -b 4096 %s %s" % (device, self.cow), shell=True)
+            self.assertRaises(scrub_snapshot.ScrubError, scrub_snapshot.scrub,
+                    device, parse('--journal', ''))
+        finally:
+            call("losetup -d %s" % device, shell=True)
+
+    def test_passes(self):
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+        metrics = scrub_snapshot.Metrics(self.cow)
+        scrub_snapshot.scrub(self.cow, parse('--journal', '', '-q', '4',
+            '--passes', 'random,0xff,zero', '--verify',
+            '--journal-interval', '2'), metrics)
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+        for name in ('pass1_random_bytes', 'pass2_0xff_bytes',
+                'pass3_zero_bytes'):
+            self.assertEquals(metrics.counters[name], 300 * chunk_size)
+
+    def test_random_pass(self):
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+        scrub_snapshot.scrub(self.cow, parse('--journal', '',
+            '--passes', 'random'))
+        fd = scrub_snapshot.directio.open(self.cow, buffered=0)
+        table = scrub_snapshot.read_exception_table(fd, chunk_size)
+        chunks = set(fd.pread(chunk_size, chunk * chunk_size)
+                for chunk in table.new_chunks)
+        fd.close()
+        # Every chunk was overwritten with different data
+        self.assertEquals(len(chunks), 300)
+        self.assertFalse(chr(0x88) * chunk_size in chunks)
+
+    def test_invalid_passes(self):
+        cowgen.generate(self.cow, 10, chunk_sectors=2)
+        for passes in ('zero,ones', 'zero,random'):
+            self.assertRaises(scrub_snapshot.ScrubError,
+                    scrub_snapshot.scrub, self.cow, parse('--journal', '',
+                        '--passes', passes, '--verify'))
+        # The interval also groups the stores of each pass
+        for interval in ('0', '-1'):
+            self.assertRaises(scrub_snapshot.ScrubError,
+                    scrub_snapshot.scrub, self.cow, parse('--journal', '',
+                        '--passes', 'random,zero', '--journal-interval',
+                        interval))
+
+    def test_flush(self):
+        # 4 metadata stores of 64 exceptions and one of 44, 1k chunks
+        for policy, flushes in (('end', 1), ('area', 6), ('64K', 5),
+                ('dsync', 1)):
+            chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+            metrics = scrub_snapshot.Metrics(self.cow)
+            scrub_snapshot.scrub(self.cow, parse('--journal', '', '-q', '4',
+                '--flush', policy), metrics)
+            self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+            self.assertEquals(metrics.counters['flushes'], flushes)
+            self.assertEquals(metrics.histograms['flush'].count, flushes)
+
+    def test_parse_flush(self):
+        for policy, expected in (('end', 'end'), ('256M', 'bytes:268435456'),
+                ('1048576', 'bytes:1048576'), ('500ms', 'seconds:0.5'),
+                ('2s', 'seconds:2.0')):
+            self.assertEquals(repr(scrub_snapshot.parse_flush(policy)),
+                    expected)
+        for policy in ('sometimes', '0', '-5s'):
+            self.assertRaises(scrub_snapshot.ScrubError,
+                    scrub_snapshot.parse_flush, policy)
+
+    def test_trace_replay(self):
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+        shutil.copy(self.cow, self.cow + '.copy')
+        trace = os.path.join(self.dir, 'trace')
+        scrub_snapshot.scrub(self.cow, parse('--journal', '', '-q', '4',
+            '-z', 'write', '--trace', trace))
+        records = list(scrub_snapshot.directio.read_trace(trace))
+        ops = [record.op for record in records]
+        self.assertEquals(ops.count('flush'), 1)
+        self.assertEquals(sum(record.length for record in records
+            if record.op == 'write'), 300 * chunk_size)
+        # Replaying the trace scrubs a copy of the cow
+        fd = scrub_snapshot.directio.open(self.cow + '.copy', buffered=0)
+        elapsed, recorded, replayed = replay.replay(records, fd, depth=4)
+        fd.close()
+        self.assertEquals(len(replayed['write']), ops.count('write'))
+        self.assertEquals(nonzero_chunks(self.cow + '.copy', chunk_size), 0)
+
+    def test_journal_identity(self):
+        # Two cows alike down to their metadata keep journals of their own
+        other = os.path.join(self.dir, 'other')
+        for path in (self.cow, other):
+            chunk_size = cowgen.generate(path, 300, chunk_sectors=2)
+        journal = os.path.join(self.dir, 'journal')
+        fd = scrub_snapshot.directio.open(self.cow, buffered=0)
+        scrub_snapshot.open_journal(journal, self.cow, fd,
+                chunk_size).record(3)
+        fd.close()
+        scrub_snapshot.scrub(other, parse('--journal', journal))
+        self.assertEquals(nonzero_chunks(other, chunk_size), 0)
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 300)
+
+        # A journal whose cow has changed since is not resumed from
+        cowgen.generate(self.cow, 300, chunk_sectors=2, fragmentation=0.5,
+                origin_chunks=1000)
+        scrub_snapshot.scrub(self.cow, parse('--journal', journal))
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+
+    def test_generate_fill(self):
+        # Every exception chunk is filled, the rest of the last store and
+        # the store ending the cow are left as holes
+        chunk_size = cowgen.generate(self.cow, 70, chunk_sectors=2, fill='17')
+        with open(self.cow, 'rb') as file:
+            data = file.read()
+        first = scrub_snapshot.area_offset(chunk_size, 1) + chunk_size
+        self.assertEquals(data[chunk_size * 2:chunk_size * 66],
+                '\x11' * chunk_size * 64)
+        self.assertEquals(data[first:first + chunk_size * 6],
+                '\x11' * chunk_size * 6)
+        self.assertEquals(data[first + chunk_size * 6:].strip('\0'), '')
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 70)
+
+    def test_progress_while_scanning(self):
+        # Progress is against the exceptions the cow can hold until the
+        # table has been read, this image has room for five full stores
+        cowgen.generate(self.cow, 300, chunk_sectors=2)
+        self.assertEquals(scrub_snapshot.estimate_exceptions(1024,
+            os.path.getsize(self.cow)), 320)
+        events = []
+
+        class Progress(scrub_snapshot.Metrics):
+            def event(self, type, **data):
+                if type == 'progress':
+                    events.append((data['done'], data['total']))
+
+        def scan_areas(*args):
+            for area in original(*args):
+                time.sleep(0.02)
+                yield area
+
+        original = scrub_snapshot.scan_areas
+        scrub_snapshot.scan_areas = scan_areas
+        try:
+            scrub_snapshot.scrub(self.cow, parse('--journal', '', '-b', '1'),
+                    Progress(self.cow))
+        finally:
+            scrub_snapshot.scan_areas = original
+        self.assertEquals(events[0], (64, 320))
+        self.assertEquals([total for done, total in events[:-1]], [320] * 4)
+        self.assertEquals(events[-1], (300, 300))
+        self.assertEquals(scrub_snapshot.estimate_exceptions(1024, 1024), 0)
+        self.assertEquals(scrub_snapshot.estimate_exceptions(4096,
+            4096 * 258), 256)
+
+    def test_serial_scan(self):
+        # The table is scanned a store at a time while the writes and
+        # --verify reads go to the same descriptor
+        for attempt in range(0, 3):
+            chunk_size = cowgen.generate(self.cow, 20000, chunk_sectors=1)
+            metrics = scrub_snapshot.Metrics(self.cow)
+            scrub_snapshot.scrub(self.cow, parse('--journal', '', '-z',
+                'write', '-b', '1', '--cache-mb', '0', '-m', '4096',
+                '--verify'), metrics)
+            self.assertEquals(metrics.counters['exceptions'], 20000)
+            self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+
+    def test_metadata_cache(self):
+        # An image may be rewritten in place within one timestamp tick, so
+        # its reads are only reused within a scrub
+        scrub_snapshot.block_cache = None
+        try:
+            for seed in range(0, 4):
+                # The same size and modification time both times
+                cowgen.generate(self.cow, 300, chunk_sectors=2)
+                os.utime(self.cow, (1000000000, 1000000000))
+                scrub_snapshot.scrub(self.cow, parse('-d', '--journal', ''))
+                chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2,
+                        fragmentation=0.5, origin_chunks=1000, seed=seed)
+                os.utime(self.cow, (1000000000, 1000000000))
+                metrics = scrub_snapshot.Metrics(self.cow)
+                scrub_snapshot.scrub(self.cow, parse('--journal', '', '-q',
+                    '4', '--verify'), metrics)
+                self.assertEquals(metrics.counters['exceptions'], 300)
+                self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+                self.assertEquals(scrub_snapshot.block_cache.hits, 0)
+        finally:
+            scrub_snapshot.block_cache = None
+
+    @unittest.skipIf(cannot_create_loopback(), "requires a loopback device")
+    def test_metadata_cache_device(self):
+        # The -zero device of a fenced cow is cached across scrubs
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+        device = find_loopback_device()
+        zero = os.path.join(self.dir, 'backup-cow-zero')
+        scrub_snapshot.block_cache = None
+        try:
+            call("losetup %s %s" % (device, self.cow), shell=True)
+            os.symlink(device, zero)
+            scrub_snapshot.scrub(zero, parse('-d', '--journal', '', '-q',
+                '4'))
+            cache = scrub_snapshot.block_cache
+            self.assertEquals(cache.hits, 0)
+            # Scrubbing after a display only run reads the header and the
+            # 5 metadata stores from memory
+            metrics = scrub_snapshot.Metrics(zero)
+            scrub_snapshot.scrub(zero, parse('--journal', '', '-q', '4'),
+                    metrics)
+            self.assertEquals(cache.hits, 6)
+            self.assertEquals(metrics.counters['exceptions'], 300)
+            # Until the device is forgotten, as it is before removal
+            scrub_snapshot.forget_cached(zero)
+            self.assertEquals(cache.size, 0)
+        finally:
+            scrub_snapshot.block_cache = None
+            call("losetup -d %s" % device, shell=True)
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+
+    def test_display_only(self):
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+        metrics = scrub_snapshot.Metrics(self.cow)
+        scrub_snapshot.scrub(self.cow, parse('-d', '--journal', ''), metrics)
+        self.assertEquals(metrics.counters['exceptions'], 300)
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 300)
+
+    def test_write_reports(self):
+        metrics = scrub_snapshot.Metrics('/dev/volume/a"b\\c')
+        metrics.add_phase('scan', 1.5)
+        metrics.count('exceptions', 300)
+        for latency in (0.00001, 0.00006, 0.00006, 0.0003, 100):
+            metrics.observe('zero', latency)
+        report, textfile = (os.path.join(self.dir, 'report.json'),
+                os.path.join(self.dir, 'scrub.prom'))
+        scrub_snapshot.write_reports([metrics], parse('--report-json',
+            report, '--textfile', textfile))
+        self.assertFalse(os.path.exists(textfile + '.tmp'))
+
+        with open(report) as file:
+            entry = json.load(file)[0]
+        self.assertEquals(entry['snapshot'], '/dev/volume/a"b\\c')
+        self.assertEquals(entry['counters'], {'exceptions': 300})
+        self.assertEquals(entry['histograms']['zero']['count'], 5)
+        self.assertEquals(entry['histograms']['zero']['p50'], 0.0001)
+
+        with open(textfile) as file:
+            lines = file.read().splitlines()
+        label = 'snapshot="/dev/volume/a\\"b\\\\c"'
+        self.assertEquals([line for line in lines if line.startswith('#')], [
+            '# TYPE scrub_snapshot_phase_seconds gauge',
+            '# TYPE scrub_snapshot_exceptions_total counter',
+            '# TYPE scrub_snapshot_io_latency_seconds histogram'])
+        self.assertTrue('scrub_snapshot_phase_seconds{%s,phase="scan"} '
+                '1.500000' % label in lines)
+        self.assertTrue('scrub_snapshot_exceptions_total{%s} 300' % label
+                in lines)
+        # Bucket counts are cumulative up to the count in +Inf
+        buckets = [int(line.split()[-1]) for line in lines
+                if line.startswith('scrub_snapshot_io_latency_seconds_bucket{'
+                    + label + ',op="zero",le=')]
+        self.assertEquals(len(buckets), len(scrub_snapshot.Histogram.BOUNDS)
+                + 1)
+        self.assertEquals(buckets[:4], [1, 3, 3, 4])
+        self.assertEquals(buckets, sorted(buckets))
+        self.assertEquals(buckets[-2:], [4, 5])
+        self.assertTrue(lines[-2].startswith(
+            'scrub_snapshot_io_latency_seconds_sum{%s,op="zero"} 100.000'
+            % label))
+        self.assertEquals(lines[-1],
+                'scrub_snapshot_io_latency_seconds_count{%s,op="zero"} 5'
+                % label)
+
+    def test_changed_extents(self):
+        self.assertEquals(scrub_snapshot.changed_extents(
+            [9, 3, 4, 5, 10, 0, 4]), [(0, 1), (3, 3), (9, 2)])
+
+    def test_export_changed(self):
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2,
+                fragmentation=0.3, origin_chunks=1000)
+        fd = scrub_snapshot.directio.open(self.cow, buffered=0)
+        table = scrub_snapshot.read_exception_table(fd, chunk_size)
+        fd.close()
+        expected = scrub_snapshot.changed_extents(table.old_chunks)
+        for format in ('json', 'binary'):
+            export = os.path.join(self.dir, '%(snapshot)s.' + format)
+            scrub_snapshot.scrub(self.cow, parse('-d', '--journal', '',
+                '--export-changed', export, '--export-format', format))
+            self.assertEquals(scrub_snapshot.read_changed(
+                os.path.join(self.dir, 'cow.' + format)),
+                (chunk_size, expected))
+        # Every exception is covered once
+        self.assertEquals(sum(count for start, count in expected),
+                len(set(table.old_chunks)))
+
+    def test_scrub_thin(self):
+        data, dump = thin_pool(self.dir)
+        metrics = scrub_snapshot.Metrics(data)
+        options = parse('--thin-dump', dump, '--thin-id', '2', '--verify',
+                '-q', '4', '--max-write', '131072')
+        target = scrub_snapshot.prepare_snapshot(data, options, metrics)
+        self.assertEquals(target[1], [(10, 3), (25, 1)])
+        scrub_snapshot.scrub_target(target, options, metrics)
+        # Only the blocks the origin doesn't share were scrubbed
+        self.assertEquals(nonzero_blocks(data, 65536),
+                range(0, 10) + range(13, 25) + range(26, 32))
+        self.assertEquals(metrics.counters['thin_blocks'], 4)
+        self.assertEquals(metrics.counters['zero_requests'], 3)
+
+    def test_extent_runs(self):
+        runs = scrub_snapshot.extent_runs([(1, 5), (9, 1)], 4096, 8192)
+        self.assertEquals(list(runs), [(4096, 4096), (8192, 8192),
+            (16384, 8192), (36864, 4096)])
+
+    def test_invalid_header(self):
+        with open(self.cow, 'w') as file:
+            file.write(pack('<IIII', 0x1234, 1, 1, 8).ljust(4096, '\0'))
+        self.assertRaises(scrub_snapshot.ScrubError, scrub_snapshot.scrub,
+                self.cow, parse('--journal', ''))
+
+    def test_token_bucket(self):
+        bucket = scrub_snapshot.TokenBucket(1000, 10)
+        start = time.time()
+        bucket.take(10)
+        self.assertTrue(time.time() - start < 0.05)
+        # 100 tokens past the burst take a tenth of a second
+        bucket.take(100)
+        self.assertTrue(0.08 < time.time() - start < 0.5)
+
+    def test_throttle_adapt(self):
+        throttle = scrub_snapshot.Throttle(mbps=100, target_latency=10)
+        throttle.SAMPLE_INTERVAL = 0
+        # Our own requests take 50ms, halve the rate down to the minimum
+        for scale in (0.5, 0.25, 0.125):
+            throttle.observe(0.05)
+            throttle.wait(0)
+            self.assertEquals(throttle.scale, scale)
+            self.assertEquals(throttle.bytes.rate, scale * 100 * 1048576)
+        for attempt in range(0, 10):
+            throttle.observe(0.05)
+            throttle.wait(0)
+        self.assertEquals(throttle.scale, throttle.MIN_SCALE)
+        # Then back up a step at a time while they are under the target
+        throttle.observe(0.001)
+        throttle.wait(0)
+        self.assertAlmostEquals(throttle.scale, throttle.MIN_SCALE + 0.05)
+        for attempt in range(0, 30):
+            throttle.observe(0.001)
+            throttle.wait(0)
+        self.assertEquals(throttle.scale, 1.0)
+
+    def test_throttle_engine(self):
+        # The latency of writes through an engine reaches the throttle
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+        observed = []
+
+        class Throttle(scrub_snapshot.Throttle):
+            def observe(self, latency):
+                observed.append(latency)
+
+        original = scrub_snapshot.Throttle
+        scrub_snapshot.Throttle = Throttle
+        try:
+            scrub_snapshot.scrub(self.cow, parse('--journal', '', '-q', '4',
+                '-z', 'write', '-m', '1024', '--target-latency', '100'))
+        finally:
+            scrub_snapshot.Throttle = original
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+        self.assertTrue(len(observed) > 0)
+        self.assertTrue(all(latency >= 0 for latency in observed))
+
+    def test_failed_scrub_closes(self):
+        # A scrub that fails leaves no descriptors or engine threads behind
+        cowgen.generate(self.cow, 300, chunk_sectors=2)
+        data, dump = thin_pool(self.dir)
+        missing = os.path.join(self.dir, 'missing', 'extents')
+        fds, threads = (len(os.listdir('/proc/self/fd')),
+                threading.active_count())
+        for attempt in range(0, 3):
+            for target, args in ((self.cow, ('--passes', 'bogus')),
+                    (self.cow, ('--export-changed', missing)),
+                    (data, ('--thin-dump', dump, '--thin-id', '2',
+                        '--passes', 'random,0xff', '--verify'))):
+                options = parse('--journal', '', '-w', '8', *args)
+                self.assertRaises((scrub_snapshot.ScrubError, IOError),
+                        scrub_snapshot.remove_snapshot, target, options)
+        self.assertEquals(len(os.listdir('/proc/self/fd')), fds)
+        self.assertEquals(threading.active_count(), threads)
+
+    def test_journal_resume(self):
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+        journal = os.path.join(self.dir, 'journal')
+        options = parse('--journal', journal, '--journal-interval', '1')
+        # Pretend a previous scrub finished the first two stores
+        fd = scrub_snapshot.directio.open(self.cow, buffered=0)
+        scrub_snapshot.open_journal(journal, self.cow, fd,
+                chunk_size).record(2)
+        fd.close()
+        scrub_snapshot.scrub(self.cow, options)
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 128)
+        # The journal is removed once the scrub completes
+        self.assertEquals(os.listdir(journal), [])
+
+
+class TestEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(dir='/tmp')
+        self.cow = os.path.join(self.dir, 'cow')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_scrub_events(self):
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+        events = list(scrub_snapshot.scrub_events(self.cow,
+            scrub_snapshot.scrub_options(journal='', queue_depth=4)))
+        types = [event.type for event in events]
+        self.assertEquals(types.count('area'), 5)
+        self.assertEquals(types[-1], 'done')
+        self.assertEquals(sum(event.data['length'] for event in events
+            if event.type == 'extent'), 300 * chunk_size)
+        progress = [event.data for event in events
+                if event.type == 'progress']
+        self.assertEquals((progress[-1]['done'], progress[-1]['bytes']),
+                (300, 300 * chunk_size))
+        self.assertEquals(events[-1].data['report']['counters']['exceptions'],
+                300)
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+
+    def test_invalid_options(self):
+        self.assertEquals(scrub_snapshot.scrub_options('-q', '8').queue_depth,
+                8)
+        for args in (('--queue-depth', 'abc'), ('--bogus',), ('-z', 'no')):
+            self.assertRaises(scrub_snapshot.ScrubError,
+                    scrub_snapshot.scrub_options, *args)
+        self.assertRaises(TypeError, scrub_snapshot.scrub_options, depth=8)
+
+    def test_error_event(self):
+        events = list(scrub_snapshot.scrub_events(
+            os.path.join(self.dir, 'missing'),
+            scrub_snapshot.scrub_options(journal='')))
+        self.assertEquals([event.type for event in events], ['error'])
+        self.assertTrue('does not exist' in events[0].data['message'])
+        self.assertRaises(TypeError, scrub_snapshot.scrub_options, bogus=1)
+
+    def test_cancel(self):
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+        events = scrub_snapshot.scrub_events(self.cow,
+                scrub_snapshot.scrub_options(journal=''), backlog=1)
+        # Stop after the first store, the scrub blocks on the backlog
+        for event in events:
+            if event.type == 'area':
+                break
+        events.close()
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 300 - 64)
+
+    def test_select(self):
+        cows = [os.path.join(self.dir, 'cow%d' % index) for index in range(3)]
+        for cow in cows:
+            chunk_size = cowgen.generate(cow, 200, chunk_sectors=2)
+        tasks = [scrub_snapshot.ScrubTask(cow, scrub_snapshot.scrub_options(
+            journal=''), backlog=4) for cow in cows]
+        for task in tasks:
+            task.start()
+        done, running = ([], list(tasks))
+        while running:
+            for task in select.select(running, [], [])[0]:
+                done.extend(event.snapshot for event in task.events()
+                        if event.type == 'done')
+                if task.finished:
+                    running.remove(task)
+        for task in tasks:
+            task.close()
+        self.assertEquals(sorted(done), cows)
+        for cow in cows:
+            self.assertEquals(nonzero_chunks(cow, chunk_size), 0)
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(dir='/tmp')
+        scrub_snapshot.dm_backend = dm.FakeDeviceMapper(self.dir)
+        self.daemon = scrub_snapshot.Daemon(parse('--max-scrubs', '2',
+            '--cache-mb', '8'))
+        self.socket = os.path.join(self.dir, 'scrub.sock')
+        self.server = scrub_snapshot.DaemonServer(self.socket, self.daemon)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.daemon.close()
+        scrub_snapshot.resources = None
+        scrub_snapshot.block_cache = None
+        scrub_snapshot.dm_backend = None
+        shutil.rmtree(self.dir)
+
+    def request(self, **request):
+        return list(scrub_snapshot.daemon_request(self.socket, request))
+
+    def test_jobs(self):
+        cows = [os.path.join(self.dir, name) for name in ('cow1', 'cow2')]
+        for cow in cows:
+            chunk_size = cowgen.generate(cow, 300, chunk_sectors=2)
+        reply = self.request(command='submit', args=cows + ['--journal', '',
+            '-q', '4', '--verify'])
+        self.assertEquals(reply, [{'jobs': [1, 2]}])
+        for id in (1, 2):
+            states = self.request(command='watch', job=id)
+            self.assertEquals(states[-1]['state'], 'done')
+            self.assertEquals(states[-1]['done'], 300)
+        for cow in cows:
+            self.assertEquals(nonzero_chunks(cow, chunk_size), 0)
+        # Jobs share the cache sized by the daemon
+        self.assertEquals(scrub_snapshot.block_cache.max_bytes, 8 << 20)
+        listed = self.request(command='list')[0]['jobs']
+        self.assertEquals([(job['job'], job['state']) for job in listed],
+                [(1, 'done'), (2, 'done')])
+
+        # The engines of the first jobs are reused by the next
+        engines = sum(len(idle) for idle in
+                scrub_snapshot.resources.engines.values())
+        cowgen.generate(cows[0], 300, chunk_sectors=2)
+        self.request(command='submit', args=cows[:1] + ['--journal', '',
+            '-q', '4'])
+        self.assertEquals(self.request(command='watch', job=3)[-1]['state'],
+                'done')
+        self.assertEquals(sum(len(idle) for idle in
+            scrub_snapshot.resources.engines.values()), engines)
+
+    def test_errors(self):
+        self.assertTrue('error' in self.request(command='status', job=9)[0])
+        self.assertTrue('error' in self.request(command='bogus')[0])
+        for args in (['cow', '--bogus'], ['cow', '-q', 'deep'], ['--help']):
+            reply = self.request(command='submit', args=args)
+            self.assertEquals(reply[0].keys(), ['error'])
+        reply = self.request(command='submit',
+                args=[os.path.join(self.dir, 'missing'), '--journal', ''])
+        states = self.request(command='watch', job=reply[0]['jobs'][0])
+        self.assertEquals(states[-1]['state'], 'failed')
+        self.assertTrue('does not exist' in states[-1]['error'])
+
+    def test_cancel(self):
+        cowgen.generate(os.path.join(self.dir, 'cow'), 10, chunk_sectors=2)
+        job = scrub_snapshot.Job(1, os.path.join(self.dir, 'cow'),
+                parse('--journal', ''))
+        job.cancelled.set()
+        self.daemon.run(job)
+        self.assertEquals(job.status()['state'], 'cancelled')
+
+
+class TestRemoveSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(dir='/tmp')
+        self.cow = os.path.join(self.dir, 'cow')
+        self.fake = dm.FakeDeviceMapper(os.path.join(self.dir, 'mapper'))
+        os.mkdir(self.fake.root)
+        scrub_snapshot.dm_backend = self.fake
+
+    def tearDown(self):
+        scrub_snapshot.dm_backend = None
+        shutil.rmtree(self.dir)
+
+    def test_remove_snapshot(self):
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+        snapshot = self.fake.add_snapshot('volume-backup', self.cow)
+        metrics = scrub_snapshot.Metrics(snapshot)
+        scrub_snapshot.remove_snapshot(snapshot,
+                parse('--journal', '', '--verify'), metrics)
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+        self.assertEquals(self.fake.devices, {})
+        self.assertTrue('suspend' in metrics.phases)
+
+        # Both tables were ready before the origin was suspended
+        calls = [(operation, name) for _, operation, name
+                in self.fake.calls if operation not in ('exists', 'table',
+                    'status')]
+        self.assertEquals(calls[:6], [
+            ('create', 'volume-backup-cow'), ('create', 'volume-backup'),
+            ('create', 'volume-backup-cow-zero'),
+            ('load', 'volume-backup-cow'), ('suspend', 'volume-backup-cow'),
+            ('resume', 'volume-backup-cow')])
+
+    def test_elevator(self):
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+        snapshot = self.fake.add_snapshot('volume-backup', self.cow)
+        # The second half of the cow comes first on the disk
+        half = os.path.getsize(self.cow) / 1024
+        self.fake.devices['volume-backup-cow']['table'] = [
+            (0, half, 'linear', '%s %d' % (self.cow, half)),
+            (half, half, 'linear', '%s 0' % self.cow)]
+
+        class Extents(scrub_snapshot.Metrics):
+            def event(self, type, **data):
+                if type == 'extent':
+                    extents.append((data['offset'], data['length']))
+
+        extents = []
+        scrub_snapshot.remove_snapshot(snapshot, parse('--journal', ''),
+                Extents(snapshot))
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+        physical = [offset - half * 512 if offset >= half * 512
+                else offset + half * 512 for offset, length in extents]
+        self.assertEquals(physical, sorted(physical))
+        self.assertTrue(extents[0][0] >= half * 512)
+
+    def test_elevator_flush_area(self):
+        # With a layout --flush area still flushes after each of the 5
+        # metadata stores, then once at the end
+        chunk_size = cowgen.generate(self.cow, 300, chunk_sectors=2)
+        snapshot = self.fake.add_snapshot('volume-backup', self.cow)
+        half = os.path.getsize(self.cow) / 1024
+        self.fake.devices['volume-backup-cow']['table'] = [
+            (0, half, 'linear', '%s %d' % (self.cow, half)),
+            (half, half, 'linear', '%s 0' % self.cow)]
+        metrics = scrub_snapshot.Metrics(snapshot)
+        scrub_snapshot.remove_snapshot(snapshot, parse('--journal', '',
+            '--flush', 'area'), metrics)
+        self.assertEquals(nonzero_chunks(self.cow, chunk_size), 0)
+        self.assertEquals(metrics.counters['flushes'], 6)
+
+    def test_cow_identity(self):
+        # The -zero device is known as its cow, even once it is recreated
+        cowgen.generate(self.cow, 10, chunk_sectors=2)
+        self.fake.add_snapshot('volume-backup', self.cow)
+        table = self.fake.table('volume-backup-cow')
+        scrub_snapshot.prepare_cow('volume-backup-cow')
+        zero = self.fake.path('volume-backup-cow-zero')
+        self.assertEquals(scrub_snapshot.cow_identity(zero),
+                'dm-uuid:LVM-volume-backup-cow')
+        self.fake.remove('volume-backup-cow-zero')
+        self.fake.create('volume-backup-cow-zero', table)
+        self.assertEquals(scrub_snapshot.cow_identity(zero),
+                'dm-uuid:LVM-volume-backup-cow')
+        info = os.stat(self.cow)
+        self.assertEquals(scrub_snapshot.cow_identity(self.cow),
+                'file:%d:%d' % (info.st_dev, info.st_ino))
+
+    def test_skip_remove(self):
+        cowgen.generate(self.cow, 10, chunk_sectors=2)
+        snapshot = self.fake.add_snapshot('volume-backup', self.cow)
+        scrub_snapshot.remove_snapshot(snapshot,
+                parse('--journal', '', '-s'))
+        self.assertEquals(self.fake.table('volume-backup-cow'),
+                [(0, os.path.getsize(self.cow) / 512, 'error', '')])
+        self.assertTrue(self.fake.exists('volume-backup-cow-zero'))
+
+    def test_remove_thin_snapshot(self):
+        data, dump = thin_pool(self.dir)
+        snapshot = self.fake.add_thin_snapshot('volume-backup', data, 2)
+        metrics = scrub_snapshot.Metrics(snapshot)
+        scrub_snapshot.remove_snapshot(snapshot, parse('--journal', '',
+            '--thin-dump', dump), metrics)
+        self.assertEquals(nonzero_blocks(data, 65536),
+                range(0, 10) + range(13, 25) + range(26, 32))
+        self.assertFalse(self.fake.exists('volume-backup'))
+        self.assertTrue(self.fake.exists('volume-backup-pool'))
+        self.assertTrue('suspend' in metrics.phases)
+
+    def test_remove_snapshots(self):
+        # 6 snapshots on 3 devices, no more than 2 scrubs on the host and
+        # 1 on each device; the first snapshot's cow is corrupt
+        snapshots, devices = ([], {})
+        for index in range(0, 6):
+            cow = os.path.join(self.dir, 'cow%d' % index)
+            cowgen.generate(cow, 100, chunk_sectors=2)
+            snapshot = self.fake.add_snapshot('volume-backup%d' % index, cow)
+            devices[snapshot] = ['8:%d' % (16 * (index % 3))]
+            snapshots.append(snapshot)
+        with open(os.path.join(self.dir, 'cow0'), 'r+') as file:
+            file.write('\0' * 16)
+
+        lock, running, peaks = (threading.Lock(), {}, {})
+
+        def scrub_target(target, options, metrics):
+            keys = ['host'] + devices[metrics.snapshot]
+            with lock:
+                for key in keys:
+                    running[key] = running.get(key, 0) + 1
+                    peaks[key] = max(peaks.get(key, 0), running[key])
+            try:
+                time.sleep(0.05)
+                return original(target, options, metrics)
+            finally:
+                with lock:
+                    for key in keys:
+                        running[key] = running[key] - 1
+
+        original, target_devices = (scrub_snapshot.scrub_target,
+                scrub_snapshot.target_devices)
+        scrub_snapshot.scrub_target = scrub_target
+        scrub_snapshot.target_devices = lambda snapshot, target: \
+                devices[snapshot]
+        metrics = [scrub_snapshot.Metrics(snapshot) for snapshot in snapshots]
+        try:
+            self.assertRaises(scrub_snapshot.ScrubError,
+                    scrub_snapshot.remove_snapshots, snapshots,
+                    parse('--journal', '', '--max-scrubs', '2',
+                        '--max-device-scrubs', '1'), metrics)
+        finally:
+            scrub_snapshot.scrub_target = original
+            scrub_snapshot.target_devices = target_devices
+        self.assertEquals(peaks['host'], 2)
+        self.assertEquals([peaks[device] for device in ('8:0', '8:16',
+            '8:32')], [1, 1, 1])
+        # Only the corrupt snapshot was left behind
+        self.assertTrue('error' in metrics[0].info)
+        self.assertFalse(any('error' in entry.info for entry in metrics[1:]))
+        self.assertEquals(sorted(self.fake.devices), ['volume-backup0',
+            'volume-backup0-cow', 'volume-backup0-cow-zero'])
+        for index in range(1, 6):
+            self.assertEquals(nonzero_chunks(os.path.join(self.dir,
+                'cow%d' % index), 1024), 0)
+
+    def test_thin_origin(self):
+        # A thin volume that isn't a snapshot is left alone
+        data, dump = thin_pool(self.dir)
+        volume = self.fake.add_thin_snapshot('volume-origin', data, 1,
+                origin=None)
+        self.assertRaises(scrub_snapshot.ScrubError,
+                scrub_snapshot.remove_snapshot, volume, parse('--journal', '',
+                    '--thin-dump', dump))
+        self.assertEquals(nonzero_blocks(data, 65536), range(0, 32))
+        self.assertEquals(self.fake.table('volume-origin')[0][2], 'thin')
+        self.assertTrue(self.fake.exists('volume-origin'))
+
+    def test_invalid_snapshot(self):
+        self.fake.create('volume-origin', [(0, 8, 'error', '')])
+        self.assertRaises(scrub_snapshot.ScrubError,
+                scrub_snapshot.remove_snapshot,
+                self.fake.path('volume-origin'), parse('--journal', ''))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+
+from StringIO import StringIO
+import unittest
+import thin
+
+# Thin device 1 is the origin, device 2 a snapshot of it that still
+# shares data blocks 0-3 and 20 and has written blocks 10-12 and 25
+THIN_DUMP = '''<superblock uuid="" time="1" transaction="2" flags="0" version="2"
+    data_block_size="128" nr_data_blocks="32">
+  <device dev_id="1" mapped_blocks="9" transaction="0" creation_time="0"
+      snap_time="1">
+    <range_mapping origin_begin="0" data_begin="0" length="8" time="0"/>
+    <single_mapping origin_block="8" data_block="20" time="0"/>
+  </device>
+  <device dev_id="2" mapped_blocks="9" transaction="1" creation_time="1"
+      snap_time="1">
+    <range_mapping origin_begin="0" data_begin="0" length="4" time="0"/>
+    <range_mapping origin_begin="4" data_begin="10" length="3" time="1"/>
+    <single_mapping origin_block="8" data_block="20" time="0"/>
+    <single_mapping origin_block="7" data_block="25" time="1"/>
+  </device>
+</superblock>
+'''
+
+
+class TestThin(unittest.TestCase):
+
+    def test_parse_thin_dump(self):
+        metadata = thin.parse_thin_dump(StringIO(THIN_DUMP))
+        self.assertEquals(metadata.block_size, 65536)
+        self.assertEquals(metadata.devices[1], [(0, 8), (20, 1)])
+        self.assertEquals(metadata.devices[2],
+                [(0, 4), (10, 3), (20, 1), (25, 1)])
+        self.assertRaises(thin.ThinError, thin.parse_thin_dump,
+                StringIO('<device dev_id="1"></device>'))
+
+    def test_extents(self):
+        self.assertEquals(thin.merge_extents([(5, 2), (0, 3), (3, 1),
+            (6, 4)]), [(0, 4), (5, 5)])
+        self.assertEquals(thin.subtract_extents([(0, 10), (20, 5)],
+            [(2, 2), (8, 14), (24, 4)]), [(0, 2), (4, 4), (22, 2)])
+
+    def test_exclusive_extents(self):
+        metadata = thin.parse_thin_dump(StringIO(THIN_DUMP))
+        self.assertEquals(thin.exclusive_extents(metadata, 2),
+                [(10, 3), (25, 1)])
+        self.assertEquals(thin.exclusive_extents(metadata, 1), [(4, 4)])
+        self.assertRaises(thin.ThinError, thin.exclusive_extents, metadata, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+
+from xml.etree.cElementTree import iterparse
+from collections import namedtuple
+from subprocess import Popen, PIPE
+import logging
+
+log = logging.getLogger('scrub-snapshot')
+
+# A thin snapshot and its pool; 'metadata' and 'data' are the paths of
+# the pool's devices, 'block_size' the pool's data block size in bytes
+ThinSnapshot = namedtuple('ThinSnapshot',
+        'name pool dev_id metadata data block_size')
+
+
+class ThinError(RuntimeError):
+    pass
+
+
+class ThinMetadata(object):
+    # The data block mappings of every device in a thin pool as
+    # (first data block, number of blocks) extents, keyed by dev_id
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.devices = {}
+
+
+def parse_thin_dump(source):
+    # Parse the XML written by thin_dump(8), 'source' is a file name or
+    # object; mappings are streamed so huge pools don't build a tree
+    #  <superblock data_block_size="128" ...>
+    #    <device dev_id="1" ...>
+    #      <range_mapping origin_begin="0" data_begin="0" length="16" .../>
+    #      <single_mapping origin_block="20" data_block="40" .../>
+    metadata, extents = (None, None)
+    for event, element in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == 'superblock':
+                # data_block_size is in 512 byte sectors
+                metadata = ThinMetadata(
+                        int(element.get('data_block_size')) << 9)
+            elif element.tag == 'device':
+                if metadata is None:
+                    raise ThinError("device outside of a superblock")
+                extents = metadata.devices.setdefault(
+                        int(element.get('dev_id')), [])
+            continue
+        if element.tag == 'range_mapping':
+            extents.append((int(element.get('data_begin')),
+                int(element.get('length'))))
+        elif element.tag == 'single_mapping':
+            extents.append((int(element.get('data_block')), 1))
+        element.clear()
+    if metadata is None:
+        raise ThinError("no superblock in the thin metadata dump")
+    return metadata
+
+
+def merge_extents(extents):
+    # Sort (first, count) extents and merge those that overlap or touch
+    merged = []
+    for first, count in sorted(extents):
+        if merged and first <= merged[-1][0] + merged[-1][1]:
+            last_first, last_count = merged[-1]
+            merged[-1] = (last_first, max(last_count,
+                first + count - last_first))
+            continue
+        merged.append((first, count))
+    return merged
+
+
+def subtract_extents(extents, others):
+    # The parts of merged 'extents' not covered by merged 'others'
+    result, index = ([], 0)
+    for first, count in extents:
+        end = first + count
+        while index < len(others) and others[index][0] + others[index][1] \
+                <= first:
+            index = index + 1
+        position, scan = (first, index)
+        while scan < len(others) and others[scan][0] < end:
+            if others[scan][0] > position:
+                result.append((position, others[scan][0] - position))
+            position = max(position, others[scan][0] + others[scan][1])
+            scan = scan + 1
+        if position < end:
+            result.append((position, end - position))
+    return result
+
+
+def exclusive_extents(metadata, dev_id):
+    # The data blocks mapped by 'dev_id' and by no other thin device, the
+    # blocks it still shares with its origin must not be scrubbed
+    if dev_id not in metadata.devices:
+        raise ThinError("thin device '%d' is not in the pool metadata"
+                % dev_id)
+    others = merge_extents(extent for id, extents
+            in metadata.devices.items() if id != dev_id
+            for extent in extents)
+    return subtract_extents(merge_extents(metadata.devices[dev_id]), others)
+
+
+def thin_snapshot(backend, path):
+    # Return the ThinSnapshot of the thin device at 'path', or None
+    # e.g. "0 2097152 thin 253:4 2" is thin device 2 in pool 253:4 and
+    # "0 20971520 thin-pool 253:2 253:3 128 0 0" has metadata on 253:2,
+    # data on 253:3 and 128 sector data blocks
+    name = backend.name(path)
+    if name is None:
+        return None
+    table = backend.table(name)
+    if len(table) != 1 or table[0][2] != 'thin':
+        return None
+    params = table[0][3].split()
+    pool = backend.name(params[0])
+    pool_table = backend.table(pool)
+    if not pool_table or pool_table[0][2] != 'thin-pool':
+        raise ThinError("'%s' of '%s' is not a thin-pool" % (pool, name))
+    pool_params = pool_table[0][3].split()
+    return ThinSnapshot(name, pool, int(params[1]),
+            backend.path(backend.name(pool_params[0])),
+            backend.path(backend.name(pool_params[1])),
+            int(pool_params[2]) << 9)
+
+
+def dump_metadata(backend, snapshot):
+    # Parse a thin_dump of a metadata snapshot, the live metadata can't be
+    # read safely while the pool is active
+    backend.message(snapshot.pool, 0, 'reserve_metadata_snap')
+    try:
+        log.info("thin_dump --metadata-snap %s" % snapshot.metadata)
+        process = Popen(['thin_dump', '--metadata-snap', snapshot.metadata],
+                stdout=PIPE)
+        try:
+            metadata = parse_thin_dump(process.stdout)
+        finally:
+            process.stdout.close()
+            if process.wait():
+                raise ThinError("thin_dump of '%s' returned non-zero exit "
+                        "status" % snapshot.metadata)
+        return metadata
+    finally:
+        backend.message(snapshot.pool, 0, 'release_metadata_snap')